@@ -0,0 +1,150 @@
+import time
+
+import metrics
+
+# Ответ-заглушка на последней ступени: клиент сразу видит, что его услышали
+QUEUED_REPLY = (
+    "Я получил ваше сообщение. Сейчас ко мне обращается много людей — "
+    "ответ придет через минуту-другую, пожалуйста, подождите."
+)
+
+
+class AdmissionDecision:
+    """Что разрешено реплике на текущей ступени деградации."""
+
+    __slots__ = ("tier", "name", "review", "search", "capped", "acknowledge")
+
+    def __init__(self, tier, name, review, search, capped, acknowledge):
+        self.tier = tier
+        self.name = name
+        self.review = review
+        self.search = search
+        self.capped = capped
+        self.acknowledge = acknowledge
+
+
+# Ступени по возрастанию нагрузки: каждая добавляет ограничение к предыдущей
+TIERS = (
+    AdmissionDecision(0, "normal", review=True, search=True, capped=False, acknowledge=False),
+    AdmissionDecision(1, "no_review", review=False, search=True, capped=False, acknowledge=False),
+    AdmissionDecision(2, "no_search", review=False, search=False, capped=False, acknowledge=False),
+    AdmissionDecision(3, "short_replies", review=False, search=False, capped=True, acknowledge=False),
+    AdmissionDecision(4, "acknowledge", review=False, search=False, capped=True, acknowledge=True),
+)
+
+
+class AdmissionController:
+    """
+    Контроль допуска при перегрузке.
+
+    По числу вызовов LLM в работе и в очереди общего лимита и по времени,
+    которое ждет самый давний ответ клиенту, выбирается ступень деградации:
+    сначала отключается супервизия, затем поиск, затем ограничивается длина
+    ответа, и наконец клиенту сразу отправляется короткое подтверждение,
+    пока полный ответ ждет очереди. Вверх ступени переключаются сразу,
+    вниз — на одну за каждые `hold_seconds`, пока нагрузка остается ниже
+    порогов с запасом `recovery_ratio` (гистерезис), чтобы режим не
+    переключался туда-обратно на границе порога.
+    """
+
+    def __init__(self, limiter, load_thresholds=(1.0, 1.5, 2.5, 4.0),
+                 wait_thresholds=(1.0, 3.0, 6.0, 10.0), recovery_ratio=0.5,
+                 hold_seconds=10.0, check_interval=0.25, logger=None):
+        """
+        Args:
+            limiter (LLMRateLimiter): Общий лимит на вызовы OpenAI
+            load_thresholds (tuple): Пороги ступеней 1-4 по загрузке:
+                (в работе + в очереди) / max_concurrency
+            wait_thresholds (tuple): Пороги ступеней 1-4 по ожиданию слота
+                ответом клиенту, сек
+            recovery_ratio (float): Доля порога, ниже которой ступень снижается
+            hold_seconds (float): Сколько длится затишье до снижения на ступень
+            check_interval (float): Как часто пересчитывать нагрузку, сек
+            logger: Логгер для диагностических сообщений
+        """
+        self.limiter = limiter
+        self.load_thresholds = tuple(load_thresholds)
+        self.wait_thresholds = tuple(wait_thresholds)
+        self.recovery_ratio = recovery_ratio
+        self.hold_seconds = hold_seconds
+        self.check_interval = check_interval
+        self.logger = logger
+
+        self.tier = 0
+        self.load = 0.0
+        self.wait = 0.0
+        self._checked_at = None
+        self._calm_since = None
+        self._admitted = {decision.name: 0 for decision in TIERS}
+        self._tier_changes = 0
+
+    def _level(self, scale):
+        by_load = sum(self.load >= threshold * scale for threshold in self.load_thresholds)
+        by_wait = sum(self.wait >= threshold * scale for threshold in self.wait_thresholds)
+        return max(by_load, by_wait)
+
+    def update(self):
+        """Пересчитывает нагрузку (не чаще check_interval) и возвращает ступень."""
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return self.tier
+        self._checked_at = now
+
+        in_flight, waiting, self.wait = self.limiter.load()
+        self.load = (in_flight + waiting) / max(1, self.limiter.max_concurrency)
+
+        target = self._level(1.0)
+        if target > self.tier:
+            self._set_tier(target)
+            self._calm_since = None
+        elif self.tier:
+            floor = self._level(self.recovery_ratio)
+            if floor >= self.tier:
+                self._calm_since = None
+            else:
+                if self._calm_since is None:
+                    # Между проверками обращений не было — значит, и нагрузки
+                    self._calm_since = checked_at
+                # За каждые hold_seconds затишья — на ступень ниже
+                steps = int((now - self._calm_since) // self.hold_seconds)
+                if steps:
+                    self._set_tier(max(floor, self.tier - steps))
+                    self._calm_since = now
+        return self.tier
+
+    def _set_tier(self, tier):
+        if self.logger:
+            log = self.logger.warning if tier > self.tier else self.logger.info
+            log(
+                f"Допуск: ступень {self.tier} -> {tier} ({TIERS[tier].name}), "
+                f"загрузка {self.load:.2f}, ожидание {self.wait:.1f} с"
+            )
+        self.tier = tier
+        self._tier_changes += 1
+        metrics.inc("admission_tier_changes_total", to=TIERS[tier].name)
+
+    def admit(self):
+        """
+        Решение для новой реплики клиента.
+
+        Returns:
+            AdmissionDecision: Ограничения текущей ступени
+        """
+        decision = TIERS[self.update()]
+        self._admitted[decision.name] += 1
+        return decision
+
+    def allows_review(self):
+        """Можно ли сейчас тратить вызовы LLM на супервизию."""
+        return TIERS[self.update()].review
+
+    def stats(self):
+        """Текущая ступень, нагрузка и число реплик, принятых на каждой ступени."""
+        return {
+            "tier": self.tier,
+            "load": round(self.load, 3),
+            "queue_wait_seconds": round(self.wait, 3),
+            "tier_changes": self._tier_changes,
+            "admitted": dict(self._admitted),
+        }
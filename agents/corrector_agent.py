@@ -1,44 +1,29 @@
-import os
-from langchain_openai import ChatOpenAI
 from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate
+from agents.history_window import count_tokens
+from llm_invoker import invoker_from_env
+from model_router import get_model_router
+import prompts
+from scheduler import NO_LIMIT, PRIORITY_BACKGROUND
+import metrics
 
 
 class CorrectorAgent:
-    def __init__(self, logger=None):
+    def __init__(self, rate_limiter=None, router=None, invoker=None, logger=None):
         self.logger = logger
-        self.llm = ChatOpenAI(
-            model="gpt-4",
-            temperature=0.4,
-            api_key=os.getenv("OPENAI_API_KEY")
-        )
+        self.rate_limiter = rate_limiter or NO_LIMIT
+        self.invoker = invoker or invoker_from_env("corrector", 90.0, logger)
+        self.router = router or get_model_router(logger)
+        self.llm = self.router.model("corrector")
+        # Собственный лимит коррекций поверх общего лимита OpenAI
+        self.route_limiter = self.router.limiter("corrector")
         self.setup_chain()
     
     def setup_chain(self):
-        prompt_template = """
-        Вы - эксперт по улучшению промптов для языковых моделей. Ваша задача - 
-        обновить промпт психолога-консультанта на основе анализа его работы.
-
-        Текущий промпт психолога:
-        {old_prompt}
-
-        Анализ работы психолога:
-        {analysis}
-
-        Пожалуйста, создайте обновленную версию промпта, которая:
-        1. Сохранит все сильные стороны текущего промпта
-        2. Исправит выявленные проблемы
-        3. Добавит конкретные инструкции по улучшению работы
-        4. Сделает акцент на этичности и профессионализме
-        5. Сохранит ясность и четкость инструкций
-
-        Обновленный промпт должен быть конкретным, практичным и эффективным.
-        """
-        
-        prompt = PromptTemplate(
-            input_variables=["old_prompt", "analysis"],
-            template=prompt_template
-        )
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompts.rewriter_system),
+            ("human", prompts.rewriter_user),
+        ])
         
         self.chain = LLMChain(
             llm=self.llm,
@@ -54,17 +39,23 @@ class CorrectorAgent:
             analysis (str): Анализ работы психолога
             
         Returns:
-            str: Обновленный промпт
+            str: Обновленный промпт или None, если модель не ответила
         """
         try:
-            return await self.chain.arun(
-                old_prompt=old_prompt,
-                analysis=analysis
-            )
+            # Оценка: промпт (~300 токенов) + входные данные + новый промпт
+            tokens = 300 + 2 * count_tokens(old_prompt) + count_tokens(analysis)
+            async with self.route_limiter.slot(tokens, PRIORITY_BACKGROUND), \
+                    self.rate_limiter.slot(tokens, PRIORITY_BACKGROUND), \
+                    metrics.stage("corrector"):
+                new_prompt = await self.invoker.call(
+                    lambda: self.chain.arun(
+                        old_prompt=old_prompt,
+                        analysis=analysis
+                    )
+                )
         except Exception as e:
             if self.logger:
                 self.logger.error(f"Ошибка в CorrectorAgent: {str(e)}")
-            return (
-                "Произошла ошибка при обновлении промпта. "
-                f"Техническая информация: {str(e)}"
-            ) 
\ No newline at end of file
+            return None
+        # Пустой ответ не должен заменить рабочий промпт
+        return new_prompt.strip() or None 
\ No newline at end of file
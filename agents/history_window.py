@@ -0,0 +1,216 @@
+import asyncio
+from collections import OrderedDict, deque
+
+# Кодировка tiktoken загружается при первом подсчете (или при прогреве)
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:  # tiktoken не установлен или нет доступа к файлам кодировки
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Считает токены в тексте (приблизительно, если tiktoken недоступен)."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+class _Message:
+    __slots__ = ("speaker", "text", "tokens")
+
+    def __init__(self, speaker, text):
+        self.speaker = speaker
+        self.text = text
+        # Количество токенов считается один раз при добавлении
+        self.tokens = count_tokens(f"{speaker}: {text}")
+
+    def render(self):
+        return f"{self.speaker}: {self.text}"
+
+
+class ChatHistoryWindow:
+    """
+    Окно истории одного чата, ограниченное по числу токенов.
+
+    Новые реплики добавляются инкрементально, старые вытесняются из окна
+    в очередь на свертку и затем объединяются в краткое содержание беседы.
+
+    Вытеснение идет крупными порциями — сразу до `keep_ratio` бюджета, —
+    а краткое содержание выводится после дословных реплик. Поэтому между
+    вытеснениями текст истории только дописывается в конец, и начало
+    запроса к модели совпадает с предыдущим вызовом (кэширование
+    промптов OpenAI); свертка меняет лишь хвост истории.
+    """
+
+    def __init__(self, max_tokens, keep_ratio=0.6):
+        self.max_tokens = max_tokens
+        self.keep_tokens = int(max_tokens * keep_ratio)
+        self.messages = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.pending = []
+        self.last_turn = None
+        self.fold_task = None
+
+    def reset(self):
+        self.messages.clear()
+        self.tokens = 0
+        self.pending = []
+        self.last_turn = None
+
+    def append(self, speaker, text):
+        message = _Message(speaker, text)
+        self.messages.append(message)
+        self.tokens += message.tokens
+        if self.tokens <= self.max_tokens:
+            return
+        while self.tokens > self.keep_tokens and len(self.messages) > 1:
+            old = self.messages.popleft()
+            self.tokens -= old.tokens
+            self.pending.append(old)
+
+    def render(self):
+        parts = [message.render() for message in self.messages]
+        if self.summary:
+            parts.append(
+                f"Краткое содержание более ранней части беседы (до реплик выше): {self.summary}"
+            )
+        return "\n".join(parts)
+
+
+class HistoryWindowManager:
+    """
+    Инкрементальные окна истории для всех чатов.
+
+    При каждом вызове `sync` в окно добавляются только реплики, появившиеся
+    после предыдущего вызова, поэтому размер промпта не растет вместе
+    с длиной сессии.
+    """
+
+    def __init__(self, max_tokens=1500, summary_max_tokens=300,
+                 summarizer=None, max_chats=10000, keep_ratio=0.6, logger=None):
+        """
+        Args:
+            max_tokens (int): Бюджет токенов на дословную часть истории
+            summary_max_tokens (int): Бюджет токенов на краткое содержание
+            summarizer (callable): Корутина summarizer(summary, text) -> str,
+                объединяющая старое краткое содержание с вытесненными репликами
+            max_chats (int): Максимальное число окон в памяти
+            keep_ratio (float): Доля бюджета, до которой окно сокращается
+                при переполнении
+            logger: Логгер для диагностических сообщений
+        """
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.summarizer = summarizer
+        self.max_chats = max_chats
+        self.keep_ratio = keep_ratio
+        self.logger = logger
+        self._windows = OrderedDict()
+
+    def _get_window(self, chat_id):
+        window = self._windows.get(chat_id)
+        if window is None:
+            window = ChatHistoryWindow(self.max_tokens, self.keep_ratio)
+            self._windows[chat_id] = window
+            while len(self._windows) > self.max_chats:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(chat_id)
+        return window
+
+    def sync(self, chat_id, turns):
+        """
+        Добавляет в окно чата новые завершенные реплики.
+
+        Args:
+            chat_id (int): Идентификатор чата
+            turns (list[Turn]): Реплики из хранилища диалогов
+
+        Returns:
+            str: Текст истории для промпта
+        """
+        window = self._get_window(chat_id)
+        completed = [turn for turn in turns if turn.bot_message is not None]
+
+        start = 0
+        if window.last_turn is not None:
+            for index in range(len(completed) - 1, -1, -1):
+                if completed[index] is window.last_turn:
+                    start = index + 1
+                    break
+            else:
+                # Чат был восстановлен из БД — строим окно заново
+                window.reset()
+
+        for turn in completed[start:]:
+            window.append("Клиент", turn.user_message)
+            window.append("Психолог", turn.bot_message)
+            window.last_turn = turn
+
+        if window.pending:
+            self._schedule_fold(window)
+        return window.render()
+
+    def _schedule_fold(self, window):
+        if window.fold_task is not None and not window.fold_task.done():
+            return
+        try:
+            window.fold_task = asyncio.get_running_loop().create_task(
+                self._fold(window)
+            )
+        except RuntimeError:
+            # Нет запущенного цикла событий — сворачиваем без LLM
+            self._fold_extractive(window, self._take_pending(window))
+
+    def _take_pending(self, window):
+        pending, window.pending = window.pending, []
+        return "\n".join(message.render() for message in pending)
+
+    async def _fold(self, window):
+        while window.pending:
+            text = self._take_pending(window)
+            if self.summarizer is None:
+                self._fold_extractive(window, text)
+                continue
+            try:
+                summary = await self.summarizer(window.summary, text)
+                window.summary = self._truncate(summary.strip())
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"Ошибка при свертке истории: {str(e)}")
+                self._fold_extractive(window, text)
+
+    def _fold_extractive(self, window, text):
+        summary = f"{window.summary}\n{text}" if window.summary else text
+        window.summary = self._truncate(summary, keep_tail=True)
+
+    def _truncate(self, text, keep_tail=False):
+        if count_tokens(text) <= self.summary_max_tokens:
+            return text
+        # Грубая оценка: ~4 символа на токен
+        limit = self.summary_max_tokens * 4
+        return text[-limit:] if keep_tail else text[:limit]
+
+    def stats(self):
+        """Размеры окон: число чатов и суммарное число токенов."""
+        return {
+            "chats": len(self._windows),
+            "tokens": sum(
+                window.tokens + count_tokens(window.summary)
+                for window in self._windows.values()
+            ),
+        }
@@ -1,50 +1,234 @@
-import os
-from langchain_openai import ChatOpenAI
+import re
+import json
+from collections import OrderedDict
 from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate
+from agents.history_window import count_tokens
+from llm_invoker import invoker_from_env
+from model_router import get_model_router
+import prompts
+from scheduler import NO_LIMIT, PRIORITY_BACKGROUND
+import metrics
+
+# Критерии оценки ответов психолога (шкала 0–10)
+SCORE_KEYS = ("empathy", "ethics", "technique", "clarity", "professionalism")
+
+# Коды замечаний наблюдателя
+ISSUE_CODES = {
+    "LOW_EMPATHY": "недостаток эмпатии",
+    "MISUNDERSTANDING": "непонимание запроса клиента",
+    "VAGUE": "неконкретные, общие ответы",
+    "TECHNIQUE_MISUSE": "неверное применение терапевтических техник",
+    "ETHICS": "нарушение этических норм",
+    "UNSAFE": "пропущены признаки риска для клиента",
+}
+
+# Замечания, при которых промпт корректируется независимо от оценок
+CRITICAL_ISSUES = {"ETHICS", "UNSAFE"}
+
+
+def parse_assessment(text):
+    """
+    Извлекает структурированную оценку из ответа модели.
+
+    Returns:
+        dict: {"scores": {...}, "issues": [...], "summary": str} или None,
+            если ответ не удалось разобрать
+    """
+    match = re.search(r"\{.*\}", text or "", re.DOTALL)
+    if not match:
+        return None
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return None
+
+    raw_scores = data.get("scores") or {}
+    scores = {}
+    for key in SCORE_KEYS:
+        try:
+            scores[key] = max(0.0, min(10.0, float(raw_scores[key])))
+        except (KeyError, TypeError, ValueError):
+            continue
+    if not scores:
+        return None
+
+    issues = [code for code in data.get("issues") or [] if code in ISSUE_CODES]
+    return {
+        "scores": scores,
+        "issues": issues,
+        "summary": str(data.get("summary", ""))[:500],
+    }
+
+
+def format_assessment(assessment):
+    """Описывает оценку наблюдателя текстом для корректора."""
+    lines = ["Оценки последних ответов психолога (0–10):"]
+    for key, value in assessment["scores"].items():
+        lines.append(f"- {key}: {value:g}")
+    if assessment["issues"]:
+        lines.append("Замечания:")
+        lines.extend(f"- {ISSUE_CODES[code]}" for code in assessment["issues"])
+    if assessment["summary"]:
+        lines.append(f"Контекст беседы: {assessment['summary']}")
+    return "\n".join(lines)
+
 
 class ObserverAgent:
-    def __init__(self, logger=None):
+    """
+    Супервизор ответов психолога.
+
+    Новые реплики сначала оценивает быстрая модель (скрининг). К большой
+    модели запрос уходит, только если скрининг заподозрил проблему:
+    оценка близка к порогу, есть критичное замечание или ответ не разобран.
+    """
+
+    def __init__(self, rate_limiter=None, router=None, score_threshold=6.0,
+                 escalation_margin=1.0, max_chats=10000, invoker=None, logger=None):
         self.logger = logger
-        self.llm = ChatOpenAI(
-            model="gpt-4",
-            temperature=0.3,
-            api_key=os.getenv("OPENAI_API_KEY")
+        self.rate_limiter = rate_limiter or NO_LIMIT
+        self.invoker = invoker or invoker_from_env("observer", 60.0, logger)
+        self.screen_invoker = invoker_from_env("observer_screen", 30.0, logger)
+        self.score_threshold = score_threshold
+        self.escalation_margin = escalation_margin
+        self.max_chats = max_chats
+        # Накопленная оценка по каждому чату: новые реплики оцениваются
+        # относительно нее, без повторного анализа старых
+        self._assessments = OrderedDict()
+        self._counters = {"screened": 0, "escalated": 0}
+        self.router = router or get_model_router(logger)
+        self.llm = self.router.model("observer")
+        # Скрининг не нужен, если он настроен на ту же модель
+        self.screen_llm = (
+            self.router.model("observer_screen")
+            if self.router.model_name("observer_screen") != self.router.model_name("observer")
+            else None
         )
         self.setup_chain()
+        self.setup_incremental_chain()
     
     def setup_chain(self):
-        prompt_template = """
-        Вы - опытный супервизор психологов. Ваша задача - анализировать диалоги 
-        между психологом и клиентом, выявляя возможные ошибки, неточности или 
-        области для улучшения в работе психолога.
-
-        Обратите особое внимание на:
-        1. Соблюдение этических норм
-        2. Правильность применения терапевтических техник
-        3. Эмпатию и понимание клиента
-        4. Четкость и понятность объяснений
-        5. Профессиональную грамотность
-
-        Диалог для анализа:
-        {dialogue}
-
-        Пожалуйста, проанализируйте этот диалог и укажите:
-        1. Основные сильные стороны в работе психолога
-        2. Области, требующие улучшения (если есть)
-        3. Конкретные рекомендации по улучшению работы
-        """
-        
-        prompt = PromptTemplate(
-            input_variables=["dialogue"],
-            template=prompt_template
-        )
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompts.observer_system),
+            ("human", prompts.observer_user),
+        ])
         
         self.chain = LLMChain(
             llm=self.llm,
             prompt=prompt
         )
     
+    def setup_incremental_chain(self):
+        # Критерии и коды замечаний — в системном сообщении (общий префикс
+        # всех оценок), резюме и новые реплики — в сообщении пользователя
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompts.observer_incremental_system),
+            ("human", prompts.observer_incremental_user),
+        ]).partial(issue_codes="\n".join(
+            f"{code} - {description}" for code, description in ISSUE_CODES.items()
+        ))
+
+        self.incremental_chain = LLMChain(
+            llm=self.llm,
+            prompt=prompt
+        )
+        self.screen_chain = LLMChain(
+            llm=self.screen_llm,
+            prompt=prompt
+        ) if self.screen_llm is not None else None
+
+    async def _assess(self, chain, invoker, previous_summary, new_turns):
+        """Один вызов оценки; None, если модель не ответила или ответ не разобран."""
+        try:
+            # Оценка: промпт (~350 токенов) + резюме + реплики + JSON (~120)
+            tokens = 470 + count_tokens(previous_summary) + count_tokens(new_turns)
+            async with self.rate_limiter.slot(tokens, PRIORITY_BACKGROUND), \
+                    metrics.stage("observer", route=invoker.name):
+                output = await invoker.call(
+                    lambda: chain.arun(
+                        previous_summary=previous_summary,
+                        new_turns=new_turns
+                    )
+                )
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"Ошибка в ObserverAgent ({invoker.name}): {str(e)}")
+            return None
+
+        assessment = parse_assessment(output)
+        if assessment is None and self.logger:
+            self.logger.warning(f"ObserverAgent ({invoker.name}): не удалось разобрать оценку")
+        return assessment
+
+    def is_suspicious(self, assessment):
+        """Нужна ли проверка большой моделью после скрининга."""
+        if assessment is None:
+            return True
+        if CRITICAL_ISSUES.intersection(assessment["issues"]):
+            return True
+        lowest = min(assessment["scores"].values())
+        return lowest < self.score_threshold + self.escalation_margin
+
+    async def review(self, chat_id, new_turns):
+        """
+        Оценивает только новые реплики чата с учетом накопленного резюме.
+
+        Args:
+            chat_id (int): Идентификатор чата
+            new_turns (str): Текст реплик, появившихся после прошлой оценки
+
+        Returns:
+            dict: Оценка (см. parse_assessment) или None при ошибке
+        """
+        previous = self._assessments.get(chat_id)
+        previous_summary = previous["summary"] if previous else "(начало беседы)"
+
+        assessment = None
+        if self.screen_chain is not None:
+            self._counters["screened"] += 1
+            assessment = await self._assess(
+                self.screen_chain, self.screen_invoker, previous_summary, new_turns
+            )
+            if self.is_suspicious(assessment):
+                self._counters["escalated"] += 1
+                metrics.inc("observer_escalations_total")
+                assessment = None
+        if assessment is None:
+            assessment = await self._assess(
+                self.incremental_chain, self.invoker, previous_summary, new_turns
+            )
+            if assessment is None:
+                return None
+
+        if not assessment["summary"] and previous:
+            assessment["summary"] = previous["summary"]
+        self._assessments[chat_id] = assessment
+        self._assessments.move_to_end(chat_id)
+        while len(self._assessments) > self.max_chats:
+            self._assessments.popitem(last=False)
+        return assessment
+
+    def stats(self):
+        """Сколько оценок прошло скрининг и сколько ушло к большой модели."""
+        stats = dict(self._counters)
+        stats["escalation_rate"] = (
+            self._counters["escalated"] / self._counters["screened"]
+            if self._counters["screened"] else 0.0
+        )
+        return stats
+
+    def forget(self, chat_id):
+        """Забывает накопленную оценку чата (следующая оценка — с начала беседы)."""
+        self._assessments.pop(chat_id, None)
+
+    def needs_correction(self, assessment):
+        """Нужна ли коррекция промпта: низкая оценка или критичное замечание."""
+        if assessment is None:
+            return False
+        if CRITICAL_ISSUES.intersection(assessment["issues"]):
+            return True
+        return min(assessment["scores"].values()) < self.score_threshold
+
     async def run(self, dialogue):
         """
         Анализирует диалог между психологом и клиентом.
@@ -53,14 +237,17 @@ class ObserverAgent:
             dialogue (str): Текст диалога для анализа
             
         Returns:
-            str: Результат анализа
+            str: Результат анализа или None, если модель не ответила
         """
         try:
-            return await self.chain.arun(dialogue=dialogue)
+            # Оценка: промпт (~300 токенов) + диалог + ответ (~500 токенов)
+            tokens = 800 + count_tokens(dialogue)
+            async with self.rate_limiter.slot(tokens, PRIORITY_BACKGROUND), \
+                    metrics.stage("observer"):
+                return await self.invoker.call(
+                    lambda: self.chain.arun(dialogue=dialogue)
+                )
         except Exception as e:
             if self.logger:
                 self.logger.error(f"Ошибка в ObserverAgent: {str(e)}")
-            return (
-                "Произошла ошибка при анализе диалога. "
-                f"Техническая информация: {str(e)}"
-            ) 
\ No newline at end of file
+            return None 
\ No newline at end of file
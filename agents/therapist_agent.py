@@ -1,145 +1,477 @@
 import os
-from langchain_openai import ChatOpenAI
+import time
+import asyncio
+from types import SimpleNamespace
 from langchain.agents import ZeroShotAgent, AgentExecutor, Tool
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate
 from langchain.chains import LLMChain
-from search_tool import get_search_tool
+from search_tool import get_search_tool, get_tavily_search_tool, compact_results
+from agents.history_window import HistoryWindowManager, count_tokens
+from latency import LatencyTracker
+from llm_invoker import invoker_from_env
+from model_router import get_model_router
+from search_router import get_search_router
+import prompts
+from scheduler import NO_LIMIT, PRIORITY_USER, PRIORITY_BACKGROUND
+import metrics
+
+# Оценка токенов промпта без истории и ответа — для общего лимита на LLM
+PROMPT_TOKENS_ESTIMATE = 400
+RESPONSE_TOKENS_ESTIMATE = 500
+
+# Максимум шагов цикла агента (ReAct)
+AGENT_MAX_ITERATIONS = 3
+
+# Срок до первого токена при потоковом ответе, сек
+FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "20"))
+
+# Ответы клиенту, когда модель недоступна (подробности ошибки — только в логе)
+FALLBACK_REPLY = (
+    "Извините, я сейчас не могу ответить. Пожалуйста, напишите мне еще раз "
+    "через пару минут — я обязательно продолжу наш разговор."
+)
+INTERRUPTED_REPLY = "(Ответ прервался. Пожалуйста, повторите последнее сообщение.)"
+
+# Метка конца потока в очереди фрагментов ответа
+_STREAM_END = object()
+
 
 class TherapistAgent:
-    def __init__(self, logger=None):
+    def __init__(self, conversation_store=None, rate_limiter=None, router=None,
+                 prompt_registry=None, invoker=None, search_router=None,
+                 capped_max_tokens=300, logger=None):
         self.logger = logger
-        self.llm = ChatOpenAI(
-            model="gpt-4",
-            temperature=0.7,
-            api_key=os.getenv("OPENAI_API_KEY")
-        )
+        self.conversation_store = conversation_store
+        self.prompt_registry = prompt_registry
+        self.invoker = invoker or invoker_from_env("therapist", 45.0, logger)
+        self.summary_invoker = invoker_from_env("history_summary", 60.0, logger)
+        self.rate_limiter = rate_limiter or NO_LIMIT
+        self.router = router or get_model_router(logger)
+        self.llm = self.router.model("therapist")
+        # Запасная модель, на которую переключаемся при сбоях основной
+        self.fallback_llm = self.router.model("therapist_fallback")
+        # Свертка истории — служебная задача, ей хватает быстрой модели
+        self.summary_llm = self.router.model("history_summary")
         self.tools = [get_search_tool()]
-        self.setup_agent()
+        self.search_tool = get_tavily_search_tool()
+        self.search_prefetch = os.getenv("SEARCH_PREFETCH", "1") == "1"
+        # Решение «нужен ли поиск»: основы слов и обученный классификатор
+        self.search_router = search_router or get_search_router(logger)
+        # Ограничение длины ответа при перегрузке (см. admission.py)
+        self.capped_max_tokens = capped_max_tokens
+        self.path_latency = {
+            "direct": LatencyTracker(),
+            "prefetch": LatencyTracker(),
+            "react": LatencyTracker(),
+        }
+        self.history = HistoryWindowManager(
+            max_tokens=int(os.getenv("HISTORY_MAX_TOKENS", "1500")),
+            summary_max_tokens=int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300")),
+            summarizer=self.summarize_history,
+            keep_ratio=float(os.getenv("HISTORY_KEEP_RATIO", "0.6")),
+            logger=logger
+        )
+        # Цепочки для базовых инструкций — если реестр промптов не подключен
+        self.default_chains = self.build_chains(prompts.therapist_instructions)
+        self.setup_summary_chain()
+
+    def build_chains(self, instructions):
+        """
+        Собирает цепочки ответа для одной версии инструкций психолога.
+
+        Args:
+            instructions (str): Текст инструкций (версия промпта)
+
+        Returns:
+            SimpleNamespace: reply_chain, llm_chain, agent_executor,
+                grounded_chain, grounded_reply_chain
+        """
+        chains = SimpleNamespace()
+        self.setup_agent(chains, instructions)
+        self.setup_grounded_chain(chains, instructions)
+        return chains
+
+    def chains_for(self, chat_id):
+        """Цепочки для активной версии промпта чата (из кэша реестра)."""
+        if self.prompt_registry is None:
+            return self.default_chains
+        version = self.prompt_registry.active(chat_id)
+        return self.prompt_registry.compiled(version, "therapist", self.build_chains)
+
+    async def achains_for(self, chat_id):
+        """Как `chains_for`, но версия промпта читается без блокировки цикла событий."""
+        if self.prompt_registry is None:
+            return self.default_chains
+        version = await self.prompt_registry.aactive(chat_id)
+        return self.prompt_registry.compiled(version, "therapist", self.build_chains)
         
-    def setup_agent(self):
+    def warm_up(self):
+        """
+        Готовит все, что иначе создается при первом ответе: цепочки активной
+        общей версии промпта, кодировку токенов и форматирование шаблонов.
+        """
+        chains = self.chains_for(None)
+        count_tokens(prompts.therapist_instructions)
+        chains.reply_chain.first.format_messages(
+            input="", chat_history="", agent_scratchpad=""
+        )
+        chains.grounded_reply_chain.first.format_messages(
+            input="", chat_history="", search_results=""
+        )
+        return chains
+        
+    def setup_agent(self, chains, instructions):
         tools_info = "\n".join([f"{tool.name}: {tool.description}" 
                                for tool in self.tools])
         
-        prompt_template = """
-        Вы - профессиональный психолог-консультант с обширным опытом в терапии. 
-        Ваша задача - помогать клиентам, проявляя эмпатию, задавая правильные 
-        вопросы и предлагая подходящие методики.
-        
-        У вас есть доступ к следующим инструментам:
-        {tools}
-        
-        Используйте инструмент поиска только когда клиент явно запрашивает 
-        фактическую информацию, упоминает исследования, методики, статьи, 
-        научные факты или когда вам нужно проверить конкретную информацию 
-        перед ответом. В остальных случаях отвечайте на основе своих знаний 
-        и опыта как терапевт.
-        
-        Формат взаимодействия:
-        Вопрос: вопрос клиента
-        Мысли: размышления о том, как лучше всего ответить или какой инструмент 
-               использовать
-        Действие: имя используемого инструмента
-        Данные действия: информация, полученная от инструмента
-        Наблюдение: результат использования инструмента
-        Ответ: ваш окончательный ответ клиенту
-        
-        История беседы:
-        {chat_history}
-        
-        Начнем!
-        Вопрос: {input}
-        {agent_scratchpad}
-        """
-        
-        prompt = PromptTemplate(
-            input_variables=["input", "chat_history", "agent_scratchpad", "tools"],
-            template=prompt_template
-        )
+        # Неизменная часть — системное сообщение, реплика и история — после нее
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompts.therapist_react_system),
+            ("human", prompts.therapist_react_user),
+        ]).partial(tools=tools_info, instructions=instructions)
         
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
+        # Та же цепочка в виде Runnable — для потоковой генерации ответа
+        chains.reply_chain = prompt | self.llm
+        chains.fallback_chain = (
+            prompt | self.fallback_llm if self.fallback_llm is not None else None
         )
-        
-        llm_chain = LLMChain(
+        # Короткие ответы при перегрузке: поиск тогда отключен, поэтому
+        # ограничение нужно только прямому ответу
+        chains.capped_reply_chain = prompt | self.llm.bind(max_tokens=self.capped_max_tokens)
+
+        # История передается в промпт явно из окна HistoryWindowManager,
+        # поэтому отдельная память LangChain агенту не нужна
+        chains.llm_chain = LLMChain(
             llm=self.llm,
             prompt=prompt
         )
+        chains.capped_llm_chain = LLMChain(
+            llm=self.llm,
+            prompt=prompt,
+            llm_kwargs={"max_tokens": self.capped_max_tokens}
+        )
         
         agent = ZeroShotAgent(
-            llm_chain=llm_chain,
+            llm_chain=chains.llm_chain,
             tools=self.tools,
             verbose=True
         )
         
-        self.agent_executor = AgentExecutor.from_agent_and_tools(
+        chains.agent_executor = AgentExecutor.from_agent_and_tools(
             agent=agent,
             tools=self.tools,
-            memory=self.memory,
             verbose=True,
             handle_parsing_errors=True,
-            max_iterations=3
+            max_iterations=AGENT_MAX_ITERATIONS
+        )
+
+    def setup_grounded_chain(self, chains, instructions):
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompts.therapist_grounded_system),
+            ("human", prompts.therapist_grounded_user),
+        ]).partial(instructions=instructions)
+
+        chains.grounded_chain = LLMChain(
+            llm=self.llm,
+            prompt=prompt
+        )
+        chains.grounded_reply_chain = prompt | self.llm
+
+    def setup_summary_chain(self):
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompts.history_summary_system),
+            ("human", prompts.history_summary_user),
+        ])
+
+        self.summary_chain = LLMChain(
+            llm=self.summary_llm,
+            prompt=prompt
         )
+
+    async def summarize_history(self, summary, new_lines):
+        """Сворачивает вытесненные из окна реплики в краткое содержание."""
+        tokens = 300 + count_tokens(summary) + count_tokens(new_lines)
+        async with self.rate_limiter.slot(tokens, PRIORITY_BACKGROUND), \
+                metrics.stage("history_summary"):
+            return await self.summary_invoker.call(
+                lambda: self.summary_chain.arun(
+                    summary=summary or "(пусто)",
+                    new_lines=new_lines
+                )
+            )
     
     def should_use_search(self, user_message):
         """
         Определяет, нужно ли использовать поиск в интернете для текущего сообщения.
         """
-        search_keywords = [
-            "статья", "исследование", "факт", "методика", "метод", 
-            "техника", "что говорит наука", "научно доказано", 
-            "исследования показывают", "согласно исследованиям",
-            "ссылка", "источник", "проверь"
-        ]
-        
-        return any(keyword in user_message.lower() for keyword in search_keywords)
+        return self.search_router.should_search(user_message)
     
-    async def generate_response(self, user_message, dialog_history=None):
+    def get_history(self, chat_id):
+        """
+        Возвращает завершенные реплики чата из хранилища диалогов.
+
+        Текущее сообщение клиента (еще без ответа) в историю не входит —
+        оно передается в промпт отдельно.
+        """
+        if self.conversation_store is None or chat_id is None:
+            return []
+        turns = self.conversation_store.recent(chat_id)
+        if turns and turns[-1].bot_message is None:
+            turns = turns[:-1]
+        return turns
+
+    async def _prefetch_search(self, user_message):
+        """Выполняет поиск и возвращает сжатые результаты (или None)."""
+        with metrics.stage("search"):
+            results = await self.search_tool.afetch_results(user_message)
+        return compact_results(user_message, results) if results else None
+
+    async def prepare_response(self, user_message, chat_id=None, allow_search=True):
+        """
+        Готовит контекст ответа и выбирает путь генерации.
+
+        Если поиск вероятно понадобится, запрос к Tavily запускается первым,
+        до чтения версии промпта и подготовки истории, а ответ затем
+        строится одним вызовом LLM с найденными материалами. Если поиск
+        ничего не дал, ответ строится без поиска: цикл агента (ReAct)
+        получил бы тот же пустой результат из кэша. Цикл агента остается
+        только для режима без предварительного поиска.
+
+        Args:
+            user_message (str): Сообщение клиента
+            chat_id (int): Идентификатор чата
+            allow_search (bool): False — отвечать без поиска (перегрузка)
+
+        Returns:
+            tuple: (цепочки версии промпта чата, путь "direct"/"prefetch"/"react",
+                история, результаты поиска)
+        """
+        use_search = allow_search and self.should_use_search(user_message)
+        search_task = None
+        if use_search and self.search_prefetch:
+            search_task = asyncio.create_task(self._prefetch_search(user_message))
+
         try:
-            if dialog_history is None:
-                dialog_history = []
-                
-            if dialog_history:
-                for entry in dialog_history[-5:]:
-                    if 'user_message' in entry and entry['user_message']:
-                        self.memory.chat_memory.add_user_message(
-                            entry['user_message']
-                        )
-                    if 'bot_message' in entry and entry['bot_message']:
-                        self.memory.chat_memory.add_ai_message(
-                            entry['bot_message']
+            chains = await self.achains_for(chat_id)
+            chat_history = self.history.sync(chat_id, self.get_history(chat_id))
+        except BaseException:
+            if search_task is not None:
+                search_task.cancel()
+            raise
+
+        if use_search and search_task is None:
+            return chains, "react", chat_history, None
+        if search_task is None:
+            return chains, "direct", chat_history, None
+
+        try:
+            search_results = await search_task
+        except Exception as e:
+            search_results = None
+            if self.logger:
+                self.logger.warning(f"Предварительный поиск не удался: {str(e)}")
+
+        if search_results:
+            return chains, "prefetch", chat_history, search_results
+        return chains, "direct", chat_history, None
+
+    def _llm_slot(self, path, user_message, chat_history, search_results, capped=False):
+        """Слот общего лимита LLM для ответа пользователю."""
+        response_tokens = self.capped_max_tokens if capped else RESPONSE_TOKENS_ESTIMATE
+        tokens = (
+            PROMPT_TOKENS_ESTIMATE + response_tokens +
+            count_tokens(user_message) + count_tokens(chat_history) +
+            count_tokens(search_results)
+        )
+        # Цикл агента может сделать до max_iterations обращений к API
+        requests = AGENT_MAX_ITERATIONS if path == "react" else 1
+        return self.rate_limiter.slot(tokens * requests, PRIORITY_USER, requests)
+
+    async def _fallback_reply(self, chains, user_message, chat_history):
+        """
+        Ответ запасной модели без поиска, а если и она недоступна — заготовка.
+
+        Вызывается уже после выхода из слота основной модели: запасная
+        модель занимает свой слот общего лимита, а вложенный слот при
+        занятом лимите ждал бы сам себя.
+        """
+        self.invoker.record_fallback()
+        if chains is not None and chains.fallback_chain is not None:
+            try:
+                async with self._llm_slot("direct", user_message, chat_history, None):
+                    message = await asyncio.wait_for(
+                        chains.fallback_chain.ainvoke({
+                            "input": user_message,
+                            "chat_history": chat_history,
+                            "agent_scratchpad": ""
+                        }),
+                        self.invoker.deadline
+                    )
+                return message.content
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"Запасная модель не ответила: {str(e)}")
+        return FALLBACK_REPLY
+
+    def _record_path(self, path, started):
+        elapsed = time.perf_counter() - started
+        self.path_latency[path].observe(elapsed)
+        metrics.observe_stage("therapist_reply", elapsed, path=path)
+        if self.logger:
+            self.logger.info(f"TherapistAgent: путь {path}, {elapsed:.2f} с")
+
+    def path_stats(self):
+        """Задержка ответа по каждому пути генерации."""
+        return {path: tracker.stats() for path, tracker in self.path_latency.items()}
+
+    async def _pump_stream(self, chain, inputs, path, slot, chunks):
+        """
+        Читает поток модели в очередь `chunks`, занимая слот общего лимита.
+
+        Слот освобождается, как только модель закончила ответ, а не когда
+        получатель дошлет текст в Telegram (правки сообщения, паузы
+        TelegramRetryAfter), — иначе загрузка лимита и ступень допуска
+        росли бы из-за Telegram. В конце в очередь кладется _STREAM_END
+        или исключение.
+        """
+        try:
+            async with slot:
+                llm_started = time.perf_counter()
+                first = True
+                async for chunk in self.invoker.stream(
+                    lambda: chain.astream(inputs),
+                    first_token_timeout=FIRST_TOKEN_TIMEOUT
+                ):
+                    if chunk.content:
+                        if first:
+                            metrics.observe_stage(
+                                "therapist_first_token",
+                                time.perf_counter() - llm_started,
+                                path=path
+                            )
+                            first = False
+                        chunks.put_nowait(chunk.content)
+                metrics.observe_stage(
+                    "therapist_llm", time.perf_counter() - llm_started, path=path
+                )
+            chunks.put_nowait(_STREAM_END)
+        except Exception as e:
+            chunks.put_nowait(e)
+
+    async def stream_response(self, user_message, chat_id=None, allow_search=True,
+                              capped=False):
+        """
+        Генерирует ответ психолога, отдавая текст по мере поступления токенов.
+
+        Args:
+            user_message (str): Сообщение клиента
+            chat_id (int): Идентификатор чата
+            allow_search (bool): False — отвечать без поиска (перегрузка)
+            capped (bool): Ограничить длину ответа capped_max_tokens
+
+        Yields:
+            str: Очередной фрагмент ответа
+        """
+        emitted = False
+        chains = None
+        chat_history = ""
+        try:
+            started = time.perf_counter()
+            chains, path, chat_history, search_results = await self.prepare_response(
+                user_message, chat_id, allow_search
+            )
+            if path == "react":
+                # Цикл агента с поиском не стримится — отдаем ответ целиком
+                async with self._llm_slot(path, user_message, chat_history, None):
+                    with metrics.stage("therapist_llm", path=path):
+                        # Сбой (LLMUnavailable) уходит в except ниже — запасной
+                        # ответ строится уже вне слота
+                        response = await self.invoker.call(
+                            lambda: chains.agent_executor.arun(
+                                input=user_message,
+                                chat_history=chat_history
+                            )
                         )
-            
-            use_search = self.should_use_search(user_message)
-            
-            if use_search:
-                response = await self.agent_executor.arun(input=user_message)
+                yield response
+                self._record_path(path, started)
+                return
+
+            if path == "prefetch":
+                chain = chains.grounded_reply_chain
+                inputs = {
+                    "input": user_message,
+                    "chat_history": chat_history,
+                    "search_results": search_results
+                }
             else:
-                response = await self.llm_chain.arun(
+                chain = chains.capped_reply_chain if capped else chains.reply_chain
+                inputs = {
+                    "input": user_message,
+                    "chat_history": chat_history,
+                    "agent_scratchpad": ""
+                }
+
+            chunks = asyncio.Queue()
+            slot = self._llm_slot(path, user_message, chat_history, search_results, capped)
+            pump = asyncio.create_task(self._pump_stream(chain, inputs, path, slot, chunks))
+            try:
+                while True:
+                    item = await chunks.get()
+                    if item is _STREAM_END:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    emitted = True
+                    yield item
+            finally:
+                if not pump.done():
+                    pump.cancel()
+            self._record_path(path, started)
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"Ошибка в TherapistAgent: {str(e)}")
+            if emitted:
+                yield "\n\n" + INTERRUPTED_REPLY
+            else:
+                yield await self._fallback_reply(chains, user_message, chat_history)
+
+    async def generate_response(self, user_message, chat_id=None, allow_search=True,
+                                capped=False):
+        chains = None
+        chat_history = ""
+        try:
+            started = time.perf_counter()
+            chains, path, chat_history, search_results = await self.prepare_response(
+                user_message, chat_id, allow_search
+            )
+
+            if path == "prefetch":
+                request = lambda: chains.grounded_chain.arun(
                     input=user_message,
-                    chat_history=self.format_history(dialog_history)
+                    chat_history=chat_history,
+                    search_results=search_results
                 )
+            elif path == "react":
+                request = lambda: chains.agent_executor.arun(
+                    input=user_message,
+                    chat_history=chat_history
+                )
+            else:
+                llm_chain = chains.capped_llm_chain if capped else chains.llm_chain
+                request = lambda: llm_chain.arun(
+                    input=user_message,
+                    chat_history=chat_history,
+                    agent_scratchpad=""
+                )
+            
+            async with self._llm_slot(path, user_message, chat_history, search_results,
+                                      capped), \
+                    metrics.stage("therapist_llm", path=path):
+                response = await self.invoker.call(request)
                 
+            self._record_path(path, started)
             return response
         except Exception as e:
             if self.logger:
                 self.logger.error(f"Ошибка в TherapistAgent: {str(e)}")
-            return (
-                "Извините, произошла ошибка при обработке вашего запроса. "
-                f"Пожалуйста, попробуйте еще раз. Техническая информация: {str(e)}"
-            )
-    
-    def format_history(self, dialog_history):
-        """Форматирует историю диалога для использования в промпте."""
-        if not dialog_history:
-            return ""
-        
-        formatted = []
-        for entry in dialog_history[-5:]:  # Берем последние 5 сообщений
-            if 'user_message' in entry:
-                formatted.append(f"Клиент: {entry['user_message']}")
-            if 'bot_message' in entry:
-                formatted.append(f"Психолог: {entry['bot_message']}")
-        
-        return "\n".join(formatted) 
\ No newline at end of file
+            return await self._fallback_reply(chains, user_message, chat_history)
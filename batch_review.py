@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import db
+from scheduler import LLMRateLimiter
+
+load_dotenv()
+
+logger = logging.getLogger("batch_review")
+
+# Сколько идентификаторов чатов читается из базы за один запрос
+_CHAT_PAGE = 500
+
+
+def conversation_windows(rows, window_turns):
+    """
+    Разбивает переписку на окна так же, как их получает живой наблюдатель.
+
+    В боте каждая пара «клиент — психолог» уходит на супервизию строкой
+    "Клиент: ...\\nПсихолог: ...", а пары, пришедшие до обработки задания,
+    склеиваются через перевод строки. Здесь склеивается по `window_turns` пар.
+
+    Args:
+        rows: Строки (id, message, role) одного чата по времени
+        window_turns (int): Сколько пар реплик в одном окне
+
+    Returns:
+        list[tuple]: (первый id, последний id, текст окна)
+    """
+    turns = []
+    pending = None
+    for row_id, message, role in rows:
+        if role == "user":
+            # Сообщение без ответа (например, бот упал) заменяется следующим
+            pending = (row_id, message)
+        elif role == "bot" and pending is not None:
+            turns.append((pending[0], row_id, f"Клиент: {pending[1]}\nПсихолог: {message}"))
+            pending = None
+
+    windows = []
+    for i in range(0, len(turns), window_turns):
+        chunk = turns[i:i + window_turns]
+        windows.append((chunk[0][0], chunk[-1][1], "\n".join(text for _, _, text in chunk)))
+    return windows
+
+
+class ResultStore:
+    """
+    Таблицы пакетной супервизии в базе диалогов.
+
+    supervision_runs — запуски, supervision_results — оценка каждого окна,
+    supervision_progress — чаты, полностью обработанные в запуске
+    (по ним запуск продолжается после прерывания).
+    """
+
+    def __init__(self, path=db.DB_PATH):
+        self._conn = db.connect(path)
+        self._lock = threading.Lock()
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS supervision_runs (
+            run_id TEXT PRIMARY KEY,
+            started_at TEXT,
+            finished_at TEXT,
+            config TEXT
+        );
+        CREATE TABLE IF NOT EXISTS supervision_results (
+            run_id TEXT,
+            user_id INTEGER,
+            window_index INTEGER,
+            first_dialog_id INTEGER,
+            last_dialog_id INTEGER,
+            scores TEXT,
+            min_score REAL,
+            issues TEXT,
+            needs_correction INTEGER,
+            summary TEXT,
+            created_at TEXT,
+            PRIMARY KEY (run_id, user_id, window_index)
+        );
+        CREATE INDEX IF NOT EXISTS idx_supervision_results_score
+            ON supervision_results (run_id, min_score);
+        CREATE TABLE IF NOT EXISTS supervision_progress (
+            run_id TEXT,
+            user_id INTEGER,
+            windows INTEGER,
+            failed INTEGER,
+            finished_at TEXT,
+            PRIMARY KEY (run_id, user_id)
+        );
+        """)
+
+    def start_run(self, run_id, config):
+        """Регистрирует запуск (или продолжение) и возвращает уже обработанные чаты."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO supervision_runs (run_id, started_at, config) "
+                "VALUES (?, ?, ?)",
+                (run_id, datetime.now().isoformat(), json.dumps(config, ensure_ascii=False))
+            )
+            rows = self._conn.execute(
+                "SELECT user_id FROM supervision_progress WHERE run_id = ? AND failed = 0",
+                (run_id,)
+            ).fetchall()
+        return {user_id for user_id, in rows}
+
+    def chat_ids(self, after=None, limit=_CHAT_PAGE):
+        """Следующая страница идентификаторов чатов (по индексу user_id)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT user_id FROM dialogs "
+                + ("WHERE user_id > ? " if after is not None else "")
+                + "ORDER BY user_id LIMIT ?",
+                ((after, limit) if after is not None else (limit,))
+            ).fetchall()
+        return [user_id for user_id, in rows]
+
+    def conversation(self, user_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, message, role FROM dialogs WHERE user_id = ? "
+                "ORDER BY timestamp, id",
+                (user_id,)
+            ).fetchall()
+
+    def save(self, run_id, user_id, results, failed):
+        """Оценки окон чата и отметка о его обработке — одной транзакцией."""
+        now = datetime.now().isoformat()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO supervision_results (run_id, user_id, window_index, "
+                "first_dialog_id, last_dialog_id, scores, min_score, issues, "
+                "needs_correction, summary, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (run_id, user_id, window, first_id, last_id,
+                     json.dumps(assessment["scores"]), min(assessment["scores"].values()),
+                     json.dumps(assessment["issues"]), int(needs_correction),
+                     assessment["summary"], now)
+                    for window, first_id, last_id, assessment, needs_correction in results
+                ]
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO supervision_progress "
+                "(run_id, user_id, windows, failed, finished_at) VALUES (?, ?, ?, ?, ?)",
+                (run_id, user_id, len(results) + failed, failed, now)
+            )
+
+    def finish_run(self, run_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE supervision_runs SET finished_at = ? WHERE run_id = ?",
+                (datetime.now().isoformat(), run_id)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BatchReviewer:
+    """
+    Пакетная супервизия сохраненных диалогов.
+
+    Чаты читаются из базы по одному и раздаются `workers` обработчикам
+    через ограниченную очередь — в памяти не больше нескольких переписок
+    одновременно. Окна одного чата оцениваются по порядку (наблюдатель
+    переносит резюме беседы от окна к окну), разные чаты — параллельно
+    в пределах лимита OpenAI.
+    """
+
+    def __init__(self, observer, store, workers=16, window_turns=1, logger=None):
+        """
+        Args:
+            observer (ObserverAgent): Наблюдатель (с общим лимитом OpenAI)
+            store (ResultStore): Хранилище диалогов и результатов
+            workers (int): Число чатов, обрабатываемых одновременно
+            window_turns (int): Сколько пар реплик в одном окне
+            logger: Логгер для диагностических сообщений
+        """
+        self.observer = observer
+        self.store = store
+        self.workers = workers
+        self.window_turns = window_turns
+        self.logger = logger
+        self._counters = {
+            "chats": 0,
+            "skipped": 0,
+            "windows": 0,
+            "failed_windows": 0,
+            "needs_correction": 0,
+        }
+
+    async def _produce(self, queue, done, limit):
+        after = None
+        queued = 0
+        while limit is None or queued < limit:
+            chat_ids = await asyncio.to_thread(self.store.chat_ids, after)
+            if not chat_ids:
+                break
+            after = chat_ids[-1]
+            for user_id in chat_ids:
+                if user_id in done:
+                    self._counters["skipped"] += 1
+                    continue
+                await queue.put(user_id)
+                queued += 1
+                if limit is not None and queued >= limit:
+                    break
+
+    async def _review_chat(self, run_id, user_id):
+        rows = await asyncio.to_thread(self.store.conversation, user_id)
+        windows = conversation_windows(rows, self.window_turns)
+        # Оценка начинается с начала беседы, без резюме из прошлых запусков
+        self.observer.forget(user_id)
+        results = []
+        failed = 0
+        for index, (first_id, last_id, text) in enumerate(windows):
+            assessment = await self.observer.review(user_id, text)
+            if assessment is None:
+                failed += 1
+                continue
+            needs_correction = self.observer.needs_correction(assessment)
+            results.append((index, first_id, last_id, assessment, needs_correction))
+            self._counters["needs_correction"] += int(needs_correction)
+        self.observer.forget(user_id)
+        await asyncio.to_thread(self.store.save, run_id, user_id, results, failed)
+        self._counters["chats"] += 1
+        self._counters["windows"] += len(results)
+        self._counters["failed_windows"] += failed
+
+    async def _worker(self, queue, run_id):
+        while True:
+            user_id = await queue.get()
+            try:
+                await self._review_chat(run_id, user_id)
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"Чат {user_id}: супервизия не удалась: {str(e)}")
+            finally:
+                queue.task_done()
+
+    async def run(self, run_id, config=None, limit=None, progress_interval=30.0):
+        """
+        Выполняет (или продолжает) запуск.
+
+        Args:
+            run_id (str): Идентификатор запуска; повторный запуск с тем же
+                идентификатором пропускает уже обработанные чаты
+            config (dict): Параметры запуска для таблицы supervision_runs
+            limit (int): Максимум чатов за этот вызов
+
+        Returns:
+            dict: Счетчики запуска
+        """
+        started = time.perf_counter()
+        done = await asyncio.to_thread(self.store.start_run, run_id, config or {})
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue, run_id)) for _ in range(self.workers)]
+        progress = asyncio.create_task(self._report_progress(started, progress_interval))
+        try:
+            await self._produce(queue, done, limit)
+            await queue.join()
+        finally:
+            progress.cancel()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, progress, return_exceptions=True)
+        await asyncio.to_thread(self.store.finish_run, run_id)
+        return self.stats(time.perf_counter() - started)
+
+    async def _report_progress(self, started, interval):
+        while True:
+            await asyncio.sleep(interval)
+            if self.logger:
+                self.logger.info(
+                    f"Обработано чатов: {self._counters['chats']}, окон: "
+                    f"{self._counters['windows']} за {time.perf_counter() - started:.0f} с"
+                )
+
+    def stats(self, elapsed=None):
+        stats = dict(self._counters)
+        if elapsed is not None:
+            stats["seconds"] = elapsed
+            stats["chats_per_sec"] = stats["chats"] / elapsed if elapsed else 0.0
+        return stats
+
+
+def build_observer(rate_limiter, llm=None):
+    """Наблюдатель с маршрутами моделей как в боте (llm — фейковая модель)."""
+    from agents.observer_agent import ObserverAgent
+    from model_router import ModelRouter
+
+    router = ModelRouter(
+        llm=llm,
+        max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+        logger=logger
+    )
+    observer = ObserverAgent(
+        rate_limiter=rate_limiter,
+        router=router,
+        score_threshold=float(os.getenv("OBSERVER_SCORE_THRESHOLD", "6")),
+        logger=logger
+    )
+    return observer, router
+
+
+async def run(args):
+    llm = None
+    if args.fake_llm:
+        from bench.fakes import FakeChatModel
+        llm = FakeChatModel(latency=args.llm_latency, seed=args.seed)
+
+    rate_limiter = LLMRateLimiter(
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_concurrency=args.workers
+    )
+    observer, router = build_observer(rate_limiter, llm)
+    store = ResultStore(args.db)
+    reviewer = BatchReviewer(
+        observer, store, workers=args.workers, window_turns=args.window, logger=logger
+    )
+    config = {
+        "workers": args.workers,
+        "window_turns": args.window,
+        "models": {
+            route: router.model_name(route) for route in ("observer_screen", "observer")
+        },
+        "fake_llm": args.fake_llm,
+    }
+    try:
+        stats = await reviewer.run(args.run_id, config, limit=args.limit)
+    finally:
+        store.close()
+        await router.close()
+    return {
+        "run_id": args.run_id,
+        "review": stats,
+        "observer": observer.stats(),
+        "llm_routes": router.stats(),
+        "rate_limiter": rate_limiter.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Пакетная супервизия сохраненных диалогов наблюдателем"
+    )
+    parser.add_argument("--db", default=db.DB_PATH, help="файл базы диалогов")
+    parser.add_argument("--run-id", help="продолжить запуск с этим идентификатором")
+    parser.add_argument("--workers", type=int,
+                        default=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")))
+    parser.add_argument("--window", type=int, default=1, help="пар реплик в окне")
+    parser.add_argument("--limit", type=int, help="максимум чатов за запуск")
+    parser.add_argument("--rpm", type=int, default=int(os.getenv("OPENAI_RPM", "500")))
+    parser.add_argument("--tpm", type=int, default=int(os.getenv("OPENAI_TPM", "80000")))
+    parser.add_argument("--fake-llm", action="store_true",
+                        help="фейковая модель из bench.fakes вместо OpenAI")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.run_id is None:
+        args.run_id = datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    logger.info(f"Запуск {args.run_id}")
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+import time
+import random
+import asyncio
+import hashlib
+import itertools
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Any, List, Optional
+
+import httpx
+import openai
+from aiohttp import web
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from agents.history_window import _get_encoding
+
+THERAPIST_REPLIES = [
+    "Я слышу, как вам сейчас непросто. Расскажите, пожалуйста, когда вы впервые "
+    "заметили это чувство и что обычно ему предшествует?",
+    "Спасибо, что делитесь этим. Давайте попробуем простое упражнение: сделайте "
+    "медленный вдох на четыре счета, задержите дыхание и выдохните на шесть счетов.",
+    "Похоже, вы много требуете от себя. Как бы вы поддержали близкого друга "
+    "в такой же ситуации? Попробуйте сказать себе то же самое.",
+]
+
+OBSERVER_REPLIES = [
+    '{"scores": {"empathy": 8, "ethics": 9, "technique": 7, "clarity": 8, '
+    '"professionalism": 8}, "issues": [], "summary": "Клиент описывает тревогу, '
+    'психолог поддерживает и задает открытые вопросы."}',
+    '{"scores": {"empathy": 7, "ethics": 9, "technique": 6, "clarity": 5, '
+    '"professionalism": 7}, "issues": ["VAGUE"], "summary": "Клиент описывает '
+    'стресс, ответы психолога слишком общие."}',
+]
+
+
+def _stable_index(text, seed, size):
+    digest = hashlib.md5(f"{seed}:{text}".encode("utf-8")).digest()
+    return digest[0] % size
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Детерминированная модель чата с настраиваемой задержкой и стримингом.
+
+    Ответ выбирается по содержанию промпта: супервизия, коррекция промпта,
+    свертка истории или ответ психолога. Задержка складывается из времени
+    до первого токена и скорости генерации.
+    """
+
+    latency: float = 0.3
+    tokens_per_second: float = 100.0
+    seed: int = 0
+    failure_rate: float = 0.0
+    calls: int = 0
+    failures: int = 0
+    # Кэш промптов как у OpenAI: общий префикс от 1024 токенов, шаг 128
+    cache_min_tokens: int = 1024
+    _prefixes: set = PrivateAttr(default_factory=set)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self, messages, stop=None, max_tokens=None) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+        if "супервизор" in prompt:
+            text = OBSERVER_REPLIES[_stable_index(prompt, self.seed, len(OBSERVER_REPLIES))]
+        elif "улучшению промптов" in prompt:
+            text = (
+                "Вы - профессиональный психолог-консультант. Проявляйте эмпатию, "
+                "отражайте чувства клиента и предлагайте конкретные шаги."
+            )
+        elif "краткое содержание" in prompt:
+            text = "Клиент описывает тревогу и усталость, обсуждались дыхательные упражнения."
+        else:
+            text = THERAPIST_REPLIES[_stable_index(prompt, self.seed, len(THERAPIST_REPLIES))]
+        if max_tokens:
+            # Ограничение длины ответа (слово ~ токен ответа, как в _usage)
+            text = " ".join(text.split()[:max_tokens])
+        if stop:
+            # Вызов из AgentExecutor: ответ в формате, который понимает парсер агента
+            text = f"Final Answer: {text}"
+        return text
+
+    def _maybe_fail(self):
+        # Имитация сбоя соединения с OpenAI (повторяемая ошибка)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failures += 1
+            raise openai.APIConnectionError(
+                request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+            )
+
+    def _prompt_tokens(self, messages):
+        # Токены считаются так же, как в окне истории: tiktoken, а без него —
+        # по 4 символа на токен, чтобы порог кэша сравнивался с тем же числом
+        prompt = "\n".join(str(message.content) for message in messages)
+        encoding = _get_encoding()
+        if encoding is not None:
+            return [str(token) for token in encoding.encode(prompt)]
+        return [prompt[i:i + 4] for i in range(0, len(prompt), 4)]
+
+    def _cached_tokens(self, tokens):
+        cached = 0
+        prefix = hashlib.md5()
+        for start in range(0, len(tokens) - 127, 128):
+            prefix.update("\x00".join(tokens[start:start + 128]).encode("utf-8"))
+            end = start + 128
+            if end < self.cache_min_tokens:
+                continue
+            key = prefix.copy().digest()
+            if key in self._prefixes:
+                cached = end
+            else:
+                self._prefixes.add(key)
+        return cached
+
+    def _usage(self, messages, text):
+        tokens = self._prompt_tokens(messages)
+        prompt_tokens = len(tokens)
+        completion_tokens = len(text.split())
+        return {
+            "input_tokens": prompt_tokens,
+            "output_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "input_token_details": {"cache_read": self._cached_tokens(tokens)},
+        }
+
+    def _result(self, messages, text):
+        usage = self._usage(messages, text)
+        message = AIMessage(content=text, usage_metadata=usage)
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={"token_usage": {
+                "prompt_tokens": usage["input_tokens"],
+                "completion_tokens": usage["output_tokens"],
+                "total_tokens": usage["total_tokens"],
+                "prompt_tokens_details": {
+                    "cached_tokens": usage["input_token_details"]["cache_read"]
+                },
+            }}
+        )
+
+    def _duration(self, text):
+        return self.latency + len(text.split()) / self.tokens_per_second
+
+    def _generate(self, messages, stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        self.calls += 1
+        self._maybe_fail()
+        text = self._reply(messages, stop, kwargs.get("max_tokens"))
+        time.sleep(self._duration(text))
+        return self._result(messages, text)
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        self._maybe_fail()
+        text = self._reply(messages, stop, kwargs.get("max_tokens"))
+        await asyncio.sleep(self._duration(text) - self.latency)
+        return self._result(messages, text)
+
+    async def _astream(self, messages, stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any):
+        self.calls += 1
+        text = self._reply(messages, stop, kwargs.get("max_tokens"))
+        await asyncio.sleep(self.latency)
+        self._maybe_fail()
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            token = word if i == len(words) - 1 else word + " "
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(1 / self.tokens_per_second)
+        usage = self._usage(messages, text)
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+
+class FakeTavilyServer:
+    """Локальная HTTP-заглушка Tavily Search API (POST /search)."""
+
+    def __init__(self, latency=0.2, results=3, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.results = results
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def _handle_search(self, request):
+        payload = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        query = payload.get("query", "")
+        results = [
+            {
+                "title": f"Материал {i + 1}: {query[:40]}",
+                "content": (
+                    f"Обзор по теме «{query}». Когнитивно-поведенческая терапия и "
+                    "дыхательные упражнения помогают снизить тревожность. " * 3
+                ),
+                "url": f"https://example.org/{i + 1}",
+            }
+            for i in range(min(self.results, payload.get("max_results", 5)))
+        ]
+        return web.json_response({"query": query, "results": results})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/search", self._handle_search)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # При port=0 система выбирает свободный порт
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeBot:
+    """
+    Заглушка aiogram.Bot: принимает send_message/edit_message_text
+    и записывает события с отметками времени.
+    """
+
+    id = 123456
+
+    def __init__(self, latency=0.03):
+        self.latency = latency
+        self.events = defaultdict(list)
+        self._message_ids = itertools.count(1)
+
+    async def __call__(self, method, request_timeout=None):
+        # Вызовы вида message.answer(...) приходят объектами методов aiogram
+        if type(method).__name__ == "EditMessageText":
+            return await self.edit_message_text(
+                method.text, chat_id=method.chat_id, message_id=method.message_id
+            )
+        return await self.send_message(method.chat_id, method.text)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        message_id = next(self._message_ids)
+        self.events[chat_id].append((time.perf_counter(), "send", text))
+        return SimpleNamespace(message_id=message_id, chat=SimpleNamespace(id=chat_id))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.events[chat_id].append((time.perf_counter(), "edit", text))
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.events[chat_id].append((time.perf_counter(), "delete", message_id))
+        return True
+
+    def first_text_after(self, chat_id, since, placeholder):
+        """Время первого видимого текста ответа в чате после момента `since`."""
+        for timestamp, kind, text in self.events[chat_id]:
+            if timestamp >= since and kind != "delete" and text != placeholder:
+                return timestamp
+        return None
+
+
+class FakeMessage:
+    """Минимальная замена aiogram.types.Message для обработчиков бота."""
+
+    def __init__(self, bot, chat_id, text):
+        self.bot = bot
+        self.chat = SimpleNamespace(id=chat_id)
+        self.text = text
+
+    async def answer(self, text, **kwargs):
+        return await self.bot.send_message(self.chat.id, text)
+
+
+CLIENT_MESSAGES = [
+    "Мне очень тревожно последние недели, плохо сплю.",
+    "На работе постоянный стресс, я не справляюсь.",
+    "Какая методика помогает при панических атаках?",
+    "Иногда кажется, что меня никто не понимает.",
+    "Что говорит наука о дыхательных упражнениях?",
+    "Я устал и ничего не хочется делать.",
+    "Поссорился с близким человеком и не знаю, как помириться.",
+    "Есть ли исследования про эффективность КПТ?",
+]
+
+
+def _client_text(chat_index, i, seed):
+    return CLIENT_MESSAGES[(chat_index * 7 + i + seed) % len(CLIENT_MESSAGES)]
+
+
+def synthetic_webhook_updates(chats, messages_per_chat, seed=0):
+    """
+    Синтетические JSON-обновления Telegram для POST на вебхук.
+
+    Returns:
+        dict: chat_id -> list[dict]
+    """
+    update_ids = itertools.count(1)
+    updates = {}
+    for chat_index in range(chats):
+        chat_id = 100000 + chat_index
+        updates[chat_id] = []
+        for i in range(messages_per_chat):
+            update_id = next(update_ids)
+            updates[chat_id].append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                    "text": _client_text(chat_index, i, seed),
+                },
+            })
+    return updates
+
+
+def synthetic_updates(bot, chats, messages_per_chat, seed=0):
+    """
+    Источник синтетических обновлений: для каждого чата — список сообщений.
+
+    Returns:
+        dict: chat_id -> list[FakeMessage]
+    """
+    updates = {}
+    for chat_index in range(chats):
+        chat_id = 100000 + chat_index
+        updates[chat_id] = [
+            FakeMessage(bot, chat_id, _client_text(chat_index, i, seed))
+            for i in range(messages_per_chat)
+        ]
+    return updates
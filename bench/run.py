@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+
+from bench.fakes import FakeBot, FakeChatModel, FakeTavilyServer, synthetic_updates
+
+
+def percentiles(samples):
+    """p50/p95/p99, среднее и максимум по списку значений (в секундах)."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        position = q / 100 * (len(ordered) - 1)
+        low = int(position)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": pick(50),
+        "p95": pick(95),
+        "p99": pick(99),
+        "max": ordered[-1],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+async def setup_bot(tavily, llm_latency=0.3, tokens_per_second=100.0,
+                    telegram_latency=0.03, stream=True, seed=0, llm_failure_rate=0.0,
+                    cache_min_tokens=1024):
+    """
+    Импортирует main с тестовым окружением и подменяет Telegram и OpenAI.
+
+    Returns:
+        tuple: (модуль main, FakeBot, FakeChatModel, TherapistAgent)
+    """
+    workdir = tempfile.mkdtemp(prefix="bench_")
+
+    # Окружение задается до импорта main: он читает его при загрузке
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:BENCHMARK",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "TAVILY_API_KEY": "tvly-benchmark",
+        "TAVILY_BASE_URL": tavily.base_url,
+        "DIALOGS_DB": os.path.join(workdir, "dialogs.db"),
+        "STREAM_REPLIES": "1" if stream else "0",
+        "METRICS_ENABLED": "1",
+        "LANGCHAIN_TRACING_V2": "false",
+    })
+
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    main.logger.setLevel(logging.WARNING)
+
+    bot = FakeBot(latency=telegram_latency)
+    main.bot = bot
+    llm = FakeChatModel(
+        latency=llm_latency, tokens_per_second=tokens_per_second, seed=seed,
+        failure_rate=llm_failure_rate, cache_min_tokens=cache_min_tokens
+    )
+    therapist = await main.init_components(llm=llm)
+    return main, bot, llm, therapist
+
+
+async def run_benchmark(chats=20, messages=5, llm_latency=0.3, tokens_per_second=100.0,
+                        tavily_latency=0.2, telegram_latency=0.03, think_time=0.0,
+                        stream=True, burst=1, burst_gap=0.2, llm_failure_rate=0.0,
+                        seed=0, cache_min_tokens=1024):
+    """
+    Прогоняет синтетические чаты через настоящие обработчики main.py и агентов.
+
+    Returns:
+        dict: Результаты в машиночитаемом виде
+    """
+    tavily = await FakeTavilyServer(latency=tavily_latency).start()
+    main, bot, llm, therapist = await setup_bot(
+        tavily, llm_latency, tokens_per_second, telegram_latency, stream, seed,
+        llm_failure_rate, cache_min_tokens
+    )
+    import db
+    from telegram_delivery import PLACEHOLDER
+
+    writer = db.get_writer()
+
+    # Рост памяти меряем после импорта и инициализации — только за время прогона
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+
+    updates = synthetic_updates(bot, chats, messages, seed=seed)
+    reply_latency = []
+    first_text_latency = []
+
+    async def run_chat(chat_id, chat_messages):
+        # Сообщения идут пачками по `burst` штук с паузой `burst_gap` —
+        # так пишет клиент, дробящий мысль на несколько сообщений
+        for i in range(0, len(chat_messages), burst):
+            started = time.perf_counter()
+            handlers = []
+            for j, message in enumerate(chat_messages[i:i + burst]):
+                if j:
+                    await asyncio.sleep(burst_gap)
+                handlers.append(asyncio.create_task(main.handle_message(message)))
+            await asyncio.gather(*handlers)
+            finished = time.perf_counter()
+            reply_latency.append(finished - started)
+            first_text = bot.first_text_after(chat_id, started, PLACEHOLDER)
+            if first_text is not None:
+                first_text_latency.append(first_text - started)
+            if think_time:
+                await asyncio.sleep(think_time)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_chat(chat_id, chat_messages) for chat_id, chat_messages in updates.items()
+    ))
+    elapsed = time.perf_counter() - started
+
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    review_stats = main.review_pipeline.stats()
+    admission_stats = main.admission.stats()
+    coalescer_stats = main.coalescer.stats()
+    invoker_stats = {
+        invoker.name: invoker.stats()
+        for invoker in (therapist.invoker, main.observer_chain.invoker,
+                        main.rewriter_chain.invoker)
+    }
+    store_stats = main.conversation_store.stats()
+    stages = main.metrics.registry.summary()
+
+    shutdown_started = time.perf_counter()
+    await main.shutdown_components()
+    shutdown_seconds = time.perf_counter() - shutdown_started
+    tracemalloc.stop()
+    await tavily.stop()
+
+    writer_stats = writer.stats()
+    total_messages = chats * messages
+    return {
+        "revision": git_revision(),
+        "config": {
+            "chats": chats,
+            "messages_per_chat": messages,
+            "llm_latency": llm_latency,
+            "tokens_per_second": tokens_per_second,
+            "tavily_latency": tavily_latency,
+            "telegram_latency": telegram_latency,
+            "think_time": think_time,
+            "stream": stream,
+            "burst": burst,
+            "burst_gap": burst_gap,
+            "llm_failure_rate": llm_failure_rate,
+            "cache_min_tokens": cache_min_tokens,
+            "seed": seed,
+        },
+        "latency": {
+            "reply": percentiles(reply_latency),
+            "first_text": percentiles(first_text_latency),
+        },
+        "throughput": {
+            "messages": total_messages,
+            "seconds": elapsed,
+            "messages_per_sec": total_messages / elapsed if elapsed else 0.0,
+        },
+        "memory": {
+            "traced_growth_bytes": memory_after - memory_before,
+            "traced_peak_bytes": memory_peak,
+            "conversation_store_bytes": store_stats["memory_bytes"],
+        },
+        "db": {
+            "rows_written": writer_stats["written"],
+            "batches": writer_stats["batches"],
+            "dropped": writer_stats["dropped"],
+            "rows_per_sec": writer_stats["written"] / elapsed if elapsed else 0.0,
+            "shutdown_flush_seconds": shutdown_seconds,
+        },
+        "llm_calls": sum(model.calls for model in main.model_router.models()),
+        "llm_failures": sum(model.failures for model in main.model_router.models()),
+        "llm_routes": main.model_router.stats(),
+        "llm_invokers": invoker_stats,
+        "tavily_requests": tavily.requests,
+        "therapist_paths": therapist.path_stats(),
+        "review": review_stats,
+        "admission": admission_stats,
+        "coalescer": coalescer_stats,
+        "stages": stages["stages"],
+        "counters": stages["counters"],
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    Сравнивает результат с базовым прогоном.
+
+    Returns:
+        list[str]: Описание регрессий (пусто, если их нет)
+    """
+    regressions = []
+    checks = [
+        ("latency.reply.p95", result["latency"]["reply"].get("p95"),
+         baseline["latency"]["reply"].get("p95"), True),
+        ("latency.first_text.p95", result["latency"]["first_text"].get("p95"),
+         baseline["latency"]["first_text"].get("p95"), True),
+        ("throughput.messages_per_sec", result["throughput"]["messages_per_sec"],
+         baseline["throughput"]["messages_per_sec"], False),
+    ]
+    for name, current, previous, lower_is_better in checks:
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        if (change > tolerance) if lower_is_better else (change < -tolerance):
+            regressions.append(f"{name}: {previous:.4f} -> {current:.4f} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Офлайн-бенчмарк бота с фейковыми OpenAI, Tavily и Telegram"
+    )
+    parser.add_argument("--chats", type=int, default=20, help="число одновременных чатов")
+    parser.add_argument("--messages", type=int, default=5, help="сообщений на чат")
+    parser.add_argument("--llm-latency", type=float, default=0.3,
+                        help="задержка модели до первого токена, сек")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--tavily-latency", type=float, default=0.2)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="пауза между сообщениями одного чата, сек")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="сколько сообщений клиент отправляет подряд")
+    parser.add_argument("--burst-gap", type=float, default=0.2,
+                        help="пауза между сообщениями одной пачки, сек")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0,
+                        help="доля вызовов модели, завершающихся ошибкой соединения")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="отправлять ответ одним сообщением")
+    parser.add_argument("--cache-min-tokens", type=int, default=1024,
+                        help="минимальный общий префикс для кэша промптов фейковой модели")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="допустимое ухудшение относительно базового прогона")
+    args = parser.parse_args()
+
+    # Подробный вывод агентов LangChain не должен смешиваться с JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        result = asyncio.run(run_benchmark(
+            chats=args.chats,
+            messages=args.messages,
+            llm_latency=args.llm_latency,
+            tokens_per_second=args.tokens_per_second,
+            tavily_latency=args.tavily_latency,
+            telegram_latency=args.telegram_latency,
+            think_time=args.think_time,
+            stream=not args.no_stream,
+            burst=args.burst,
+            burst_gap=args.burst_gap,
+            llm_failure_rate=args.llm_failure_rate,
+            seed=args.seed,
+            cache_min_tokens=args.cache_min_tokens,
+        ))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        result["regressions"] = regressions
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+    if regressions:
+        print("Регрессии:\n" + "\n".join(regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
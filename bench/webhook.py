@@ -0,0 +1,168 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+
+from aiohttp import ClientSession
+
+from bench.fakes import FakeTavilyServer, synthetic_webhook_updates
+from bench.run import percentiles, git_revision, setup_bot
+
+
+def _port(runner):
+    return runner.addresses[0][1]
+
+
+async def run_webhook_benchmark(chats=20, messages=5, shards=4, llm_latency=0.3,
+                                tokens_per_second=100.0, telegram_latency=0.03,
+                                tavily_latency=0.2, url=None, secret=None, seed=0):
+    """
+    Отправляет синтетические обновления POST-запросами на вебхук.
+
+    Без `url` поднимает в этом процессе фронт ShardRouter и `shards`
+    приемников WebhookWorker с фейковыми Telegram и OpenAI и проверяет, что
+    каждый чат обрабатывается ровно одним шардом. Приемники делят один
+    диспетчер main.py — распределение и доставка проверяются так же, как
+    в BOT_MODE=sharded, но без отдельных процессов. С `url` обновления
+    отправляются на уже запущенный бот (фронт или вебхук одного процесса).
+
+    Returns:
+        dict: Результаты в машиночитаемом виде
+    """
+    tavily = None
+    workers = []
+    runners = []
+    router = None
+    if url is None:
+        import webhook
+
+        tavily = await FakeTavilyServer(latency=tavily_latency).start()
+        main, bot, _, _ = await setup_bot(
+            tavily, llm_latency, tokens_per_second, telegram_latency, True, seed
+        )
+        worker_urls = []
+        for _ in range(shards):
+            worker = webhook.WebhookWorker(main.dp, bot, secret=secret)
+            runner = await webhook.serve(worker.make_app(), "127.0.0.1", 0)
+            workers.append(worker)
+            runners.append(runner)
+            worker_urls.append(f"http://127.0.0.1:{_port(runner)}/webhook")
+        router = webhook.ShardRouter(worker_urls, secret=secret)
+        await router.start()
+        front = await webhook.serve(router.make_app(), "127.0.0.1", 0)
+        runners.insert(0, front)
+        url = f"http://127.0.0.1:{_port(front)}/webhook"
+
+    updates = synthetic_webhook_updates(chats, messages, seed=seed)
+    ack_latency = []
+    statuses = {}
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async with ClientSession() as session:
+        async def post_chat(chat_updates):
+            # Обновления одного чата отправляются по порядку, как это делает Telegram
+            for update in chat_updates:
+                started = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                ack_latency.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post_chat(chat_updates) for chat_updates in updates.values()))
+        posted = time.perf_counter() - started
+
+        result = {
+            "revision": git_revision(),
+            "config": {
+                "chats": chats,
+                "messages_per_chat": messages,
+                "shards": shards if workers else None,
+                "url": url,
+                "llm_latency": llm_latency,
+                "seed": seed,
+            },
+            "ack_latency": percentiles(ack_latency),
+            "statuses": {str(status): count for status, count in statuses.items()},
+            "post_seconds": posted,
+        }
+
+    if workers:
+        # Ждем обработки: приемники дообрабатывают принятые обновления
+        await asyncio.gather(*(worker.drain() for worker in workers))
+        elapsed = time.perf_counter() - started
+        total = chats * messages
+
+        import webhook
+
+        expected = [0] * shards
+        for chat_updates in updates.values():
+            expected[webhook.shard_for(chat_updates[0], shards)] += len(chat_updates)
+        accepted = [worker.stats()["accepted"] for worker in workers]
+        replied = sum(
+            1 for chat_id in updates if any(kind == "send" for _, kind, _ in bot.events[chat_id])
+        )
+        result.update({
+            "throughput": {
+                "messages": total,
+                "seconds": elapsed,
+                "messages_per_sec": total / elapsed if elapsed else 0.0,
+            },
+            "shards": {
+                "accepted": accepted,
+                "expected": expected,
+                "consistent": accepted == expected,
+                "handled": sum(worker.stats()["handled"] for worker in workers),
+                "failed": sum(worker.stats()["failed"] for worker in workers),
+            },
+            "chats_replied": replied,
+            "llm_calls": sum(model.calls for model in main.model_router.models()),
+            "router": router.stats(),
+        })
+        for runner in runners:
+            await runner.cleanup()
+        await router.close()
+        await main.shutdown_components()
+        await tavily.stop()
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Нагрузка на вебхук синтетическими обновлениями Telegram"
+    )
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--shards", type=int, default=4,
+                        help="число приемников при запуске в этом процессе")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--url", help="вебхук уже запущенного бота вместо локального")
+    parser.add_argument("--secret", help="значение X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        result = asyncio.run(run_webhook_benchmark(
+            chats=args.chats,
+            messages=args.messages,
+            shards=args.shards,
+            llm_latency=args.llm_latency,
+            url=args.url,
+            secret=args.secret,
+            seed=args.seed,
+        ))
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
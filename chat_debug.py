@@ -0,0 +1,203 @@
+import os
+import io
+import time
+import pstats
+import random
+import cProfile
+import tracemalloc
+import contextlib
+
+import metrics
+
+# Этапы ответа в порядке вывода: имя этапа metrics.stage -> подпись
+_REPLY_STAGES = (
+    ("history_summary", "свертка истории"),
+    ("search", "поиск"),
+    ("therapist_llm", "LLM психолога"),
+    ("telegram_send", "отправка"),
+)
+_REVIEW_STAGES = (
+    ("observer", "наблюдатель"),
+    ("corrector", "корректор"),
+)
+
+
+class ChatTrace:
+    """Длительность этапов и токены одной реплики (или одной супервизии)."""
+
+    __slots__ = ("started", "stages", "tokens", "path", "profile_path")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self.path = None
+        self.profile_path = None
+
+    def add_stage(self, name, seconds, labels):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if name == "therapist_reply" and "path" in labels:
+            self.path = labels["path"]
+
+    def add_tokens(self, prompt_tokens, completion_tokens, cached_tokens, labels):
+        route = labels.get("route", "llm")
+        prompt, completion, cached = self.tokens.get(route, (0, 0, 0))
+        self.tokens[route] = (
+            prompt + prompt_tokens, completion + completion_tokens, cached + cached_tokens
+        )
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def _format_stages(self, stages):
+        return " · ".join(
+            f"{title} {self.stages[name]:.2f} с"
+            for name, title in stages if name in self.stages
+        )
+
+    def format(self, review=None):
+        """
+        Компактная сводка для чата.
+
+        Args:
+            review (ChatTrace): Последняя завершенная супервизия чата —
+                она идет в фоне после ответа, поэтому показывается
+                с отставанием на одну реплику
+        """
+        lines = [
+            f"🛠 {self.elapsed():.2f} с: " + (self._format_stages(_REPLY_STAGES) or "—")
+        ]
+        if self.tokens:
+            lines.append("Токены: " + ", ".join(
+                f"{route} {prompt}→{completion}" + (f" (кэш {cached})" if cached else "")
+                for route, (prompt, completion, cached) in self.tokens.items()
+            ))
+        search = self.path in ("prefetch", "react") or "search" in self.stages
+        lines.append(f"Поиск: {'да' if search else 'нет'} (путь {self.path or '—'})")
+        if review is not None:
+            lines.append(
+                "Супервизия прошлой реплики: "
+                + (review._format_stages(_REVIEW_STAGES) or "не запускалась")
+            )
+        if self.profile_path is not None:
+            lines.append(f"Профиль: {self.profile_path}")
+        return "\n".join(lines)
+
+
+class ChatDebug:
+    """
+    Режим /debug: разбивка времени ответа по этапам для отдельных чатов.
+
+    Этапы и токены собираются теми же metrics.stage и колбэками моделей,
+    что и метрики, — но только внутри трассировки чата с включенной
+    отладкой. Пока таких чатов нет, трассировка выключена целиком и
+    остальные чаты не платят за нее ничего.
+
+    По запросу (/debug profile) реплики чата выборочно профилируются:
+    cProfile и tracemalloc пишутся в файлы в `profile_dir`. Профилировщик
+    видит и замедляет весь цикл событий, поэтому профилирование доступно
+    только администраторам из `admin_ids`, затрагивает долю `profile_rate`
+    реплик и одновременно снимается только один профиль.
+    """
+
+    def __init__(self, profile_rate=0.1, profile_dir="debug_profiles", admin_ids=(),
+                 logger=None):
+        """
+        Args:
+            profile_rate (float): Доля профилируемых реплик в чатах с профилированием
+            profile_dir (str): Каталог для файлов профилей
+            admin_ids (iterable): Пользователи Telegram, которым разрешено
+                профилирование
+            logger: Логгер для диагностических сообщений
+        """
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.admin_ids = frozenset(admin_ids)
+        self.logger = logger
+        # chat_id -> профилировать ли реплики
+        self._chats = {}
+        self._last_review = {}
+        self._profiling = False
+        self._own_tracemalloc = False
+
+    def allows_profile(self, user_id):
+        """Можно ли пользователю включать профилирование (/debug profile)."""
+        return user_id is not None and user_id in self.admin_ids
+
+    def enable(self, chat_id, profile=False):
+        self._chats[chat_id] = profile
+        metrics.set_tracing(True)
+
+    def disable(self, chat_id):
+        self._chats.pop(chat_id, None)
+        self._last_review.pop(chat_id, None)
+        metrics.set_tracing(bool(self._chats))
+
+    def is_enabled(self, chat_id):
+        return chat_id in self._chats
+
+    def last_review(self, chat_id):
+        """Трассировка последней завершенной супервизии чата."""
+        return self._last_review.get(chat_id)
+
+    @contextlib.contextmanager
+    def trace(self, chat_id, review=False):
+        """
+        Трассирует реплику чата.
+
+        Yields:
+            ChatTrace или None, если отладка в чате выключена
+        """
+        profile = self._chats.get(chat_id)
+        if profile is None:
+            yield None
+            return
+
+        trace = ChatTrace()
+        token = metrics.start_trace(trace)
+        profiler = None
+        if (profile and not review and not self._profiling
+                and random.random() < self.profile_rate):
+            profiler = self._start_profile()
+        try:
+            yield trace
+        finally:
+            metrics.stop_trace(token)
+            if profiler is not None:
+                trace.profile_path = self._stop_profile(profiler, chat_id)
+            if review and chat_id in self._chats:
+                self._last_review[chat_id] = trace
+
+    def _start_profile(self):
+        self._profiling = True
+        # Уже запущенный снаружи tracemalloc (PYTHONTRACEMALLOC) не трогаем
+        self._own_tracemalloc = not tracemalloc.is_tracing()
+        if self._own_tracemalloc:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profile(self, profiler, chat_id):
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+        self._profiling = False
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            base = os.path.join(self.profile_dir, f"{chat_id}_{int(time.time() * 1000)}")
+            profiler.dump_stats(base + ".prof")
+
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(40)
+            report.write("\nПамять (tracemalloc, топ-20 строк):\n")
+            for stat in snapshot.statistics("lineno")[:20]:
+                report.write(f"{stat}\n")
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(report.getvalue())
+            return base + ".prof"
+        except OSError as e:
+            if self.logger:
+                self.logger.error(f"Не удалось сохранить профиль чата {chat_id}: {str(e)}")
+            return None
@@ -104,6 +104,40 @@ def check_api_access():
     except Exception as e:
         print(f"❌ Ошибка при подключении к Tavily API: {str(e)}")
 
+def check_startup_time():
+    """Замеряет этапы запуска бота: импорт, создание компонентов и прогрев"""
+    import json
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ)
+        # Замер не должен трогать рабочую базу; ключи нужны только для проверки формата
+        env.setdefault("TELEGRAM_TOKEN", "123456:STARTUP")
+        env.setdefault("OPENAI_API_KEY", "sk-startup")
+        env.setdefault("TAVILY_API_KEY", "tvly-startup")
+        env["DIALOGS_DB"] = os.path.join(workdir, "dialogs.db")
+        env["PROMPTS_DB"] = env["DIALOGS_DB"]
+        try:
+            output = subprocess.run(
+                [sys.executable, "startup.py"],
+                env=env, capture_output=True, text=True, timeout=300, check=True
+            ).stdout
+            report = json.loads(output.strip().splitlines()[-1])
+        except Exception as e:
+            print(f"❌ Не удалось замерить запуск: {str(e)}")
+            return False
+
+    phases = report["phases"]
+    print("⏱️ Время запуска:")
+    for name, seconds in phases.items():
+        print(f"   {name}: {seconds:.3f} с")
+    # import_agents, construct и warm_up идут параллельно с запуском приема обновлений
+    blocking = phases.get("import_main", 0.0)
+    ready = blocking + phases.get("import_agents", 0.0) + phases.get("construct", 0.0)
+    print(f"✅ До начала приема обновлений: {blocking:.3f} с, "
+          f"до готовности агентов: {ready:.3f} с")
+    return True
+
 def main():
     print("🔍 Проверка настройки проекта AI Therapy MCP")
     print("=" * 50)
@@ -131,6 +165,9 @@ def main():
     # Проверка доступа к API
     check_api_access()
     
+    # Время запуска бота
+    check_startup_time()
+    
     print("=" * 50)
     if all_modules_installed and env_vars_ok and db_ok:
         print("✅ Проект настроен корректно и готов к запуску!")
@@ -0,0 +1,145 @@
+import time
+import asyncio
+
+import metrics
+
+
+class _PendingTurn:
+    """Фрагменты чата, еще не получившие ответа, и ход их обработки."""
+
+    __slots__ = ("fragments", "waiters", "first_at", "timer", "run", "committed")
+
+    def __init__(self):
+        self.fragments = []
+        self.waiters = []
+        self.first_at = time.monotonic()
+        self.timer = None
+        self.run = None
+        self.committed = False
+
+
+class MessageCoalescer:
+    """
+    Склейка сообщений, которые клиент отправляет подряд.
+
+    Сообщения чата копятся, пока клиент не замолчит на `quiet_period`
+    секунд (но не дольше `max_wait` от первого фрагмента), и обрабатываются
+    одной репликой: один ответ психолога и одна супервизия вместо
+    нескольких. Если новый фрагмент приходит, пока ответ еще генерируется,
+    генерация отменяется и ответ строится заново по всем фрагментам.
+    После того как ответ зафиксирован (commit), он уже не отменяется —
+    новые фрагменты копятся для следующей реплики.
+    """
+
+    def __init__(self, process, quiet_period=0.5, max_wait=3.0, logger=None):
+        """
+        Args:
+            process (callable): Корутина process(chat_id, text, commit) —
+                отвечает на склеенный текст и вызывает commit() перед
+                отправкой окончательного ответа
+            quiet_period (float): Пауза, после которой фрагменты склеиваются, сек
+            max_wait (float): Максимальное ожидание с первого фрагмента, сек
+            logger: Логгер для диагностических сообщений
+        """
+        self.process = process
+        self.quiet_period = quiet_period
+        self.max_wait = max_wait
+        self.logger = logger
+        self._pending = {}
+        self._counters = {
+            "fragments": 0,
+            "turns": 0,
+            "merged_fragments": 0,
+            "cancelled_generations": 0,
+            "failed": 0,
+        }
+
+    async def submit(self, chat_id, text):
+        """
+        Добавляет фрагмент и ждет ответа на реплику, в которую он вошел.
+
+        Returns:
+            Результат process для склеенной реплики
+        """
+        self._counters["fragments"] += 1
+        pending = self._pending.get(chat_id)
+        if pending is None or pending.committed:
+            pending = self._pending[chat_id] = _PendingTurn()
+        elif pending.run is not None and not pending.run.done():
+            # Клиент дописал мысль, пока готовился ответ, — начинаем заново
+            pending.run.cancel()
+            pending.run = None
+            self._counters["cancelled_generations"] += 1
+            metrics.inc("coalescer_cancelled_generations_total")
+
+        waiter = asyncio.get_running_loop().create_future()
+        pending.fragments.append(text)
+        pending.waiters.append(waiter)
+        if pending.timer is not None:
+            pending.timer.cancel()
+        delay = min(
+            self.quiet_period,
+            max(0.0, pending.first_at + self.max_wait - time.monotonic())
+        )
+        pending.timer = asyncio.get_running_loop().call_later(
+            delay, self._start, chat_id, pending
+        )
+        return await waiter
+
+    def _start(self, chat_id, pending):
+        pending.timer = None
+        pending.run = asyncio.create_task(self._run(chat_id, pending))
+
+    async def _run(self, chat_id, pending):
+        fragments = list(pending.fragments)
+        waiters = list(pending.waiters)
+
+        def commit():
+            # Ответ уходит клиенту: дальнейшие фрагменты — уже новая реплика
+            pending.committed = True
+            if self._pending.get(chat_id) is pending:
+                del self._pending[chat_id]
+
+        try:
+            result = await self.process(chat_id, "\n".join(fragments), commit)
+        except asyncio.CancelledError:
+            if pending.committed:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.cancel()
+            # Иначе фрагменты остаются в pending и войдут в следующий запуск
+            raise
+        except Exception as e:
+            commit()
+            self._counters["failed"] += 1
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        commit()
+
+        self._counters["turns"] += 1
+        if len(fragments) > 1:
+            self._counters["merged_fragments"] += len(fragments) - 1
+            metrics.inc("coalescer_merged_fragments_total", len(fragments) - 1)
+            if self.logger:
+                self.logger.info(f"Чат {chat_id}: склеено {len(fragments)} сообщений")
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(result)
+
+    def stats(self):
+        """
+        Счетчики склейки.
+
+        saved_llm_calls — сколько ответов психолога и супервизий не
+        понадобилось благодаря склейке (по одному каждого на фрагмент),
+        за вычетом генераций, которые начались и были отменены.
+        """
+        stats = dict(self._counters)
+        stats["saved_llm_calls"] = max(
+            0,
+            2 * self._counters["merged_fragments"] - self._counters["cancelled_generations"]
+        )
+        stats["pending_chats"] = len(self._pending)
+        return stats
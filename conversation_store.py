@@ -0,0 +1,227 @@
+import sys
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+
+class Turn:
+    """Одна реплика диалога: сообщение клиента и ответ психолога."""
+
+    __slots__ = ("seq", "user_message", "bot_message", "timestamp")
+
+    def __init__(self, seq, user_message, bot_message=None, timestamp=None):
+        self.seq = seq
+        self.user_message = user_message
+        self.bot_message = bot_message
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    def size(self):
+        """Приблизительный объем памяти, занимаемый репликой, в байтах."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.user_message or "")
+        if self.bot_message:
+            size += sys.getsizeof(self.bot_message)
+        return size
+
+
+class _ChatHistory:
+    """Кольцевой буфер реплик одного чата."""
+
+    __slots__ = ("turns", "bytes", "next_seq")
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)
+        self.bytes = 0
+        self.next_seq = 0
+
+    def append(self, turn):
+        if len(self.turns) == self.turns.maxlen:
+            self.bytes -= self.turns[0].size()
+        self.turns.append(turn)
+        self.bytes += turn.size()
+        self.next_seq = turn.seq + 1
+
+
+class ConversationStore:
+    """
+    Хранилище диалогов с разбивкой по чатам.
+
+    Для каждого чата хранится кольцевой буфер последних реплик. Общий объем
+    памяти ограничен бюджетом: при его превышении из памяти вытесняются
+    чаты, к которым дольше всего не обращались (LRU). Вытесненный чат
+    восстанавливается через `loader` (например, из dialogs.db) в `load`,
+    которую нужно дождаться перед обращением к чату: `loader` выполняется
+    в отдельном потоке, а остальные методы не делают ввода-вывода.
+    """
+
+    def __init__(self, max_turns=50, memory_budget_bytes=64 * 1024 * 1024,
+                 loader=None, logger=None):
+        """
+        Args:
+            max_turns (int): Максимальное число реплик в буфере одного чата
+            memory_budget_bytes (int): Общий бюджет памяти на все чаты
+            loader (callable): Функция loader(chat_id, limit) -> list[tuple],
+                возвращающая пары (user_message, bot_message) в порядке времени
+            logger: Логгер для диагностических сообщений
+        """
+        self.max_turns = max_turns
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loader = loader
+        self.logger = logger
+        self._chats = OrderedDict()
+        self._lock = threading.RLock()
+        self._total_bytes = 0
+        self._evictions = 0
+        self._rehydrations = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _get_chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            self._hits += 1
+            self._chats.move_to_end(chat_id)
+            return chat
+
+        # Чат не загружен через load — начинаем с пустой истории
+        self._misses += 1
+        chat = _ChatHistory(self.max_turns)
+        self._chats[chat_id] = chat
+        return chat
+
+    async def load(self, chat_id):
+        """
+        Восстанавливает историю чата через `loader`, если чата нет в памяти.
+
+        Запрос к БД выполняется в отдельном потоке, чтобы не блокировать
+        цикл событий.
+
+        Args:
+            chat_id (int): Идентификатор чата Telegram
+        """
+        if self.loader is None:
+            return
+        with self._lock:
+            if chat_id in self._chats:
+                return
+
+        try:
+            rows = await asyncio.to_thread(self.loader, chat_id, self.max_turns)
+        except Exception as e:
+            rows = []
+            if self.logger:
+                self.logger.error(
+                    f"Ошибка при восстановлении истории чата {chat_id}: {str(e)}"
+                )
+
+        with self._lock:
+            if chat_id in self._chats:
+                # Чат появился, пока шел запрос, — его история уже новее
+                return
+            self._misses += 1
+            chat = _ChatHistory(self.max_turns)
+            for user_message, bot_message in rows:
+                chat.append(Turn(chat.next_seq, user_message, bot_message))
+            if rows:
+                self._rehydrations += 1
+            self._chats[chat_id] = chat
+            self._total_bytes += chat.bytes
+            self._evict(chat_id)
+
+    def _evict(self, keep_chat_id):
+        """Вытесняет наименее используемые чаты, пока не уложимся в бюджет."""
+        while self._total_bytes > self.memory_budget_bytes and len(self._chats) > 1:
+            chat_id = next(iter(self._chats))
+            if chat_id == keep_chat_id:
+                # Текущий чат всегда остается в памяти
+                self._chats.move_to_end(chat_id)
+                chat_id = next(iter(self._chats))
+            chat = self._chats.pop(chat_id)
+            self._total_bytes -= chat.bytes
+            self._evictions += 1
+
+    def append_user_message(self, chat_id, text):
+        """
+        Добавляет сообщение клиента в историю чата.
+
+        Args:
+            chat_id (int): Идентификатор чата Telegram
+            text (str): Текст сообщения клиента
+
+        Returns:
+            Turn: Новая реплика, в которую затем записывается ответ психолога
+        """
+        with self._lock:
+            chat = self._get_chat(chat_id)
+            before = chat.bytes
+            turn = Turn(chat.next_seq, text)
+            chat.append(turn)
+            self._total_bytes += chat.bytes - before
+            self._evict(chat_id)
+            return turn
+
+    def set_bot_message(self, chat_id, turn, text):
+        """Записывает ответ психолога в реплику и обновляет учет памяти."""
+        with self._lock:
+            before = turn.size()
+            turn.bot_message = text
+            delta = turn.size() - before
+            chat = self._chats.get(chat_id)
+            # Реплика могла быть вытеснена вместе с чатом, пока шла генерация
+            if chat is not None and any(t is turn for t in chat.turns):
+                chat.bytes += delta
+                self._total_bytes += delta
+                self._evict(chat_id)
+
+    def discard_turn(self, chat_id, turn):
+        """
+        Убирает последнюю реплику без ответа (например, если ее генерация
+        отменена и реплика будет построена заново).
+        """
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None or not chat.turns or chat.turns[-1] is not turn:
+                return False
+            chat.turns.pop()
+            size = turn.size()
+            chat.bytes -= size
+            self._total_bytes -= size
+            return True
+
+    def recent(self, chat_id, limit=None):
+        """
+        Возвращает последние реплики чата.
+
+        Args:
+            chat_id (int): Идентификатор чата Telegram
+            limit (int): Максимальное число реплик (по умолчанию все)
+
+        Returns:
+            list[Turn]: Реплики в хронологическом порядке
+        """
+        with self._lock:
+            turns = self._get_chat(chat_id).turns
+            self._evict(chat_id)
+            if limit is None or limit >= len(turns):
+                return list(turns)
+            return list(turns)[-limit:]
+
+    def drop(self, chat_id):
+        """Удаляет чат из памяти (данные в БД не затрагиваются)."""
+        with self._lock:
+            chat = self._chats.pop(chat_id, None)
+            if chat is not None:
+                self._total_bytes -= chat.bytes
+
+    def stats(self):
+        """Счетчики памяти и вытеснения."""
+        with self._lock:
+            return {
+                "chats": len(self._chats),
+                "memory_bytes": self._total_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "evictions": self._evictions,
+                "rehydrations": self._rehydrations,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
@@ -1,22 +1,227 @@
+import os
+import queue
 import sqlite3
+import threading
+import time
+import logging
 from datetime import datetime
 
-conn = sqlite3.connect("dialogs.db")
-cursor = conn.cursor()
+import metrics
+
+logger = logging.getLogger("db")
+
+DB_PATH = os.getenv("DIALOGS_DB", "dialogs.db")
+
+
+def connect(path=DB_PATH):
+    """
+    Открывает соединение с базой диалогов и создает схему при необходимости.
+
+    Включается WAL: чтение не блокируется записью, а фиксация транзакции
+    не требует fsync основного файла на каждое сообщение.
+    """
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dialogs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message TEXT,
+        role TEXT,
+        timestamp TEXT
+    )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_dialogs_user_ts ON dialogs (user_id, timestamp)"
+    )
+    conn.commit()
+    return conn
+
+
+class DialogueWriter:
+    """
+    Фоновая запись диалогов в SQLite.
+
+    Сообщения складываются в ограниченную очередь и записываются отдельным
+    потоком пачками через executemany — по достижении `batch_size` строк
+    или раз в `flush_interval` секунд. Цикл событий бота на запись
+    не блокируется. Пачка, которую не удалось записать, повторяется один
+    раз через `retry_delay` секунд (например, после SQLITE_BUSY) и только
+    затем отбрасывается с записью в лог.
+    """
+
+    _STOP = object()
+
+    def __init__(self, path=DB_PATH, batch_size=100, flush_interval=0.5,
+                 max_queue=10000, retry_delay=1.0):
+        """
+        Args:
+            path (str): Путь к файлу базы
+            batch_size (int): Максимальный размер пачки
+            flush_interval (float): Максимальная задержка записи, сек
+            max_queue (int): Максимальная длина очереди
+            retry_delay (float): Пауза перед повтором неудавшейся пачки, сек
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stats = {
+            "written": 0, "batches": 0, "dropped": 0, "errors": 0, "lost": 0,
+        }
+        self._thread = threading.Thread(
+            target=self._run, name="dialogue-writer", daemon=True
+        )
+        self._thread.start()
+
+    def save(self, user_id, message, role):
+        """
+        Ставит сообщение в очередь на запись.
+
+        Returns:
+            bool: False, если очередь переполнена и сообщение отброшено
+        """
+        row = (user_id, message, role, datetime.now().isoformat())
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self._stats["dropped"] += 1
+            return False
+
+    def _run(self):
+        conn = connect(self.path)
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch:
+                self._write(conn, batch)
+        conn.close()
+
+    def _write(self, conn, batch):
+        for attempt in range(2):
+            try:
+                with metrics.stage("db_write"), conn:
+                    conn.executemany(
+                        "INSERT INTO dialogs (user_id, message, role, timestamp) "
+                        "VALUES (?, ?, ?, ?)",
+                        batch
+                    )
+                break
+            except sqlite3.Error as e:
+                self._stats["errors"] += 1
+                if attempt == 0:
+                    logger.warning(
+                        f"Ошибка записи пачки диалогов ({len(batch)} строк), "
+                        f"повтор через {self.retry_delay} с: {str(e)}"
+                    )
+                    time.sleep(self.retry_delay)
+                    continue
+                logger.error(
+                    f"Пачка диалогов ({len(batch)} строк) не записана и отброшена: {str(e)}"
+                )
+                self._stats["lost"] += len(batch)
+                metrics.inc("db_rows_lost_total", len(batch))
+                return
+        self._stats["written"] += len(batch)
+        metrics.inc("db_rows_written_total", len(batch))
+        self._stats["batches"] += 1
+
+    def close(self, timeout=10.0):
+        """Записывает все накопленные сообщения и останавливает поток."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        """Счетчики записи и текущая длина очереди."""
+        stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
+
+
+_writer = None
+_read_conn = None
+_lock = threading.Lock()
+
+
+def get_writer():
+    """Возвращает общий фоновый писатель диалогов."""
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = DialogueWriter(
+                batch_size=int(os.getenv("DB_BATCH_SIZE", "100")),
+                flush_interval=float(os.getenv("DB_FLUSH_INTERVAL", "0.5"))
+            )
+        return _writer
+
+
+def _get_read_conn():
+    global _read_conn
+    with _lock:
+        if _read_conn is None:
+            _read_conn = connect()
+        return _read_conn
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS dialogs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    message TEXT,
-    role TEXT,
-    timestamp TEXT
-)
-""")
-conn.commit()
 
 def save_dialogue(user_id, message, role):
-    timestamp = datetime.now().isoformat()
-    cursor.execute("INSERT INTO dialogs (user_id, message, role, timestamp) VALUES (?, ?, ?, ?)",
-                   (user_id, message, role, timestamp))
-    conn.commit()
\ No newline at end of file
+    """Сохраняет сообщение диалога (асинхронно, через фоновый поток)."""
+    return get_writer().save(user_id, message, role)
+
+
+def close():
+    """Дописывает очередь и закрывает соединения при остановке бота."""
+    global _writer, _read_conn
+    with _lock:
+        writer, _writer = _writer, None
+        read_conn, _read_conn = _read_conn, None
+    if writer is not None:
+        writer.close()
+    if read_conn is not None:
+        read_conn.close()
+
+
+def load_recent_dialogue(user_id, limit):
+    """
+    Загружает последние реплики пользователя из базы.
+
+    Args:
+        user_id (int): Идентификатор пользователя (чата)
+        limit (int): Максимальное число реплик
+
+    Returns:
+        list[tuple]: Пары (user_message, bot_message) в хронологическом порядке
+    """
+    rows = _get_read_conn().execute(
+        "SELECT message, role FROM dialogs WHERE user_id = ? "
+        "ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (user_id, limit * 2)
+    ).fetchall()
+
+    turns = []
+    for message, role in reversed(rows):
+        if role == "user":
+            turns.append([message, None])
+        elif turns and turns[-1][1] is None:
+            turns[-1][1] = message
+    return [tuple(turn) for turn in turns[-limit:]]
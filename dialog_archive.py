@@ -0,0 +1,273 @@
+import io
+import csv
+import json
+import time
+import sqlite3
+import threading
+
+import db
+
+_COLUMNS = ("id", "user_id", "message", "role", "timestamp")
+
+
+def _ts(value):
+    """Граница периода: datetime или строка ISO 8601 (как в столбце timestamp)."""
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat()
+
+
+def _fts_query(text):
+    # Каждое слово — отдельная фраза в кавычках: пользовательский ввод
+    # не должен разбираться как синтаксис FTS5 (NEAR, OR, *, -)
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+class Page:
+    """Страница выборки и курсор для следующей страницы (None — страниц больше нет)."""
+
+    __slots__ = ("rows", "cursor")
+
+    def __init__(self, rows, cursor):
+        self.rows = rows
+        self.cursor = cursor
+
+
+class DialogArchive:
+    """
+    Чтение архива диалогов для веб-интерфейса.
+
+    Все выборки идут по индексам: страницы — по курсору (timestamp, id)
+    вместо OFFSET, поиск — по полнотекстовому индексу FTS5, который
+    поддерживается триггерами при каждой записи бота. Агрегаты считаются
+    инкрементально: при обновлении читаются только строки с id больше
+    уже учтенного, поэтому их стоимость не растет вместе с таблицей.
+    """
+
+    def __init__(self, path=db.DB_PATH, aggregate_ttl=30.0, logger=None):
+        """
+        Args:
+            path (str): Путь к файлу базы
+            aggregate_ttl (float): Как часто обновлять агрегаты, сек
+            logger: Логгер для диагностических сообщений
+        """
+        self.logger = logger
+        self.aggregate_ttl = aggregate_ttl
+        self._conn = db.connect(path)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self.fts = self._ensure_indexes()
+        # (день, роль) -> число сообщений; учтены строки с id <= _aggregated_to
+        self._daily = {}
+        self._aggregated_to = 0
+        self._aggregated_at = None
+
+    def _ensure_indexes(self):
+        conn = self._conn
+        # Страницы по всем пользователям: порядок (timestamp, id) дает сам индекс
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dialogs_ts ON dialogs (timestamp)")
+        try:
+            created = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'dialogs_fts'"
+            ).fetchone() is None
+            conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS dialogs_fts USING fts5(
+                message, content='dialogs', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS dialogs_fts_insert AFTER INSERT ON dialogs BEGIN
+                INSERT INTO dialogs_fts (rowid, message) VALUES (new.id, new.message);
+            END;
+            CREATE TRIGGER IF NOT EXISTS dialogs_fts_delete AFTER DELETE ON dialogs BEGIN
+                INSERT INTO dialogs_fts (dialogs_fts, rowid, message)
+                VALUES ('delete', old.id, old.message);
+            END;
+            CREATE TRIGGER IF NOT EXISTS dialogs_fts_update AFTER UPDATE OF message ON dialogs BEGIN
+                INSERT INTO dialogs_fts (dialogs_fts, rowid, message)
+                VALUES ('delete', old.id, old.message);
+                INSERT INTO dialogs_fts (rowid, message) VALUES (new.id, new.message);
+            END;
+            """)
+            if created:
+                # Индекс по уже накопленной истории строится один раз
+                conn.execute("INSERT INTO dialogs_fts (dialogs_fts) VALUES ('rebuild')")
+            conn.commit()
+            return True
+        except sqlite3.OperationalError as e:
+            # SQLite собран без FTS5 — поиск работает через LIKE
+            conn.rollback()
+            if self.logger:
+                self.logger.warning(f"FTS5 недоступен, поиск без индекса: {str(e)}")
+            return False
+
+    def _fetch(self, sql, params):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def page(self, user_id=None, since=None, until=None, cursor=None, limit=50,
+             newest_first=False):
+        """
+        Страница сообщений по времени (keyset-пагинация).
+
+        Args:
+            user_id (int): Пользователь (чат) или None для всех
+            since: Начало периода включительно (datetime или ISO-строка)
+            until: Конец периода не включительно
+            cursor (tuple): Курсор из предыдущей страницы
+            limit (int): Размер страницы
+            newest_first (bool): Сначала новые сообщения
+
+        Returns:
+            Page: Строки (dict) и курсор следующей страницы
+        """
+        where = []
+        params = []
+        if user_id is not None:
+            where.append("user_id = ?")
+            params.append(user_id)
+        # Курсор заменяет ближнюю границу периода: с ней SQLite начинал бы
+        # сканирование индекса от начала периода на каждой странице
+        if since is not None and (cursor is None or newest_first):
+            where.append("timestamp >= ?")
+            params.append(_ts(since))
+        if until is not None and (cursor is None or not newest_first):
+            where.append("timestamp < ?")
+            params.append(_ts(until))
+        if cursor is not None:
+            timestamp, row_id = cursor
+            if newest_first:
+                where.append("timestamp <= ? AND (timestamp < ? OR id < ?)")
+            else:
+                where.append("timestamp >= ? AND (timestamp > ? OR id > ?)")
+            params.extend((timestamp, timestamp, row_id))
+        order = "DESC" if newest_first else "ASC"
+        sql = (
+            f"SELECT {', '.join(_COLUMNS)} FROM dialogs "
+            f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+            f"ORDER BY timestamp {order}, id {order} LIMIT ?"
+        )
+        rows = self._fetch(sql, params + [limit])
+        next_cursor = (
+            (rows[-1]["timestamp"], rows[-1]["id"]) if len(rows) == limit else None
+        )
+        return Page(rows, next_cursor)
+
+    def search(self, text, user_id=None, cursor=None, limit=50):
+        """
+        Полнотекстовый поиск по сообщениям, сначала новые.
+
+        Args:
+            text (str): Слова для поиска (все должны встретиться)
+            user_id (int): Ограничить поиск одним пользователем
+            cursor (int): Курсор из предыдущей страницы
+            limit (int): Размер страницы
+
+        Returns:
+            Page: Строки (dict) и курсор следующей страницы
+        """
+        if not text.split():
+            return Page([], None)
+        columns = ", ".join(f"d.{column}" for column in _COLUMNS)
+        if self.fts:
+            sql = (
+                f"SELECT {columns} FROM dialogs_fts f JOIN dialogs d ON d.id = f.rowid "
+                "WHERE dialogs_fts MATCH ?"
+            )
+            params = [_fts_query(text)]
+        else:
+            sql = f"SELECT {columns} FROM dialogs d WHERE d.message LIKE ?"
+            params = [f"%{text}%"]
+        if user_id is not None:
+            sql += " AND d.user_id = ?"
+            params.append(user_id)
+        if cursor is not None:
+            sql += " AND d.id < ?"
+            params.append(cursor)
+        sql += " ORDER BY d.id DESC LIMIT ?"
+        rows = self._fetch(sql, params + [limit])
+        return Page(rows, rows[-1]["id"] if len(rows) == limit else None)
+
+    def iter_pages(self, user_id=None, since=None, until=None, batch_size=1000):
+        """Все сообщения периода по порядку, страницами по `batch_size` строк."""
+        cursor = None
+        while True:
+            page = self.page(user_id, since, until, cursor, batch_size)
+            if page.rows:
+                yield page.rows
+            if page.cursor is None:
+                return
+            cursor = page.cursor
+
+    def export(self, fmt="jsonl", user_id=None, since=None, until=None, batch_size=1000):
+        """
+        Потоковая выгрузка сообщений.
+
+        В памяти одновременно находится не больше одной страницы строк —
+        генератор можно отдавать прямо в HTTP-ответ или st.download_button.
+
+        Args:
+            fmt (str): "jsonl" или "csv"
+
+        Yields:
+            str: Очередной фрагмент файла (одна страница строк)
+        """
+        if fmt not in ("jsonl", "csv"):
+            raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == "csv":
+            writer.writerow(_COLUMNS)
+        for rows in self.iter_pages(user_id, since, until, batch_size):
+            if fmt == "jsonl":
+                buffer.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+            else:
+                writer.writerows([row[column] for column in _COLUMNS] for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    def _aggregate(self, since, until):
+        since = _ts(since)[:10] if since is not None else None
+        until = _ts(until)[:10] if until is not None else None
+        with self._lock:
+            now = time.monotonic()
+            if self._aggregated_at is None or now - self._aggregated_at >= self.aggregate_ttl:
+                # Дочитываем только строки, добавленные после прошлого обновления
+                rows = self._conn.execute(
+                    "SELECT substr(timestamp, 1, 10), role, count(*), max(id) FROM dialogs "
+                    "WHERE id > ? GROUP BY 1, 2",
+                    (self._aggregated_to,)
+                ).fetchall()
+                for day, role, count, max_id in rows:
+                    self._daily[(day, role)] = self._daily.get((day, role), 0) + count
+                    self._aggregated_to = max(self._aggregated_to, max_id)
+                self._aggregated_at = now
+            return [
+                (day, role, count) for (day, role), count in self._daily.items()
+                if (since is None or day >= since) and (until is None or day < until)
+            ]
+
+    def messages_per_day(self, since=None, until=None):
+        """
+        Число сообщений по дням (границы периода округляются до дня).
+
+        Returns:
+            dict: {"YYYY-MM-DD": {"user": n, "bot": n}} по возрастанию дат
+        """
+        result = {}
+        for day, role, count in self._aggregate(since, until):
+            result.setdefault(day, {})[role] = count
+        return dict(sorted(result.items()))
+
+    def messages_per_role(self, since=None, until=None):
+        """Число сообщений по ролям (user/bot) за период."""
+        result = {}
+        for _, role, count in self._aggregate(since, until):
+            result[role] = result.get(role, 0) + count
+        return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,62 @@
+import time
+from collections import deque
+
+
+class LatencyTracker:
+    """
+    Статистика задержек по скользящему окну последних измерений.
+
+    Хранит счетчик, сумму и максимум за все время, а перцентили считает
+    по последним `window` измерениям.
+    """
+
+    def __init__(self, window=500):
+        self._samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Добавляет одно измерение (в секундах)."""
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Возвращает перцентиль q (от 0 до 100) по окну измерений."""
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def time(self):
+        """Контекстный менеджер, измеряющий время выполнения блока."""
+        return _Timer(self)
+
+    def stats(self):
+        """Сводка: число измерений, среднее, p50, p95 и максимум."""
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+        }
+
+
+class _Timer:
+    __slots__ = ("tracker", "started")
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracker.observe(time.perf_counter() - self.started)
+        return False
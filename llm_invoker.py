@@ -0,0 +1,343 @@
+import os
+import time
+import random
+import asyncio
+
+import openai
+
+from latency import LatencyTracker
+import metrics
+
+# Ошибки, после которых повтор запроса имеет смысл
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class LLMUnavailable(Exception):
+    """Модель не ответила: исчерпаны попытки или разомкнут предохранитель."""
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # Прочие ответы 5xx (например, 529 при перегрузке)
+    status = getattr(error, "status_code", None)
+    return status is not None and status >= 500
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после `failure_threshold` неудачных вызовов подряд
+    перестает обращаться к модели на `reset_timeout` секунд, затем
+    пропускает один пробный вызов.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probe_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """Можно ли сейчас обращаться к модели."""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if state == self.HALF_OPEN and (
+                self._probe_at is None or now - self._probe_at >= self.reset_timeout):
+            # Один пробный вызов решает, замыкать ли цепь снова (зависший
+            # или отмененный пробный вызов не блокирует цепь навсегда)
+            self._probe_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probe_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+            self._probe_at = None
+
+
+class LLMInvoker:
+    """
+    Общий слой вызова LLM для агентов.
+
+    Каждый вызов ограничен сроком `deadline` (на все попытки вместе).
+    Повторяемые ошибки (таймауты, 429, 5xx) повторяются с экспоненциальной
+    задержкой со случайным разбросом. Если включено хеджирование и вызов
+    длится дольше p95 последних вызовов, параллельно отправляется второй
+    такой же запрос — берется первый ответ. Серия неудач размыкает
+    предохранитель: вызовы сразу уходят на запасной вариант.
+    """
+
+    def __init__(self, name, deadline=60.0, retries=2, backoff_base=0.5,
+                 backoff_max=8.0, hedge=False, hedge_min_samples=20,
+                 breaker=None, logger=None):
+        """
+        Args:
+            name (str): Название маршрута (агента) для метрик и логов
+            deadline (float): Срок на вызов со всеми попытками, сек
+            retries (int): Число повторов после первой попытки
+            backoff_base (float): Базовая задержка перед повтором, сек
+            backoff_max (float): Максимальная задержка перед повтором, сек
+            hedge (bool): Отправлять ли запасной параллельный запрос
+            hedge_min_samples (int): Сколько вызовов нужно для оценки p95
+            breaker (CircuitBreaker): Предохранитель (по умолчанию свой)
+            logger: Логгер для диагностических сообщений
+        """
+        self.name = name
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.logger = logger
+        self.latency = LatencyTracker()
+        self._counters = {
+            "calls": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "failures": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "fallbacks": 0,
+            "short_circuited": 0,
+        }
+
+    def _count(self, key):
+        self._counters[key] += 1
+        metrics.inc(f"llm_invoker_{key}_total", agent=self.name)
+
+    def _backoff(self, attempt):
+        # Full jitter: равномерно от нуля до экспоненциальной границы
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _hedge_delay(self):
+        if not self.hedge or self.latency.stats()["count"] < self.hedge_min_samples:
+            return None
+        return self.latency.percentile(95)
+
+    async def _attempt(self, factory, timeout):
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await asyncio.wait_for(factory(), timeout)
+
+        primary = asyncio.ensure_future(factory())
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                self._count("hedged")
+                tasks.add(asyncio.ensure_future(factory()))
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout - hedge_delay,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+            winner = next(iter(done))
+            if winner is not primary:
+                self._count("hedge_wins")
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _fallback(self, fallback, error):
+        if fallback is None:
+            raise LLMUnavailable(f"{self.name}: {error}") from error
+        self._count("fallbacks")
+        return await fallback()
+
+    def record_fallback(self):
+        """Учитывает запасной ответ, построенный вызывающим кодом (вне call)."""
+        self._count("fallbacks")
+
+    async def call(self, factory, fallback=None):
+        """
+        Выполняет вызов LLM с ограничением срока, повторами и хеджированием.
+
+        Args:
+            factory (callable): Функция без аргументов, возвращающая новую
+                корутину запроса (вызывается на каждую попытку)
+            fallback (callable): Корутина-функция запасного ответа
+                (другая модель или заготовленный текст)
+
+        Returns:
+            Результат запроса или запасного варианта
+
+        Raises:
+            LLMUnavailable: Если запрос не удался и запасного варианта нет
+        """
+        self._count("calls")
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            return await self._fallback(fallback, LLMUnavailable("предохранитель разомкнут"))
+
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                result = await self._attempt(factory, remaining)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self._count("timeouts")
+                delay = self._backoff(attempt)
+                if (is_retryable(e) and attempt < self.retries
+                        and time.monotonic() + delay < deadline):
+                    attempt += 1
+                    self._count("retries")
+                    if self.logger:
+                        self.logger.warning(
+                            f"LLM {self.name}: {type(e).__name__}, повтор {attempt} "
+                            f"через {delay:.2f} с"
+                        )
+                    await asyncio.sleep(delay)
+                    continue
+                self._failed(e)
+                return await self._fallback(fallback, e)
+
+            self.breaker.record_success()
+            elapsed = time.perf_counter() - started
+            self.latency.observe(elapsed)
+            metrics.observe_stage("llm_call", elapsed, agent=self.name)
+            return result
+
+    def _failed(self, error):
+        self._count("failures")
+        self.breaker.record_failure()
+        if self.logger:
+            self.logger.error(f"LLM {self.name}: вызов не удался: {type(error).__name__}: {error}")
+
+    async def stream(self, factory, first_token_timeout=None, idle_timeout=30.0):
+        """
+        Потоковый вызов LLM с ограничением срока.
+
+        Повторяется только попытка, не успевшая выдать ни одного фрагмента:
+        начатый ответ уже показан клиенту. Хеджирование для потока
+        не применяется.
+
+        Args:
+            factory (callable): Функция без аргументов, возвращающая новый
+                асинхронный итератор фрагментов
+            first_token_timeout (float): Срок до первого фрагмента, сек
+                (по умолчанию — весь deadline)
+            idle_timeout (float): Максимальная пауза между фрагментами, сек
+
+        Yields:
+            Фрагменты ответа
+
+        Raises:
+            LLMUnavailable: Если поток не удалось получить
+        """
+        self._count("calls")
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise LLMUnavailable(f"{self.name}: предохранитель разомкнут")
+
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            iterator = factory().__aiter__()
+            emitted = False
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    if emitted:
+                        timeout = min(idle_timeout, remaining)
+                    else:
+                        timeout = min(first_token_timeout or remaining, remaining)
+                    try:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+                    except StopAsyncIteration:
+                        break
+                    emitted = True
+                    yield chunk
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self._count("timeouts")
+                delay = self._backoff(attempt)
+                if (not emitted and is_retryable(e) and attempt < self.retries
+                        and time.monotonic() + delay < deadline):
+                    attempt += 1
+                    self._count("retries")
+                    await asyncio.sleep(delay)
+                    continue
+                self._failed(e)
+                raise LLMUnavailable(f"{self.name}: {e}") from e
+            finally:
+                aclose = getattr(iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+            self.breaker.record_success()
+            elapsed = time.perf_counter() - started
+            self.latency.observe(elapsed)
+            metrics.observe_stage("llm_call", elapsed, agent=self.name)
+            return
+
+    def stats(self):
+        """Счетчики вызовов, состояние предохранителя и задержка."""
+        stats = dict(self._counters)
+        stats["breaker_open"] = self.breaker.state != CircuitBreaker.CLOSED
+        stats["breaker_trips"] = self.breaker.trips
+        stats["latency_seconds"] = self.latency.stats()
+        return stats
+
+
+def invoker_from_env(name, deadline, logger=None):
+    """
+    Создает слой вызова для агента по переменным окружения.
+
+    LLM_DEADLINE_<AGENT> задает срок для агента (иначе `deadline`),
+    LLM_RETRIES, LLM_HEDGE, LLM_BREAKER_FAILURES и LLM_BREAKER_RESET —
+    общие настройки.
+    """
+    return LLMInvoker(
+        name,
+        deadline=float(os.getenv(f"LLM_DEADLINE_{name.upper()}", str(deadline))),
+        retries=int(os.getenv("LLM_RETRIES", "2")),
+        hedge=os.getenv("LLM_HEDGE", "0") == "1",
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("LLM_BREAKER_RESET", "30"))
+        ),
+        logger=logger
+    )
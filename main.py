@@ -1,4 +1,5 @@
 import os
+import signal
 import logging
 import asyncio
 from aiogram import Bot, Dispatcher
@@ -6,10 +7,23 @@ from aiogram.types import Message
 from aiogram.filters.command import Command
 from dotenv import load_dotenv
 
-# Импорты для работы с LangChain и агентами
-from agents.therapist_agent import TherapistAgent
-from agents.observer_agent import ObserverAgent
-from agents.corrector_agent import CorrectorAgent
+# Агенты и LangChain импортируются в init_components (см. startup.py)
+from conversation_store import ConversationStore
+from coalescer import MessageCoalescer
+from prompt_registry import PromptRegistry
+from review_pipeline import ReviewPipeline
+from telegram_delivery import StreamingReply, PLACEHOLDER
+from admission import AdmissionController, QUEUED_REPLY
+from chat_debug import ChatDebug
+from search_tool import (
+    get_tavily_search_tool, get_search_cache, get_async_search_client, close_search_clients
+)
+from startup import StartupTimer, import_heavy_modules, warm_up
+from scheduler import ChatScheduler, LLMRateLimiter
+import db
+import metrics
+import prompts
+import webhook
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -30,49 +44,65 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=os.getenv("TELEGRAM_TOKEN"))
 dp = Dispatcher()
 
-dialogue_history = []
+# Прием обновлений стартует раньше, чем готовы агенты: обработчики ждут
+# components_ready, а этапы запуска замеряет startup_timer
+startup_timer = StartupTimer()
+components_ready = asyncio.Event()
 
-@dp.message(Command("start"))
-async def start_handler(message: Message):
-    await message.answer("Привет! Я AI-терапевт. Расскажи, что тебя беспокоит.")
+@dp.update.outer_middleware()
+async def wait_for_components(handler, event, data):
+    if not components_ready.is_set():
+        await components_ready.wait()
+    startup_timer.mark("first_update")
+    return await handler(event, data)
 
-@dp.message()
-async def handle_message(message: Message):
-    global current_prompt
+# История диалогов по чатам с ограничением по памяти
+conversation_store = ConversationStore(
+    max_turns=int(os.getenv("CONVERSATION_MAX_TURNS", "50")),
+    memory_budget_bytes=int(os.getenv("CONVERSATION_MEMORY_MB", "64")) * 1024 * 1024,
+    loader=db.load_recent_dialogue,
+    logger=logger
+)
 
-    client_input = message.text
-    current_dialog = {"user_message": client_input}
-    dialogue_history.append(current_dialog)
+# Потоковая доставка ответов через редактирование сообщения
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
 
-    # Ответ психолога
-    psych_response = await psych_chain.generate_response(
-        user_message=client_input, 
-        dialog_history=dialogue_history
-    )
-    current_dialog["bot_message"] = psych_response
-    await message.answer(psych_response)
-
-    # Наблюдатель
-    history_text = []
-    for entry in dialogue_history[-6:]:
-        if "user_message" in entry:
-            history_text.append(f"Клиент: {entry['user_message']}")
-        if "bot_message" in entry:
-            history_text.append(f"Психолог: {entry['bot_message']}")
-    
-    dialogue_text = "\n".join(history_text)
-    observer_output = await observer_chain.run(dialogue=dialogue_text)
-
-    # Корректор (если есть замечания)
-    if "ошибка" in observer_output.lower() or "проблема" in observer_output.lower():
-        new_prompt = await rewriter_chain.run(
-            old_prompt=current_prompt, 
-            analysis=observer_output
-        )
-        current_prompt = new_prompt
-        await message.answer(
-            "⚠️ Обнаружены проблемы в ответах. Промпт психолога обновлён."
-        )
+# Порядок сообщений внутри чата и общий лимит на вызовы OpenAI
+chat_scheduler = ChatScheduler()
+llm_limiter = LLMRateLimiter(
+    requests_per_minute=int(os.getenv("OPENAI_RPM", "500")),
+    tokens_per_minute=int(os.getenv("OPENAI_TPM", "80000")),
+    max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+)
+
+def _thresholds(name, default):
+    return tuple(float(value) for value in os.getenv(name, default).split(","))
+
+# Ступени деградации при перегрузке: без супервизии, без поиска,
+# короткие ответы, подтверждение получения
+admission = AdmissionController(
+    llm_limiter,
+    load_thresholds=_thresholds("ADMISSION_LOAD_THRESHOLDS", "1,1.5,2.5,4"),
+    wait_thresholds=_thresholds("ADMISSION_WAIT_THRESHOLDS", "1,3,6,10"),
+    hold_seconds=float(os.getenv("ADMISSION_HOLD", "10")),
+    logger=logger
+)
+
+# Режим /debug: разбивка времени ответа по этапам в отдельных чатах
+chat_debug = ChatDebug(
+    profile_rate=float(os.getenv("DEBUG_PROFILE_RATE", "0.1")),
+    profile_dir=os.getenv("DEBUG_PROFILE_DIR", "debug_profiles"),
+    admin_ids=[
+        int(user_id) for user_id in os.getenv("DEBUG_ADMIN_IDS", "").split(",")
+        if user_id.strip()
+    ],
+    logger=logger
+)
+
+@dp.message(Command("start"))
+async def start_handler(message: Message):
+    await message.answer("Привет! Я AI-терапевт. Расскажи, что тебя беспокоит.")
 
 @dp.message(Command("search"))
 async def handle_search_command(message: Message):
@@ -89,43 +119,403 @@ async def handle_search_command(message: Message):
     search_query = command_args[1]
     await message.answer(f"🔍 Ищу информацию по запросу: '{search_query}'...")
     
-    # Используем инструмент поиска напрямую
-    from search_tool import get_search_tool
-    search_tool = get_search_tool()
-    
     try:
-        # Создаем корутину для выполнения поиска
-        def run_search():
-            return search_tool.run(search_query)
-        
-        # Выполняем поиск асинхронно, чтобы не блокировать бота
-        result = await asyncio.to_thread(run_search)
-        await message.answer(result)
+        # Общий асинхронный клиент: без отдельного потока и нового соединения
+        for part in await get_tavily_search_tool().asearch_messages(search_query):
+            await message.answer(part)
     except Exception as e:
         logger.error(f"Ошибка при выполнении поиска: {str(e)}")
         await message.answer(f"Произошла ошибка при выполнении поиска: {str(e)}")
 
-async def main():
-    # Инициализация агентов
-    global psych_chain, observer_chain, rewriter_chain, current_prompt
-    
-    # Базовый промпт для психолога
-    current_prompt = """
-    Вы - профессиональный психолог-консультант. Ваша задача - помогать клиентам, 
-    проявляя эмпатию и используя научно-обоснованные методы терапии.
+@dp.message(Command("rollback"))
+async def handle_rollback_command(message: Message):
+    """Обработчик команды /rollback: возврат к предыдущей версии промпта чата"""
+    version = await prompt_registry.arollback(message.chat.id)
+    if version is None:
+        await message.answer("Промпт психолога для этого чата не менялся.")
+        return
+    scope = "общая" if version.scope == "global" else "версия чата"
+    await message.answer(
+        f"↩️ Промпт психолога возвращен к предыдущей версии ({scope} №{version.version})."
+    )
+
+@dp.message(Command("debug"))
+async def handle_debug_command(message: Message):
+    """Обработчик команды /debug [profile]: сводка по этапам после каждого ответа"""
+    command_args = message.text.split(maxsplit=1)
+    profile = len(command_args) > 1 and command_args[1].strip().lower() == "profile"
+    user_id = message.from_user.id if message.from_user else None
+    denied = profile and not chat_debug.allows_profile(user_id)
+    profile = profile and not denied
+    chat_debug.enable(message.chat.id, profile=profile)
+    text = "🛠 Режим отладки включен: после ответа придет разбивка по этапам."
+    if denied:
+        text += " Профилирование доступно только администраторам."
+    if profile:
+        text += (
+            f" Часть реплик ({chat_debug.profile_rate:.0%}) профилируется, "
+            f"профили сохраняются в {chat_debug.profile_dir}."
+        )
+    await message.answer(text + " Выключить: /nodebug")
+
+@dp.message(Command("nodebug"))
+async def handle_nodebug_command(message: Message):
+    """Обработчик команды /nodebug: выключение режима отладки"""
+    chat_debug.disable(message.chat.id)
+    await message.answer("Режим отладки выключен.")
+
+@dp.message()
+async def handle_message(message: Message):
+    # Стикеры, фото и голосовые сообщения без текста психолог не разберет
+    if not message.text:
+        await message.answer(
+            "Я понимаю только текстовые сообщения. Напишите, пожалуйста, словами, "
+            "что вас беспокоит."
+        )
+        return
+    # Сообщения, отправленные подряд, склеиваются в одну реплику
+    await coalescer.submit(message.chat.id, message.text)
+
+async def process_turn(chat_id, client_input, commit=None):
+    # Реплики одного чата обрабатываются строго по очереди
+    await chat_scheduler.run(
+        chat_id, lambda: process_message(chat_id, client_input, commit)
+    )
+
+async def process_message(chat_id, client_input, commit=None):
+    with chat_debug.trace(chat_id) as trace:
+        with metrics.stage("handle_message"):
+            await _process_message(chat_id, client_input, commit)
+    if trace is not None:
+        await bot.send_message(chat_id, trace.format(chat_debug.last_review(chat_id)))
+
+async def _process_message(chat_id, client_input, commit=None):
+    await conversation_store.load(chat_id)
+    current_turn = conversation_store.append_user_message(chat_id, client_input)
+    # Ограничения реплики по текущей нагрузке
+    decision = admission.admit()
+
+    # Ответ психолога
+    reply = None
+    try:
+        if STREAM_REPLIES:
+            # Сразу показываем заглушку и дописываем ответ по мере генерации
+            # При перегрузке заглушка сообщает, что ответ задержится
+            reply = StreamingReply(
+                bot, chat_id,
+                placeholder=QUEUED_REPLY if decision.acknowledge else PLACEHOLDER,
+                min_edit_interval=STREAM_EDIT_INTERVAL,
+                logger=logger
+            )
+            await reply.start()
+            async for token in psych_chain.stream_response(
+                user_message=client_input,
+                chat_id=chat_id,
+                allow_search=decision.search,
+                capped=decision.capped
+            ):
+                await reply.push(token)
+        else:
+            if decision.acknowledge:
+                await bot.send_message(chat_id, QUEUED_REPLY)
+            psych_response = await psych_chain.generate_response(
+                user_message=client_input, 
+                chat_id=chat_id,
+                allow_search=decision.search,
+                capped=decision.capped
+            )
+    except asyncio.CancelledError:
+        # Клиент дописал сообщение — реплика будет построена заново
+        conversation_store.discard_turn(chat_id, current_turn)
+        if reply is not None:
+            await reply.abort()
+        raise
+
+    # Дальше ответ уже не отменяется новыми фрагментами
+    if commit is not None:
+        commit()
+    if reply is not None:
+        psych_response = await reply.finish()
+        metrics.observe_stage("telegram_send", reply.send_seconds)
+    else:
+        with metrics.stage("telegram_send"):
+            await bot.send_message(chat_id, psych_response)
+    conversation_store.set_bot_message(chat_id, current_turn, psych_response)
+
+    db.save_dialogue(chat_id, client_input, "user")
+    db.save_dialogue(chat_id, psych_response, "bot")
+
+    # Наблюдатель и корректор работают в фоне, не задерживая ответ.
+    # Отправляется только новая пара реплик: наблюдатель помнит резюме беседы
+    review_pipeline.submit(
+        chat_id,
+        f"Клиент: {client_input}\nПсихолог: {psych_response}"
+    )
+
+# Склейка сообщений, отправленных подряд (COALESCE_QUIET_PERIOD=0 — без ожидания)
+coalescer = MessageCoalescer(
+    process_turn,
+    quiet_period=float(os.getenv("COALESCE_QUIET_PERIOD", "0.5")),
+    max_wait=float(os.getenv("COALESCE_MAX_WAIT", "3.0")),
+    logger=logger
+)
+
+async def get_current_prompt(chat_id):
+    return (await prompt_registry.aactive(chat_id)).text
+
+async def apply_prompt(chat_id, new_prompt):
+    # Новая версия промпта действует только в чате, где прошла супервизия
+    await prompt_registry.apublish(new_prompt, chat_id, source="corrector")
+
+async def notify_chat(chat_id, text):
+    await bot.send_message(chat_id, text)
+
+def register_metric_collectors(therapist):
+    """Подключает показатели компонентов к экспорту метрик."""
+    metrics.registry.register_collector("conversation_store", conversation_store.stats)
+    metrics.registry.register_collector("history_window", therapist.history.stats)
+    metrics.registry.register_collector("therapist_path", therapist.path_stats)
+    metrics.registry.register_collector("search_router", therapist.search_router.stats)
+    metrics.registry.register_collector("review", review_pipeline.stats)
+    metrics.registry.register_collector("prompt_registry", prompt_registry.stats)
+    metrics.registry.register_collector("scheduler", chat_scheduler.stats)
+    metrics.registry.register_collector("coalescer", coalescer.stats)
+    metrics.registry.register_collector("llm", lambda: {
+        invoker.name: invoker.stats()
+        for invoker in (
+            therapist.invoker, therapist.summary_invoker,
+            observer_chain.screen_invoker, observer_chain.invoker, rewriter_chain.invoker
+        )
+    })
+    metrics.registry.register_collector("model_router", model_router.stats)
+    metrics.registry.register_collector("observer", observer_chain.stats)
+    metrics.registry.register_collector("llm_limiter", llm_limiter.stats)
+    metrics.registry.register_collector("admission", admission.stats)
+    metrics.registry.register_collector("search_cache", get_search_cache().stats)
+    metrics.registry.register_collector("db_writer", db.get_writer().stats)
+
+async def init_components(llm=None):
     """
+    Создает агентов и запускает фоновые службы.
+
+    Args:
+        llm: Модель для всех агентов вместо ChatOpenAI (используется
+            в бенчмарке с фейковой моделью)
+
+    Returns:
+        TherapistAgent: Агент-психолог
+    """
+    global psych_chain, observer_chain, rewriter_chain, prompt_registry, review_pipeline
+    global model_router
+
+    from agents.therapist_agent import TherapistAgent
+    from agents.observer_agent import ObserverAgent
+    from agents.corrector_agent import CorrectorAgent
+    from model_router import ModelRouter
+
+    # Модели по задачам агентов с общим пулом соединений к OpenAI
+    model_router = ModelRouter(
+        llm=llm,
+        max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+        logger=logger
+    )
+    
+    # Версии промпта психолога (глобальные и по чатам)
+    prompt_registry = PromptRegistry(
+        path=os.getenv("PROMPTS_DB", db.DB_PATH),
+        default_prompt=prompts.therapist_instructions,
+        logger=logger
+    )
     
     # Создание агентов
-    therapist = TherapistAgent(logger=logger)
-    observer = ObserverAgent(logger=logger)
-    corrector = CorrectorAgent(logger=logger)
+    therapist = TherapistAgent(
+        conversation_store=conversation_store,
+        rate_limiter=llm_limiter,
+        router=model_router,
+        prompt_registry=prompt_registry,
+        capped_max_tokens=int(os.getenv("ADMISSION_MAX_TOKENS", "300")),
+        logger=logger
+    )
+    observer = ObserverAgent(
+        rate_limiter=llm_limiter,
+        router=model_router,
+        score_threshold=float(os.getenv("OBSERVER_SCORE_THRESHOLD", "6")),
+        logger=logger
+    )
+    corrector = CorrectorAgent(rate_limiter=llm_limiter, router=model_router, logger=logger)
     
     psych_chain = therapist
     observer_chain = observer
     rewriter_chain = corrector
+
+    review_pipeline = ReviewPipeline(
+        observer=observer_chain,
+        corrector=rewriter_chain,
+        get_prompt=get_current_prompt,
+        apply_prompt=apply_prompt,
+        queue_size=int(os.getenv("REVIEW_QUEUE_SIZE", "100")),
+        workers=int(os.getenv("REVIEW_WORKERS", "2")),
+        sample_rate=float(os.getenv("REVIEW_SAMPLE_RATE", "1.0")),
+        notify=notify_chat,
+        tracer=chat_debug,
+        admission=admission,
+        logger=logger
+    )
+    await review_pipeline.start()
+    components_ready.set()
+    return therapist
+
+async def warm_up_components(timer=startup_timer):
+    """Прогревает цепочки, кодировку и пулы соединений (после init_components)."""
+    await warm_up(timer, psych_chain, model_router, get_async_search_client(), logger)
+
+async def start_components():
+    """
+    Запуск компонентов параллельно с приемом обновлений: тяжелые модули
+    импортируются в фоновом потоке, затем создаются агенты и прогреваются
+    соединения. Длительность этапов пишется в лог.
+    """
+    with startup_timer.phase("import_agents"):
+        await asyncio.to_thread(import_heavy_modules)
+    with startup_timer.phase("construct"):
+        therapist = await init_components()
+    if metrics.is_enabled():
+        register_metric_collectors(therapist)
+    with startup_timer.phase("warm_up"):
+        await warm_up_components()
+    logger.info(f"Запуск: {startup_timer.format()}")
+    return therapist
+
+async def shutdown_components():
+    """Останавливает фоновые службы и дописывает данные на диск."""
+    await review_pipeline.stop()
+    await close_search_clients()
+    prompt_registry.close()
+    await model_router.close()
+    # Дописываем в базу все сообщения из очереди
+    await asyncio.to_thread(db.close)
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+async def set_webhook():
+    """Регистрирует вебхук в Telegram, если задан публичный WEBHOOK_URL."""
+    url = os.getenv("WEBHOOK_URL")
+    if url:
+        await bot.set_webhook(
+            url.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=False
+        )
+
+async def run_webhook(register=True):
+    """
+    Принимает обновления через локальный aiohttp-сервер до SIGTERM/SIGINT.
+
+    При остановке новые обновления отклоняются, принятые дообрабатываются,
+    после чего shutdown_components сбрасывает накопленные данные на диск.
+    """
+    worker = webhook.WebhookWorker(
+        dp, bot,
+        secret=WEBHOOK_SECRET,
+        drain_timeout=float(os.getenv("DRAIN_TIMEOUT", "30")),
+        logger=logger
+    )
+    metrics.registry.register_collector("webhook", worker.stats)
+    runner = await webhook.serve(worker.make_app(WEBHOOK_PATH), WEBHOOK_HOST, WEBHOOK_PORT)
+    if register:
+        await set_webhook()
+    logger.info(
+        f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} "
+        f"(шард {os.getenv('SHARD_INDEX', '0')}/{os.getenv('SHARD_COUNT', '1')})"
+    )
+    try:
+        await webhook.wait_for_signal()
+    finally:
+        await worker.drain()
+        await runner.cleanup()
+
+async def run_sharded():
+    """
+    Фронт-процесс: запускает SHARD_WORKERS процессов-обработчиков и
+    распределяет между ними обновления по согласованному хешу chat_id.
+    """
+    supervisor = webhook.WorkerSupervisor(
+        script=os.path.abspath(__file__),
+        workers=int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1))),
+        base_port=int(os.getenv("SHARD_BASE_PORT", str(WEBHOOK_PORT + 1))),
+        path=WEBHOOK_PATH,
+        stop_timeout=float(os.getenv("DRAIN_TIMEOUT", "30")) + 10,
+        logger=logger
+    )
+    if not await supervisor.start():
+        logger.warning("Не все обработчики ответили на /healthz при запуске")
+
+    router = webhook.ShardRouter(supervisor.urls, secret=WEBHOOK_SECRET, logger=logger)
+    await router.start()
+    runner = await webhook.serve(router.make_app(WEBHOOK_PATH), WEBHOOK_HOST, WEBHOOK_PORT)
+    await set_webhook()
+    logger.info(
+        f"Фронт слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, "
+        f"обработчиков: {supervisor.workers}"
+    )
+    try:
+        await webhook.wait_for_signal()
+    finally:
+        # Сначала перестаем принимать, затем даем обработчикам дообработать
+        await runner.cleanup()
+        await supervisor.stop()
+        await router.close()
+        await bot.session.close()
+
+def _check_startup(task):
+    # Без агентов бот не может отвечать: останавливаемся так же, как по SIGTERM
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Не удалось запустить компоненты: {task.exception()!r}")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+async def main():
+    # polling — один процесс; webhook — один процесс с вебхуком;
+    # sharded — фронт и процессы-обработчики (BOT_MODE=worker)
+    mode = os.getenv("BOT_MODE", "polling")
+    if mode == "sharded":
+        await run_sharded()
+        return
+
+    startup_task = asyncio.create_task(start_components())
+    startup_task.add_done_callback(_check_startup)
+
+    # Метрики: локальный эндпоинт Prometheus и периодическая строка лога
+    metrics_runner = None
+    metrics_task = None
+    if metrics.is_enabled():
+        metrics.registry.register_collector("startup", startup_timer.report)
+        metrics_runner = await metrics.serve(
+            host=os.getenv("METRICS_HOST", "127.0.0.1"),
+            port=int(os.getenv("METRICS_PORT", "9100"))
+        )
+        metrics_task = asyncio.create_task(metrics.log_periodically(
+            logger, float(os.getenv("METRICS_LOG_INTERVAL", "60"))
+        ))
     
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        if mode in ("webhook", "worker"):
+            # Обработчик шарда не регистрирует вебхук — это делает фронт
+            await run_webhook(register=mode == "webhook")
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if metrics_task is not None:
+            metrics_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if not startup_task.done():
+            startup_task.cancel()
+        if components_ready.is_set():
+            await shutdown_components()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
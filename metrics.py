@@ -0,0 +1,428 @@
+import os
+import re
+import json
+import time
+import asyncio
+import threading
+import contextvars
+
+# Границы корзин гистограмм длительности, сек
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_enabled = os.getenv("METRICS_ENABLED", "0") == "1"
+
+
+# Трассировка отдельных запросов (режим /debug): пока ни один чат ее не
+# включил, этапы не заглядывают даже в контекстную переменную
+_tracing = False
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable(value=True):
+    """Включает или выключает сбор метрик (например, из бенчмарка)."""
+    global _enabled
+    _enabled = value
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _render_labels(labels, extra=None):
+    items = list(labels) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    body = ",".join(f'{key}="{str(value)}"' for key, value in items)
+    return "{" + body + "}"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Registry:
+    """Хранилище метрик процесса и их экспорт в текстовом формате Prometheus."""
+
+    def __init__(self, prefix="therapy"):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        key = _key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def counter(self, name, **labels):
+        key = _key(name, labels)
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, Counter())
+        return counter
+
+    def register_collector(self, name, collect):
+        """
+        Регистрирует источник показателей (gauge).
+
+        Args:
+            name (str): Префикс показателей
+            collect (callable): Функция без аргументов, возвращающая dict
+                (вложенные словари разворачиваются, нечисловые значения
+                пропускаются)
+        """
+        self._collectors[name] = collect
+
+    def _collect_gauges(self):
+        gauges = {}
+        for name, collect in list(self._collectors.items()):
+            try:
+                _flatten(f"{self.prefix}_{name}", collect(), gauges)
+            except Exception:
+                continue
+        return gauges
+
+    def render_prometheus(self):
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        typed = set()
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            full = f"{self.prefix}_{name}"
+            if full not in typed:
+                lines.append(f"# TYPE {full} histogram")
+                typed.add(full)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f"{full}_bucket{_render_labels(labels, {'le': bound})} {cumulative}"
+                )
+            lines.append(
+                f"{full}_bucket{_render_labels(labels, {'le': '+Inf'})} {histogram.count}"
+            )
+            lines.append(f"{full}_sum{_render_labels(labels)} {histogram.sum}")
+            lines.append(f"{full}_count{_render_labels(labels)} {histogram.count}")
+        for (name, labels), counter in sorted(self._counters.items()):
+            full = f"{self.prefix}_{name}"
+            if full not in typed:
+                lines.append(f"# TYPE {full} counter")
+                typed.add(full)
+            lines.append(f"{full}{_render_labels(labels)} {counter.value}")
+        for name, value in sorted(self._collect_gauges().items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Краткая сводка для периодической строки лога."""
+        stages = {}
+        for (name, labels), histogram in self._histograms.items():
+            if not histogram.count:
+                continue
+            label = ",".join(f"{key}={value}" for key, value in labels)
+            stages[f"{name}{{{label}}}" if label else name] = {
+                "count": histogram.count,
+                "avg": round(histogram.sum / histogram.count, 4),
+                "p95_le": histogram.quantile(0.95),
+            }
+        counters = {}
+        for (name, labels), counter in self._counters.items():
+            label = ",".join(f"{key}={value}" for key, value in labels)
+            counters[f"{name}{{{label}}}" if label else name] = counter.value
+        return {"stages": stages, "counters": counters, "gauges": self._collect_gauges()}
+
+
+def _flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', str(key))}", item, out)
+    elif isinstance(value, bool):
+        out[prefix] = int(value)
+    elif isinstance(value, (int, float)):
+        out[prefix] = value
+
+
+registry = Registry()
+
+
+class _Stage:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+class _TracedStage(_Stage):
+    __slots__ = ("name", "labels", "trace")
+
+    def __init__(self, histogram, name, labels, trace):
+        self.histogram = histogram
+        self.name = name
+        self.labels = labels
+        self.trace = trace
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.started
+        if self.histogram is not None:
+            self.histogram.observe(seconds)
+        self.trace.add_stage(self.name, seconds, self.labels)
+        return False
+
+
+class _NoopStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+def stage(name, **labels):
+    """
+    Контекстный менеджер, измеряющий длительность этапа обработки.
+
+    Работает и как обычный, и как асинхронный контекстный менеджер.
+    Когда метрики выключены, возвращает общий пустой объект без замеров.
+
+    Args:
+        name (str): Название этапа (therapist_llm, search, observer, ...)
+        **labels: Дополнительные метки
+    """
+    trace = _current_trace.get() if _tracing else None
+    if trace is not None:
+        histogram = (
+            registry.histogram("stage_seconds", stage=name, **labels) if _enabled else None
+        )
+        return _TracedStage(histogram, name, labels, trace)
+    if not _enabled:
+        return _NOOP_STAGE
+    return _Stage(registry.histogram("stage_seconds", stage=name, **labels))
+
+
+def observe_stage(name, seconds, **labels):
+    """Записывает уже измеренную длительность этапа."""
+    if _enabled:
+        registry.histogram("stage_seconds", stage=name, **labels).observe(seconds)
+    if _tracing:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_stage(name, seconds, labels)
+
+
+def set_tracing(value):
+    """Включает проверку трассировки в этапах (есть хотя бы один чат в /debug)."""
+    global _tracing
+    _tracing = value
+
+
+def start_trace(trace):
+    """
+    Привязывает трассировку к текущему контексту: этапы и токены, измеренные
+    в нем (и в порожденных задачах), добавляются в `trace`.
+
+    Returns:
+        Токен для stop_trace
+    """
+    return _current_trace.set(trace)
+
+
+def stop_trace(token):
+    _current_trace.reset(token)
+
+
+def trace_tokens(prompt_tokens, completion_tokens, cached_tokens=0, **labels):
+    """Добавляет токены вызова LLM в трассировку текущего запроса."""
+    if _tracing:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_tokens(prompt_tokens, completion_tokens, cached_tokens, labels)
+
+
+def inc(name, amount=1, **labels):
+    """Увеличивает счетчик, если метрики включены."""
+    if _enabled:
+        registry.counter(name, **labels).inc(amount)
+
+
+def extract_token_usage(response):
+    """
+    Извлекает число токенов из LLMResult.
+
+    Returns:
+        tuple: (prompt_tokens, completion_tokens)
+    """
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+    # При потоковой генерации usage приходит в метаданных сообщения
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            metadata = getattr(message, "usage_metadata", None) or {}
+            prompt_tokens += metadata.get("input_tokens", 0)
+            completion_tokens += metadata.get("output_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+
+def extract_cached_tokens(response):
+    """
+    Извлекает из LLMResult число токенов запроса, взятых из кэша промптов
+    OpenAI (prompt_tokens_details.cached_tokens).
+    """
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+    cached_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            metadata = getattr(message, "usage_metadata", None) or {}
+            cached_tokens += (metadata.get("input_token_details") or {}).get("cache_read") or 0
+    return cached_tokens
+
+
+_callback_class = None
+
+
+def _token_usage_callback_class():
+    # langchain_core импортируется только при включенных метриках
+    global _callback_class
+    if _callback_class is None:
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        class TokenUsageCallback(BaseCallbackHandler):
+            """Учитывает токены запроса и ответа по данным usage из ответов OpenAI."""
+
+            def __init__(self, agent):
+                self.agent = agent
+
+            def on_llm_end(self, response, **kwargs):
+                prompt_tokens, completion_tokens = extract_token_usage(response)
+                if prompt_tokens or completion_tokens:
+                    cached_tokens = extract_cached_tokens(response)
+                    inc("llm_prompt_tokens_total", prompt_tokens, agent=self.agent)
+                    inc("llm_cached_prompt_tokens_total", cached_tokens, agent=self.agent)
+                    inc("llm_uncached_prompt_tokens_total", prompt_tokens - cached_tokens,
+                        agent=self.agent)
+                    inc("llm_completion_tokens_total", completion_tokens, agent=self.agent)
+                inc("llm_calls_total", agent=self.agent)
+
+        _callback_class = TokenUsageCallback
+    return _callback_class
+
+
+def llm_callbacks(agent):
+    """Колбэки LangChain для учета токенов агента (пусто, если метрики выключены)."""
+    if not _enabled:
+        return []
+    return [_token_usage_callback_class()(agent)]
+
+
+async def serve(host="127.0.0.1", port=9100):
+    """
+    Запускает локальный HTTP-эндпоинт /metrics.
+
+    Returns:
+        aiohttp.web.AppRunner: Раннер, который нужно остановить при выходе
+    """
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(
+            text=registry.render_prometheus(),
+            content_type="text/plain",
+            charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def log_periodically(logger, interval=60.0):
+    """Раз в `interval` секунд пишет сводку метрик одной строкой JSON."""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("metrics " + json.dumps(registry.summary(), ensure_ascii=False))
@@ -0,0 +1,252 @@
+import os
+import time
+import threading
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_openai import ChatOpenAI
+
+from latency import LatencyTracker
+from scheduler import LLMRateLimiter, NO_LIMIT
+import metrics
+
+# Маршруты: задача агента -> (модель по умолчанию, температура).
+# Модель маршрута переопределяется переменной MODEL_<МАРШРУТ>.
+# У запасной модели психолога нет значения по умолчанию: она берется
+# из LLM_FALLBACK_MODEL, если не задана MODEL_THERAPIST_FALLBACK.
+ROUTES = {
+    "therapist": ("gpt-4", 0.7),
+    "therapist_fallback": (None, 0.7),
+    "history_summary": ("gpt-4o-mini", 0.3),
+    "observer_screen": ("gpt-4o-mini", 0.3),
+    "observer": ("gpt-4", 0.3),
+    "corrector": ("gpt-4", 0.4),
+}
+
+# Цена за 1000 токенов (запрос, ответ), USD
+PRICES_PER_1K = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4o": (0.0025, 0.01),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+
+# Токены запроса из кэша промптов OpenAI стоят вдвое дешевле
+CACHED_PROMPT_DISCOUNT = 0.5
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """Стоимость вызова в USD по таблице цен (0 для неизвестной модели)."""
+    prompt_price, completion_price = PRICES_PER_1K.get(model, (0.0, 0.0))
+    prompt_cost = (prompt_tokens - cached_tokens * CACHED_PROMPT_DISCOUNT) * prompt_price
+    return (prompt_cost + completion_tokens * completion_price) / 1000
+
+
+class _RouteStats:
+    __slots__ = ("model", "calls", "errors", "prompt_tokens", "cached_tokens",
+                 "completion_tokens", "cost_usd", "latency")
+
+    def __init__(self, model):
+        self.model = model
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self.latency = LatencyTracker()
+
+
+class RouteCallback(BaseCallbackHandler):
+    """Записывает задержку, токены и стоимость каждого вызова маршрута."""
+
+    # Вызывается в контексте запроса: токены попадают в трассировку /debug
+    run_inline = True
+
+    def __init__(self, route, stats, lock):
+        self.route = route
+        self.stats = stats
+        self.lock = lock
+        self._started = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        prompt_tokens, completion_tokens = metrics.extract_token_usage(response)
+        cached_tokens = metrics.extract_cached_tokens(response)
+        cost = estimate_cost(self.stats.model, prompt_tokens, completion_tokens, cached_tokens)
+        with self.lock:
+            self.stats.calls += 1
+            self.stats.prompt_tokens += prompt_tokens
+            self.stats.cached_tokens += cached_tokens
+            self.stats.completion_tokens += completion_tokens
+            self.stats.cost_usd += cost
+            if started is not None:
+                self.stats.latency.observe(time.perf_counter() - started)
+        if started is not None:
+            metrics.observe_stage(
+                "llm_route", time.perf_counter() - started, route=self.route
+            )
+        metrics.inc("llm_cost_usd_total", cost, route=self.route)
+        metrics.trace_tokens(prompt_tokens, completion_tokens, cached_tokens, route=self.route)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._started.pop(run_id, None)
+        with self.lock:
+            self.stats.errors += 1
+
+
+class ModelRouter:
+    """
+    Выбор модели для каждой задачи агентов.
+
+    Для каждого маршрута (ответ психолога, скрининг наблюдателя,
+    углубленная супервизия, коррекция промпта, свертка истории) создается
+    своя модель, но все они работают через один общий пул HTTP-соединений
+    к OpenAI. По каждому маршруту копятся задержка, токены и стоимость —
+    по ним настраивается политика на реальном трафике.
+    """
+
+    def __init__(self, llm=None, max_connections=100, logger=None):
+        """
+        Args:
+            llm: Модель для всех маршрутов вместо ChatOpenAI (бенчмарк)
+            max_connections (int): Размер общего пула соединений с OpenAI
+            logger: Логгер для диагностических сообщений
+        """
+        self.logger = logger
+        self._override = llm
+        self._models = {}
+        self._stats = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._http_client = None
+        self._http_async_client = None
+        if llm is None:
+            limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections // 2
+            )
+            timeout = httpx.Timeout(120.0, connect=5.0)
+            self._http_client = httpx.Client(limits=limits, timeout=timeout)
+            self._http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+        # Отдельный лимит на коррекцию промпта: она дорогая и не срочная
+        self._limiters["corrector"] = LLMRateLimiter(
+            requests_per_minute=int(os.getenv("CORRECTOR_RPM", "6")),
+            tokens_per_minute=int(os.getenv("CORRECTOR_TPM", "20000")),
+            max_concurrency=int(os.getenv("CORRECTOR_MAX_CONCURRENCY", "1"))
+        )
+
+    def model_name(self, route):
+        default, _ = ROUTES[route]
+        if route == "therapist_fallback":
+            default = os.getenv("LLM_FALLBACK_MODEL") or default
+        return os.getenv(f"MODEL_{route.upper()}", default)
+
+    def model(self, route):
+        """
+        Модель маршрута (создается один раз).
+
+        Returns:
+            Модель LangChain или None, если у маршрута модель не задана
+        """
+        if route in self._models:
+            return self._models[route]
+        name = self.model_name(route)
+        if name is None:
+            self._models[route] = None
+            return None
+
+        stats = self._stats[route] = _RouteStats(name)
+        callbacks = [RouteCallback(route, stats, self._lock)] + metrics.llm_callbacks(route)
+        if self._override is not None:
+            # Копия общей модели со своими колбэками маршрута
+            model = self._override.model_copy(update={"callbacks": callbacks})
+        else:
+            _, temperature = ROUTES[route]
+            model = ChatOpenAI(
+                model=name,
+                temperature=temperature,
+                api_key=os.getenv("OPENAI_API_KEY"),
+                max_retries=0,
+                stream_usage=True,
+                http_client=self._http_client,
+                http_async_client=self._http_async_client,
+                callbacks=callbacks
+            )
+        self._models[route] = model
+        if self.logger:
+            self.logger.info(f"Маршрут {route}: модель {name}")
+        return model
+
+    def limiter(self, route):
+        """Собственный лимит маршрута (в дополнение к общему лимиту OpenAI)."""
+        return self._limiters.get(route, NO_LIMIT)
+
+    def models(self):
+        """Созданные модели маршрутов."""
+        return [model for model in self._models.values() if model is not None]
+
+    def stats(self):
+        """Вызовы, ошибки, токены, стоимость и задержка по маршрутам."""
+        with self._lock:
+            return {
+                route: {
+                    "model": stats.model,
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "prompt_tokens": stats.prompt_tokens,
+                    "cached_prompt_tokens": stats.cached_tokens,
+                    # Доля токенов запроса из кэша промптов OpenAI
+                    "cache_hit_ratio": round(
+                        stats.cached_tokens / stats.prompt_tokens, 4
+                    ) if stats.prompt_tokens else 0.0,
+                    "completion_tokens": stats.completion_tokens,
+                    "cost_usd": round(stats.cost_usd, 6),
+                    "latency_seconds": stats.latency.stats(),
+                }
+                for route, stats in self._stats.items()
+            }
+
+    async def warm_up(self):
+        """
+        Открывает соединение с OpenAI в общем пуле до первого запроса
+        (бесплатный GET /models: DNS, TCP и TLS не ложатся на ответ клиенту).
+        """
+        if self._http_async_client is None:
+            return None
+        base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+        response = await self._http_async_client.get(
+            f"{base_url}/models",
+            headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"}
+        )
+        return response.status_code
+
+    async def close(self):
+        """Закрывает общий пул соединений."""
+        if self._http_async_client is not None:
+            await self._http_async_client.aclose()
+        if self._http_client is not None:
+            self._http_client.close()
+
+
+_router = None
+
+
+def get_model_router(logger=None):
+    """Общий маршрутизатор моделей процесса."""
+    global _router
+    if _router is None:
+        _router = ModelRouter(
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+            logger=logger
+        )
+    return _router
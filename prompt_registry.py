@@ -0,0 +1,291 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import db
+
+# Область глобальных версий; версии чата хранятся в области str(chat_id)
+GLOBAL_SCOPE = "global"
+
+
+def _scope(chat_id):
+    return GLOBAL_SCOPE if chat_id is None else str(chat_id)
+
+
+class PromptVersion:
+    """Одна версия промпта психолога."""
+
+    __slots__ = ("id", "scope", "version", "text", "source", "created_at")
+
+    def __init__(self, id, scope, version, text, source, created_at):
+        self.id = id
+        self.scope = scope
+        self.version = version
+        self.text = text
+        self.source = source
+        self.created_at = created_at
+
+
+class PromptRegistry:
+    """
+    Версионированный реестр промптов психолога в SQLite.
+
+    Версии хранятся глобально и для отдельных чатов: чат без собственной
+    версии использует активную глобальную. Коррекция промпта создает новую
+    версию только для своего чата, не затрагивая остальных.
+
+    Активные версии кэшируются в памяти (LRU по чатам), а собранные из
+    версии объекты — шаблоны и цепочки LangChain — кэшируются по
+    идентификатору версии, поэтому переключение версий и откат не требуют
+    пересборки цепочек.
+
+    Из цикла событий реестр вызывается через `aactive`, `apublish`
+    и `arollback`: чтение при промахе кэша и запись в SQLite выполняются
+    в отдельном потоке.
+    """
+
+    def __init__(self, path=db.DB_PATH, default_prompt=None, max_chats=10000,
+                 max_compiled=256, logger=None):
+        """
+        Args:
+            path (str): Путь к файлу базы
+            default_prompt (str): Промпт для первой глобальной версии,
+                если в базе еще нет ни одной
+            max_chats (int): Сколько активных версий чатов держать в памяти
+            max_compiled (int): Сколько собранных объектов держать в памяти
+            logger: Логгер для диагностических сообщений
+        """
+        self.max_chats = max_chats
+        self.max_compiled = max_compiled
+        self.logger = logger
+        self._conn = db.connect(path)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS prompt_versions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            source TEXT,
+            created_at TEXT,
+            UNIQUE (scope, version)
+        )
+        """)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS prompt_active (
+            scope TEXT PRIMARY KEY,
+            version_id INTEGER NOT NULL
+        )
+        """)
+        self._conn.commit()
+        # _lock защищает кэши в памяти, _db_lock — соединение: цикл событий
+        # не ждет запись в базу, чтобы прочитать версию из кэша
+        self._lock = threading.RLock()
+        self._db_lock = threading.Lock()
+        # scope -> PromptVersion или None (у чата нет собственной версии)
+        self._active = OrderedDict()
+        self._compiled = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "compiled": 0, "compiled_hits": 0}
+
+        if default_prompt is not None and self._load_active(GLOBAL_SCOPE) is None:
+            self.publish(default_prompt, source="default")
+
+    def _row_to_version(self, row):
+        return PromptVersion(*row) if row else None
+
+    def _load_active(self, scope):
+        row = self._conn.execute(
+            "SELECT v.id, v.scope, v.version, v.text, v.source, v.created_at "
+            "FROM prompt_active a JOIN prompt_versions v ON v.id = a.version_id "
+            "WHERE a.scope = ?",
+            (scope,)
+        ).fetchone()
+        return self._row_to_version(row)
+
+    def _cached_active(self, scope):
+        with self._lock:
+            if scope in self._active:
+                self._active.move_to_end(scope)
+                self._stats["hits"] += 1
+                return self._active[scope]
+            self._stats["misses"] += 1
+        with self._db_lock:
+            version = self._load_active(scope)
+        with self._lock:
+            if scope in self._active:
+                # Пока шло чтение, версию опубликовали или уже прочитали
+                return self._active[scope]
+            self._remember(scope, version)
+            return version
+
+    def _remember(self, scope, version):
+        self._active[scope] = version
+        self._active.move_to_end(scope)
+        while len(self._active) > self.max_chats:
+            # Глобальная версия нужна всем чатам — ее не вытесняем
+            oldest = next(iter(self._active))
+            if oldest == GLOBAL_SCOPE:
+                self._active.move_to_end(oldest)
+                oldest = next(iter(self._active))
+            del self._active[oldest]
+
+    def active(self, chat_id=None):
+        """
+        Активная версия промпта для чата.
+
+        Args:
+            chat_id (int): Идентификатор чата или None для глобальной версии
+
+        Returns:
+            PromptVersion: Версия чата, а если ее нет — глобальная
+        """
+        if chat_id is not None:
+            version = self._cached_active(_scope(chat_id))
+            if version is not None:
+                return version
+        return self._cached_active(GLOBAL_SCOPE)
+
+    def _is_cached(self, chat_id):
+        with self._lock:
+            scope = _scope(chat_id)
+            if scope not in self._active:
+                return False
+            return self._active[scope] is not None or GLOBAL_SCOPE in self._active
+
+    async def aactive(self, chat_id=None):
+        """Как `active`, но при промахе кэша читает базу в отдельном потоке."""
+        if self._is_cached(chat_id):
+            return self.active(chat_id)
+        return await asyncio.to_thread(self.active, chat_id)
+
+    def publish(self, text, chat_id=None, source="manual"):
+        """
+        Сохраняет новую версию промпта и делает ее активной.
+
+        Args:
+            text (str): Текст промпта
+            chat_id (int): Чат, для которого создается версия (None — глобально)
+            source (str): Происхождение версии (default, corrector, manual)
+
+        Returns:
+            PromptVersion: Созданная версия
+        """
+        scope = _scope(chat_id)
+        created_at = datetime.now().isoformat()
+        with self._db_lock, self._conn:
+            (last,) = self._conn.execute(
+                "SELECT COALESCE(MAX(version), 0) FROM prompt_versions WHERE scope = ?",
+                (scope,)
+            ).fetchone()
+            cursor = self._conn.execute(
+                "INSERT INTO prompt_versions (scope, version, text, source, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (scope, last + 1, text, source, created_at)
+            )
+            version = PromptVersion(
+                cursor.lastrowid, scope, last + 1, text, source, created_at
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO prompt_active (scope, version_id) VALUES (?, ?)",
+                (scope, version.id)
+            )
+            with self._lock:
+                self._remember(scope, version)
+        if self.logger:
+            self.logger.info(f"Промпт {scope}: опубликована версия {version.version} ({source})")
+        return version
+
+    async def apublish(self, text, chat_id=None, source="manual"):
+        """Как `publish`, но запись в базу идет в отдельном потоке."""
+        return await asyncio.to_thread(self.publish, text, chat_id, source)
+
+    def rollback(self, chat_id=None):
+        """
+        Возвращает предыдущую версию промпта.
+
+        Если у чата нет более ранней собственной версии, чат возвращается
+        к глобальному промпту.
+
+        Returns:
+            PromptVersion: Новая активная версия чата или None, если
+                откатывать нечего
+        """
+        scope = _scope(chat_id)
+        with self._db_lock, self._conn:
+            current = self._load_active(scope)
+            if current is None:
+                return None
+            row = self._conn.execute(
+                "SELECT id, scope, version, text, source, created_at "
+                "FROM prompt_versions WHERE scope = ? AND version < ? "
+                "ORDER BY version DESC LIMIT 1",
+                (scope, current.version)
+            ).fetchone()
+            previous = self._row_to_version(row)
+            if previous is not None:
+                self._conn.execute(
+                    "UPDATE prompt_active SET version_id = ? WHERE scope = ?",
+                    (previous.id, scope)
+                )
+            elif scope != GLOBAL_SCOPE:
+                self._conn.execute("DELETE FROM prompt_active WHERE scope = ?", (scope,))
+            else:
+                return None
+            with self._lock:
+                self._remember(scope, previous)
+        if self.logger:
+            target = previous.version if previous else GLOBAL_SCOPE
+            self.logger.info(f"Промпт {scope}: откат с версии {current.version} на {target}")
+        return self.active(chat_id)
+
+    async def arollback(self, chat_id=None):
+        """Как `rollback`, но запись в базу идет в отдельном потоке."""
+        return await asyncio.to_thread(self.rollback, chat_id)
+
+    def history(self, chat_id=None, limit=20):
+        """Последние версии промпта чата (или глобальные), от новых к старым."""
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT id, scope, version, text, source, created_at "
+                "FROM prompt_versions WHERE scope = ? ORDER BY version DESC LIMIT ?",
+                (_scope(chat_id), limit)
+            ).fetchall()
+        return [PromptVersion(*row) for row in rows]
+
+    def compiled(self, version, name, build):
+        """
+        Возвращает объект, собранный из версии промпта, из кэша.
+
+        Args:
+            version (PromptVersion): Версия промпта
+            name (str): Вид объекта (например, "therapist")
+            build (callable): build(text) — собирает объект при промахе кэша
+
+        Returns:
+            Собранный объект (шаблон, цепочка, набор цепочек)
+        """
+        key = (version.id, name)
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is not None:
+                self._compiled.move_to_end(key)
+                self._stats["compiled_hits"] += 1
+                return compiled
+        compiled = build(version.text)
+        with self._lock:
+            self._compiled[key] = compiled
+            self._stats["compiled"] += 1
+            while len(self._compiled) > self.max_compiled:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    def stats(self):
+        """Попадания в кэши активных версий и собранных объектов."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached_chats"] = len(self._active)
+            stats["cached_compiled"] = len(self._compiled)
+        return stats
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,211 @@
+import asyncio
+import random
+import contextlib
+
+
+class ReviewPipeline:
+    """
+    Фоновая очередь супервизии ответов психолога.
+
+    Наблюдатель и корректор работают вне обработчика сообщений: обработчик
+    только ставит новую реплику в очередь и сразу освобождается. Для каждого
+    чата в очереди хранится не более одного задания — реплики, пришедшие до
+    его обработки, присоединяются к нему и оцениваются одним вызовом. При
+    переполнении очереди задания отбрасываются, а не замедляют ответы.
+    """
+
+    def __init__(self, observer, corrector, get_prompt, apply_prompt,
+                 queue_size=100, workers=2, sample_rate=1.0,
+                 notify=None, tracer=None, admission=None, logger=None):
+        """
+        Args:
+            observer (ObserverAgent): Агент-наблюдатель
+            corrector (CorrectorAgent): Агент-корректор
+            get_prompt (callable): Корутина get_prompt(chat_id) -> текст
+                текущего промпта психолога
+            apply_prompt (callable): Корутина apply_prompt(chat_id, prompt) —
+                сохраняет обновленный промпт
+            queue_size (int): Максимальное число чатов в очереди
+            workers (int): Число параллельных обработчиков
+            sample_rate (float): Доля сообщений, отправляемых на супервизию
+            notify (callable): Корутина notify(chat_id, text) для уведомлений
+            tracer (ChatDebug): Трассировка супервизии для чатов в режиме /debug
+            admission (AdmissionController): При перегрузке супервизия
+                пропускается, чтобы не отнимать вызовы LLM у ответов
+            logger: Логгер для диагностических сообщений
+        """
+        self.observer = observer
+        self.corrector = corrector
+        self.get_prompt = get_prompt
+        self.apply_prompt = apply_prompt
+        self.queue_size = queue_size
+        self.workers = workers
+        self.sample_rate = sample_rate
+        self.notify = notify
+        self.tracer = tracer
+        self.admission = admission
+        self.logger = logger
+
+        self._queue = None
+        self._pending = {}
+        # Чаты, супервизия которых идет сейчас: их новые реплики ждут
+        # в _pending и ставятся в очередь только после ее окончания, иначе
+        # второй обработчик начал бы с того же резюме беседы
+        self._running = set()
+        self._tasks = []
+        self._apply_lock = asyncio.Lock()
+        self._counters = {
+            "submitted": 0,
+            "sampled_out": 0,
+            "debounced": 0,
+            "dropped": 0,
+            "shed": 0,
+            "reviewed": 0,
+            "corrected": 0,
+            "stale": 0,
+            "failed": 0,
+        }
+
+    async def start(self):
+        """Запускает обработчики очереди."""
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        """Останавливает обработчики; необработанные задания отбрасываются."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pending.clear()
+        self._running.clear()
+
+    def submit(self, chat_id, dialogue):
+        """
+        Ставит новые реплики в очередь на супервизию, не дожидаясь результата.
+
+        Args:
+            chat_id (int): Идентификатор чата
+            dialogue (str): Текст реплик, еще не отправленных на супервизию
+
+        Returns:
+            bool: True, если окно принято в обработку
+        """
+        self._counters["submitted"] += 1
+        if self._queue is None:
+            self._counters["dropped"] += 1
+            return False
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self._counters["sampled_out"] += 1
+            return False
+        if self._shed():
+            return False
+
+        if chat_id in self._pending:
+            # Чат уже ждет в очереди — дописываем реплики к его заданию
+            self._pending[chat_id] += "\n" + dialogue
+            self._counters["debounced"] += 1
+            return True
+        if chat_id in self._running:
+            # Чат встанет в очередь, когда закончится текущая супервизия
+            self._pending[chat_id] = dialogue
+            self._counters["debounced"] += 1
+            return True
+
+        try:
+            self._queue.put_nowait(chat_id)
+        except asyncio.QueueFull:
+            self._counters["dropped"] += 1
+            return False
+        self._pending[chat_id] = dialogue
+        return True
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._queue.get()
+            dialogue = self._pending.pop(chat_id, None)
+            self._running.add(chat_id)
+            try:
+                # Нагрузка могла вырасти, пока задание ждало в очереди
+                if dialogue is not None and not self._shed():
+                    with self._trace(chat_id):
+                        await self._review(chat_id, dialogue)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counters["failed"] += 1
+                if self.logger:
+                    self.logger.error(f"Ошибка при супервизии чата {chat_id}: {str(e)}")
+            finally:
+                self._running.discard(chat_id)
+                self._requeue(chat_id)
+                self._queue.task_done()
+
+    def _requeue(self, chat_id):
+        # Реплики, пришедшие во время супервизии чата
+        if chat_id not in self._pending:
+            return
+        try:
+            self._queue.put_nowait(chat_id)
+        except asyncio.QueueFull:
+            del self._pending[chat_id]
+            self._counters["dropped"] += 1
+
+    def _shed(self):
+        # При перегрузке вызовы LLM нужнее ответам клиентам
+        if self.admission is None or self.admission.allows_review():
+            return False
+        self._counters["shed"] += 1
+        return True
+
+    def _trace(self, chat_id):
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.trace(chat_id, review=True)
+
+    async def _review(self, chat_id, dialogue):
+        assessment = await self.observer.review(chat_id, dialogue)
+        if assessment is None:
+            self._counters["failed"] += 1
+            return
+        self._counters["reviewed"] += 1
+
+        # Решение о коррекции принимается по порогам оценок, а не по тексту
+        if not self.observer.needs_correction(assessment):
+            return
+
+        # Модуль наблюдателя (с LangChain) к этому моменту уже загружен
+        from agents.observer_agent import format_assessment
+
+        old_prompt = await self.get_prompt(chat_id)
+        new_prompt = await self.corrector.run(
+            old_prompt=old_prompt,
+            analysis=format_assessment(assessment)
+        )
+        if new_prompt is None:
+            self._counters["failed"] += 1
+            return
+
+        # Промпт применяется целиком и только если за время работы корректора
+        # его не успела обновить другая супервизия. Сравнивается текст:
+        # кэш реестра может вытеснить и перечитать ту же версию
+        async with self._apply_lock:
+            if await self.get_prompt(chat_id) != old_prompt:
+                self._counters["stale"] += 1
+                return
+            await self.apply_prompt(chat_id, new_prompt)
+            self._counters["corrected"] += 1
+
+        if self.notify is not None:
+            await self.notify(
+                chat_id,
+                "⚠️ Обнаружены проблемы в ответах. Промпт психолога обновлён."
+            )
+
+    def stats(self):
+        """Счетчики очереди супервизии."""
+        stats = dict(self._counters)
+        stats["queue_depth"] = self._queue.qsize() if self._queue else 0
+        return stats
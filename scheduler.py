@@ -0,0 +1,281 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from latency import LatencyTracker
+
+# Приоритеты вызовов LLM: меньшее значение обслуживается раньше
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+
+class ChatScheduler:
+    """
+    Планировщик обработки сообщений: строгий FIFO внутри чата,
+    параллельная обработка разных чатов.
+
+    aiogram обрабатывает обновления конкурентно, поэтому без планировщика
+    ответы на быстрые сообщения одного чата могут прийти не по порядку.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._waiting = {}
+        self.wait_latency = LatencyTracker()
+        self.processed = 0
+
+    async def run(self, chat_id, job):
+        """
+        Выполняет `job()` после завершения всех ранее поставленных задач чата.
+
+        Args:
+            chat_id (int): Идентификатор чата
+            job (callable): Функция без аргументов, возвращающая корутину
+
+        Returns:
+            Результат корутины
+        """
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._waiting[chat_id] = self._waiting.get(chat_id, 0) + 1
+
+        queued_at = time.perf_counter()
+        try:
+            # asyncio.Lock пропускает ожидающих в порядке очереди
+            async with lock:
+                self.wait_latency.observe(time.perf_counter() - queued_at)
+                return await job()
+        finally:
+            self.processed += 1
+            self._waiting[chat_id] -= 1
+            if not self._waiting[chat_id]:
+                # Последняя задача чата — освобождаем его структуры
+                del self._waiting[chat_id]
+                del self._locks[chat_id]
+
+    def stats(self):
+        """Глубина очередей и время ожидания."""
+        depths = self._waiting.values()
+        return {
+            "active_chats": len(self._waiting),
+            "queued_messages": sum(depths) - len(self._waiting),
+            "max_chat_depth": max(depths, default=0),
+            "processed": self.processed,
+            "wait_seconds": self.wait_latency.stats(),
+        }
+
+
+class _TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Запрос больше емкости ведра ждет, пока ведро не заполнится целиком
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class LLMRateLimiter:
+    """
+    Общий лимит на вызовы OpenAI для всех агентов.
+
+    Ограничивает число одновременных запросов, а также запросы и токены
+    в минуту (token bucket). Ожидающие вызовы обслуживаются по приоритету:
+    ответы пользователю идут раньше фоновой супервизии.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=80000,
+                 max_concurrency=16):
+        """
+        Args:
+            requests_per_minute (int): Лимит запросов в минуту
+            tokens_per_minute (int): Лимит токенов в минуту
+            max_concurrency (int): Максимум одновременных запросов
+        """
+        self.requests = _TokenBucket(requests_per_minute)
+        self.tokens = _TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._pump_task = None
+        self.wait_latency = {
+            PRIORITY_USER: LatencyTracker(),
+            PRIORITY_BACKGROUND: LatencyTracker(),
+        }
+        self.granted = {PRIORITY_USER: 0, PRIORITY_BACKGROUND: 0}
+
+    def slot(self, tokens, priority=PRIORITY_USER, requests=1):
+        """
+        Контекстный менеджер для одного обращения к LLM.
+
+        Args:
+            tokens (int): Оценка числа токенов запроса и ответа
+            priority (int): PRIORITY_USER или PRIORITY_BACKGROUND
+            requests (int): Сколько запросов к API займет обращение
+
+        Returns:
+            Асинхронный контекстный менеджер
+        """
+        return _Slot(self, tokens, priority, requests)
+
+    def _try_take(self, tokens, requests):
+        if self.in_flight >= self.max_concurrency:
+            return False
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        if self.requests.wait_time(requests) or self.tokens.wait_time(tokens):
+            return False
+        self.requests.tokens -= min(requests, self.requests.capacity)
+        self.tokens.tokens -= min(tokens, self.tokens.capacity)
+        self.in_flight += 1
+        return True
+
+    async def acquire(self, tokens, priority=PRIORITY_USER, requests=1):
+        queued_at = time.perf_counter()
+        if not self._waiters and self._try_take(tokens, requests):
+            self._granted(priority, queued_at)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._waiters,
+            (priority, next(self._seq), tokens, requests, future, queued_at)
+        )
+        self._ensure_pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий отменен — возвращаем его
+                self.release()
+            raise
+        self._granted(priority, queued_at)
+
+    def _granted(self, priority, queued_at):
+        self.granted[priority] = self.granted.get(priority, 0) + 1
+        self.wait_latency.setdefault(priority, LatencyTracker()).observe(
+            time.perf_counter() - queued_at
+        )
+
+    def release(self):
+        self.in_flight -= 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _ensure_pump(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+        else:
+            # Новый ожидающий может иметь более высокий приоритет
+            self._wakeup.set()
+
+    async def _pump(self):
+        """Выдает слоты ожидающим в порядке приоритета по мере пополнения лимитов."""
+        while self._waiters:
+            priority, _, tokens, requests, future, _ = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            if self._try_take(tokens, requests):
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+                continue
+
+            if self.in_flight >= self.max_concurrency:
+                delay = None
+            else:
+                delay = max(
+                    self.requests.wait_time(requests),
+                    self.tokens.wait_time(tokens)
+                )
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def load(self, priority=PRIORITY_USER):
+        """
+        Текущая нагрузка для контроля допуска.
+
+        Returns:
+            tuple: (вызовов в работе, ожидающих вызовов, сколько секунд ждет
+                самый давний вызов с приоритетом `priority`)
+        """
+        waiting = 0
+        oldest = None
+        for waiter_priority, _, _, _, future, queued_at in self._waiters:
+            if future.done():
+                continue
+            waiting += 1
+            if waiter_priority == priority and (oldest is None or queued_at < oldest):
+                oldest = queued_at
+        wait = time.perf_counter() - oldest if oldest is not None else 0.0
+        return self.in_flight, waiting, wait
+
+    def stats(self):
+        """Текущая загрузка, очереди по приоритетам и время ожидания слота."""
+        waiting = {}
+        for priority, _, _, _, future, _ in self._waiters:
+            if not future.done():
+                waiting[priority] = waiting.get(priority, 0) + 1
+        return {
+            "in_flight": self.in_flight,
+            "waiting": waiting,
+            "granted": dict(self.granted),
+            "wait_seconds": {
+                priority: tracker.stats()
+                for priority, tracker in self.wait_latency.items()
+            },
+        }
+
+
+class _Slot:
+    __slots__ = ("limiter", "tokens", "priority", "requests")
+
+    def __init__(self, limiter, tokens, priority, requests):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.priority = priority
+        self.requests = requests
+
+    async def __aenter__(self):
+        await self.limiter.acquire(self.tokens, self.priority, self.requests)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.limiter.release()
+        return False
+
+
+class _NoLimit:
+    """Заглушка лимитера для агентов, созданных без общего лимита."""
+
+    def slot(self, tokens, priority=PRIORITY_USER, requests=1):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_LIMIT = _NoLimit()
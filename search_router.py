@@ -0,0 +1,470 @@
+import os
+import re
+import json
+import math
+import time
+import random
+import logging
+import argparse
+
+import db
+import metrics
+from latency import LatencyTracker
+
+logger = logging.getLogger("search_router")
+
+# Основы слов, по которым видно, что клиенту нужны внешние сведения.
+# Основы покрывают словоформы: «статья», «статьи», «статей», «исследованиях»
+SEARCH_STEMS = (
+    r"стат(?:ь|ей)", r"исследова", r"научн", r"наук", r"уч[её]н(?:ы|ые|ых)",
+    r"доказа", r"факт", r"метод", r"техник", r"упражнени", r"ссылк", r"источник",
+    r"провер", r"статистик", r"эксперимент", r"мета-?анализ", r"литератур",
+    r"книг", r"найд[иу]", r"поищ", r"погугл", r"загугл", r"поиск",
+    r"по данным", r"согласно", r"research", r"stud(?:y|ies)", r"paper", r"evidence",
+)
+_PATTERN = re.compile(r"(?<!\w)(?:" + "|".join(SEARCH_STEMS) + ")", re.IGNORECASE)
+_NON_LETTERS = re.compile(r"[\W\d_]+")
+
+# Признаки классификатора: символьные n-граммы слов (с границами слов)
+NGRAM_RANGE = (3, 5)
+# Намерение видно в начале сообщения — длинные тексты не разбираются целиком
+MAX_CHARS = 300
+# Сколько слов помнит кэш сумм весов (словарь клиентов невелик)
+WORD_CACHE_SIZE = 50000
+PATTERN_FEATURE = "<pattern>"
+
+
+def matches(text):
+    """Первая ступень: есть ли в тексте основа из SEARCH_STEMS."""
+    return _PATTERN.search(text) is not None
+
+
+def words(text):
+    """Различные слова сообщения (в нижнем регистре, ё -> е)."""
+    return set(_NON_LETTERS.sub(" ", text[:MAX_CHARS].lower().replace("ё", "е")).split())
+
+
+def word_grams(word, ngram_range=NGRAM_RANGE):
+    """Символьные n-граммы слова вместе с границами слова."""
+    min_n, max_n = ngram_range
+    padded = f" {word} "
+    length = len(padded)
+    return {
+        padded[i:i + size]
+        for size in range(min_n, max_n + 1)
+        for i in range(length - size + 1)
+    }
+
+
+def features(text, ngram_range=NGRAM_RANGE):
+    """N-граммы сообщения: по множеству n-грамм каждого различного слова."""
+    grams = []
+    for word in words(text):
+        grams.extend(word_grams(word, ngram_range))
+    return grams
+
+
+def _sigmoid(value):
+    if value < -30:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-value))
+
+
+class SearchModel:
+    """
+    Логистическая регрессия по n-граммам и срабатыванию первой ступени.
+
+    Признаки складываются по словам, поэтому сумма весов n-грамм слова
+    считается один раз и дальше берется из кэша: решение стоит несколько
+    десятков поисков в словаре, а не разбор сообщения на n-граммы.
+    """
+
+    def __init__(self, weights, bias=0.0, threshold=0.5, ngram_range=NGRAM_RANGE,
+                 report=None):
+        self.weights = weights
+        self.bias = bias
+        self.threshold = threshold
+        self.ngram_range = tuple(ngram_range)
+        self.report = report or {}
+        self._word_scores = {}
+
+    def _word_score(self, word):
+        score = self._word_scores.get(word)
+        if score is None:
+            weights = self.weights
+            score = sum(weights.get(gram, 0.0) for gram in word_grams(word, self.ngram_range))
+            if len(self._word_scores) >= WORD_CACHE_SIZE:
+                self._word_scores.clear()
+            self._word_scores[word] = score
+        return score
+
+    def probability(self, text, matched):
+        value = self.bias
+        for word in words(text):
+            value += self._word_score(word)
+        if matched:
+            value += self.weights.get(PATTERN_FEATURE, 0.0)
+        return _sigmoid(value)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "ngram_range": list(self.ngram_range),
+                "bias": self.bias,
+                "threshold": self.threshold,
+                "report": self.report,
+                "weights": self.weights,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(
+            data["weights"], data["bias"], data["threshold"],
+            data["ngram_range"], data.get("report")
+        )
+
+
+class SearchRouter:
+    """
+    Решает, нужен ли поиск в интернете для сообщения клиента.
+
+    Первая ступень — скомпилированное регулярное выражение по основам слов
+    (ловит словоформы, а не только точные ключевые слова). Если обучена
+    модель, ее вероятность по n-граммам сообщения и срабатыванию первой
+    ступени сравнивается с порогом: так отсекаются ложные срабатывания
+    («какой метод мне подходит?») и находятся перефразировки без ключевых
+    слов. Без модели решение принимает первая ступень. Все решение —
+    в памяти процесса, без сети.
+    """
+
+    def __init__(self, model=None, threshold=None, logger=None):
+        """
+        Args:
+            model (SearchModel): Обученная модель или None
+            threshold (float): Порог вероятности (по умолчанию — подобранный
+                при обучении)
+            logger: Логгер для диагностических сообщений
+        """
+        self.model = model
+        if threshold is None:
+            threshold = model.threshold if model is not None else 0.5
+        self.threshold = threshold
+        self.logger = logger
+        self.latency = LatencyTracker()
+        self._counters = {"decisions": 0, "search": 0, "pattern_hits": 0}
+
+    @classmethod
+    def from_file(cls, path, threshold=None, logger=None):
+        """Загружает модель из `path`; если файла нет — только первая ступень."""
+        model = None
+        if path and os.path.exists(path):
+            try:
+                model = SearchModel.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                if logger:
+                    logger.warning(f"Модель маршрутизации поиска не загружена: {str(e)}")
+        if logger:
+            logger.info(
+                f"Маршрутизация поиска: {'модель ' + path if model else 'ключевые основы'}"
+            )
+        return cls(model, threshold, logger)
+
+    def score(self, text):
+        """
+        Returns:
+            tuple: (вероятность, что поиск нужен; сработала ли первая ступень)
+        """
+        matched = matches(text)
+        if self.model is None:
+            return (1.0 if matched else 0.0), matched
+        return self.model.probability(text, matched), matched
+
+    def should_search(self, text):
+        started = time.perf_counter()
+        score, matched = self.score(text)
+        decision = score >= self.threshold
+        elapsed = time.perf_counter() - started
+
+        self.latency.observe(elapsed)
+        self._counters["decisions"] += 1
+        self._counters["search"] += decision
+        self._counters["pattern_hits"] += matched
+        metrics.observe_stage("search_route", elapsed)
+        return decision
+
+    def stats(self):
+        """Решения, их время и качество модели на отложенной выборке."""
+        stats = dict(self._counters)
+        stats["threshold"] = self.threshold
+        stats["model"] = self.model is not None
+        stats["latency_seconds"] = self.latency.stats()
+        if self.model is not None:
+            stats.update({
+                key: value for key, value in self.model.report.items()
+                if key in ("precision", "recall", "f1")
+            })
+        return stats
+
+
+_router = None
+
+
+def get_search_router(logger=None):
+    """Общий маршрутизатор поиска процесса (SEARCH_ROUTER_MODEL, SEARCH_ROUTER_THRESHOLD)."""
+    global _router
+    if _router is None:
+        threshold = os.getenv("SEARCH_ROUTER_THRESHOLD")
+        _router = SearchRouter.from_file(
+            os.getenv("SEARCH_ROUTER_MODEL", "search_router.json"),
+            float(threshold) if threshold else None,
+            logger
+        )
+    return _router
+
+
+# Обучение и оценка (офлайн, по размеченным репликам dialogs.db)
+
+def _ensure_labels(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS search_labels (
+        dialog_id INTEGER PRIMARY KEY,
+        label INTEGER NOT NULL
+    )
+    """)
+    conn.commit()
+
+
+def load_samples(path, bootstrap=False):
+    """
+    Реплики клиентов с разметкой «нужен поиск» (1) или «не нужен» (0).
+
+    Разметка хранится в таблице search_labels (dialog_id -> label).
+    С `bootstrap` неразмеченные реплики размечаются первой ступенью —
+    для первой модели, пока ручной разметки мало.
+
+    Returns:
+        list[tuple]: (текст, метка)
+    """
+    conn = db.connect(path)
+    try:
+        _ensure_labels(conn)
+        samples = conn.execute(
+            "SELECT d.message, l.label FROM search_labels l "
+            "JOIN dialogs d ON d.id = l.dialog_id WHERE d.role = 'user'"
+        ).fetchall()
+        if bootstrap:
+            rows = conn.execute(
+                "SELECT message FROM dialogs WHERE role = 'user' "
+                "AND id NOT IN (SELECT dialog_id FROM search_labels)"
+            )
+            samples.extend((message, int(matches(message))) for message, in rows)
+    finally:
+        conn.close()
+    return [(message, int(label)) for message, label in samples if message]
+
+
+def label(path, dialog_ids, value):
+    """Размечает реплики клиентов (INSERT OR REPLACE)."""
+    conn = db.connect(path)
+    try:
+        _ensure_labels(conn)
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO search_labels (dialog_id, label) VALUES (?, ?)",
+                [(dialog_id, value) for dialog_id in dialog_ids]
+            )
+    finally:
+        conn.close()
+
+
+def _vectorize(samples, ngram_range):
+    vectors = []
+    for text, target in samples:
+        grams = features(text, ngram_range)
+        if matches(text):
+            grams.append(PATTERN_FEATURE)
+        vectors.append((grams, target))
+    return vectors
+
+
+def train(samples, epochs=5, learning_rate=0.2, l2=1e-5, min_weight=1e-3,
+          ngram_range=NGRAM_RANGE, seed=0):
+    """
+    Обучает логистическую регрессию стохастическим градиентом.
+
+    Классы взвешиваются обратно их частоте: реплик, которым нужен поиск,
+    обычно намного меньше. Веса меньше `min_weight` по модулю отбрасываются,
+    чтобы файл модели и словарь весов оставались небольшими.
+
+    Returns:
+        SearchModel: Модель с порогом 0.5 (подбирается отдельно)
+    """
+    vectors = _vectorize(samples, ngram_range)
+    positives = sum(target for _, target in vectors) or 1
+    negatives = (len(vectors) - positives) or 1
+    class_weight = {
+        1: len(vectors) / (2 * positives),
+        0: len(vectors) / (2 * negatives),
+    }
+    weights = {}
+    bias = 0.0
+    rng = random.Random(seed)
+    for epoch in range(epochs):
+        rng.shuffle(vectors)
+        rate = learning_rate / (1 + epoch)
+        for grams, target in vectors:
+            value = bias
+            for gram in grams:
+                value += weights.get(gram, 0.0)
+            gradient = (_sigmoid(value) - target) * class_weight[target]
+            bias -= rate * gradient
+            for gram in grams:
+                weight = weights.get(gram, 0.0)
+                weights[gram] = weight - rate * (gradient + l2 * weight)
+    weights = {
+        gram: round(weight, 5) for gram, weight in weights.items()
+        if abs(weight) >= min_weight
+    }
+    return SearchModel(weights, bias, 0.5, ngram_range)
+
+
+def evaluate(score, samples, threshold):
+    """
+    Точность и полнота решений `score(text) >= threshold` и время решения.
+
+    Args:
+        score (callable): score(text) -> вероятность
+        samples: (текст, метка)
+    """
+    tp = fp = fn = 0
+    timings = LatencyTracker(window=len(samples) or 1)
+    for text, target in samples:
+        started = time.perf_counter()
+        decision = score(text) >= threshold
+        timings.observe(time.perf_counter() - started)
+        tp += decision and target
+        fp += decision and not target
+        fn += not decision and target
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    latency = timings.stats()
+    return {
+        "samples": len(samples),
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(f1, 4),
+        "decision_us": {
+            "p50": round(latency["p50"] * 1e6, 1),
+            "p95": round(latency["p95"] * 1e6, 1),
+            "max": round(latency["max"] * 1e6, 1),
+        },
+    }
+
+
+def best_threshold(model, samples):
+    """Порог с наибольшей F1 на отложенной выборке."""
+    scored = [(model.probability(text, matches(text)), target) for text, target in samples]
+    best, best_key = 0.5, None
+    positives = sum(target for _, target in scored)
+    for threshold in (i / 100 for i in range(5, 96)):
+        tp = sum(1 for score, target in scored if score >= threshold and target)
+        predicted = sum(1 for score, _ in scored if score >= threshold)
+        if not tp:
+            continue
+        # При равной F1 — порог ближе к 0.5, он устойчивее на новых данных
+        key = (round(2 * tp / (predicted + positives), 4), -abs(threshold - 0.5))
+        if best_key is None or key > best_key:
+            best, best_key = threshold, key
+    return best
+
+
+def split(samples, test_share, seed=0):
+    samples = list(samples)
+    random.Random(seed).shuffle(samples)
+    cut = int(len(samples) * (1 - test_share))
+    return samples[:cut], samples[cut:]
+
+
+def run_train(args):
+    samples = load_samples(args.db, bootstrap=args.bootstrap)
+    if not samples:
+        raise SystemExit(
+            "Нет размеченных реплик: заполните search_labels (команда label) "
+            "или запустите с --bootstrap"
+        )
+    train_set, test_set = split(samples, args.test_share, args.seed)
+    started = time.perf_counter()
+    model = train(train_set, epochs=args.epochs, seed=args.seed)
+    train_seconds = time.perf_counter() - started
+    model.threshold = (
+        args.threshold if args.threshold is not None else best_threshold(model, test_set)
+    )
+    report = evaluate(lambda text: model.probability(text, matches(text)), test_set,
+                      model.threshold)
+    model.report = dict(report, train=len(train_set), features=len(model.weights))
+    model.save(args.output)
+    return {
+        "output": args.output,
+        "threshold": model.threshold,
+        "train_seconds": round(train_seconds, 2),
+        "model": model.report,
+        # Для сравнения — одна первая ступень на той же выборке
+        "pattern_only": evaluate(lambda text: float(matches(text)), test_set, 0.5),
+    }
+
+
+def run_evaluate(args):
+    samples = load_samples(args.db, bootstrap=args.bootstrap)
+    router = SearchRouter.from_file(args.model, args.threshold)
+    return {
+        "model": args.model if router.model is not None else None,
+        "threshold": router.threshold,
+        "router": evaluate(lambda text: router.score(text)[0], samples, router.threshold),
+        "pattern_only": evaluate(lambda text: float(matches(text)), samples, 0.5),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Обучение и оценка маршрутизации поиска по репликам dialogs.db"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = commands.add_parser("train", help="обучить модель")
+    train_parser.add_argument("--output", default="search_router.json")
+    train_parser.add_argument("--epochs", type=int, default=5)
+    train_parser.add_argument("--test-share", type=float, default=0.2)
+    train_parser.add_argument("--seed", type=int, default=0)
+
+    evaluate_parser = commands.add_parser("evaluate", help="точность, полнота и время")
+    evaluate_parser.add_argument("--model", default="search_router.json")
+
+    for command in (train_parser, evaluate_parser):
+        command.add_argument("--db", default=db.DB_PATH, help="файл базы диалогов")
+        command.add_argument("--threshold", type=float, help="порог вероятности")
+        command.add_argument("--bootstrap", action="store_true",
+                             help="разметить неразмеченные реплики первой ступенью")
+
+    label_parser = commands.add_parser("label", help="разметить реплики клиентов")
+    label_parser.add_argument("--db", default=db.DB_PATH, help="файл базы диалогов")
+    label_parser.add_argument("value", type=int, choices=(0, 1),
+                              help="1 — нужен поиск, 0 — не нужен")
+    label_parser.add_argument("dialog_ids", type=int, nargs="+", help="id строк dialogs")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    if args.command == "label":
+        label(args.db, args.dialog_ids, args.value)
+        return
+    result = run_train(args) if args.command == "train" else run_evaluate(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
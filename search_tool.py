@@ -1,47 +1,660 @@
 import os
+import re
+import json
+import time
+import queue
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+import aiohttp
 from dotenv import load_dotenv
-from langchain.tools import Tool
-from tavily import TavilyClient
+from agents.history_window import count_tokens
+from telegram_delivery import TELEGRAM_MESSAGE_LIMIT, split_message
+import metrics
 
 load_dotenv()
 
+
+def normalize_query(query: str) -> str:
+    """
+    Приводит поисковый запрос к каноническому виду для ключа кэша.
+
+    Регистр, буква «ё», пунктуация и лишние пробелы не влияют на ключ.
+    """
+    query = query.lower().replace("ё", "е")
+    query = re.sub(r"[^\w\s-]", " ", query)
+    return " ".join(query.split())
+
+
+class SearchCache:
+    """
+    Кэш результатов поиска с ограничением по времени жизни и размеру (LRU).
+
+    При указании `db_path` записи дублируются в локальный файл SQLite
+    и переживают перезапуск бота; запись идет в фоновом потоке, поэтому
+    `put` не блокирует цикл событий. Одновременные запросы с одинаковым
+    ключом объединяются: к Tavily уходит только один из них, остальные
+    ждут его результата.
+
+    Синхронный `get_or_fetch` нужен только вне цикла событий (CLI,
+    синхронный вызов инструмента). Его запросы объединяются между собой,
+    но не с асинхронными `aget_or_fetch` бота — у них отдельные таблицы
+    запросов в работе.
+    """
+
+    def __init__(self, ttl: float = 3600, max_size: int = 1000,
+                 db_path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "merged": 0,
+            "evictions": 0,
+            "fetch_count": 0,
+            "fetch_seconds_total": 0.0,
+            "fetch_seconds_max": 0.0,
+            "db_errors": 0,
+        }
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("""
+        CREATE TABLE IF NOT EXISTS search_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at REAL
+        )
+        """)
+        self._db.execute("DELETE FROM search_cache WHERE expires_at < ?", (time.time(),))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT key, value, expires_at FROM search_cache "
+            "ORDER BY expires_at DESC LIMIT ?",
+            (self.max_size,)
+        ).fetchall()
+        for key, value, expires_at in reversed(rows):
+            self._entries[key] = (json.loads(value), expires_at)
+
+        self._writes = queue.SimpleQueue()
+        threading.Thread(
+            target=self._write_loop, name="search-cache-writer", daemon=True
+        ).start()
+
+    def _write_loop(self):
+        while True:
+            # Накопившиеся за время прошлой записи изменения — одной транзакцией
+            batch = [self._writes.get()]
+            while True:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._db:
+                    for key, value, expires_at, evicted in batch:
+                        self._db.executemany(
+                            "DELETE FROM search_cache WHERE key = ?",
+                            [(old_key,) for old_key in evicted]
+                        )
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO search_cache (key, value, expires_at) "
+                            "VALUES (?, ?, ?)",
+                            (key, value, expires_at)
+                        )
+            except sqlite3.Error:
+                # Это только кэш: потерянная запись обойдется лишним запросом к API
+                with self._lock:
+                    self._stats["db_errors"] += 1
+
+    def get(self, key: str):
+        """Возвращает значение из кэша или None, если его нет или оно устарело."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value):
+        """Сохраняет значение, вытесняя самые старые записи при переполнении."""
+        expires_at = time.time() + self.ttl
+        evicted = []
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                old_key, _ = self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+                evicted.append(old_key)
+        if self._writes is not None:
+            self._writes.put(
+                (key, json.dumps(value, ensure_ascii=False), expires_at, evicted)
+            )
+
+    def get_or_fetch(self, query: str, fetch):
+        """
+        Возвращает результат из кэша или вызывает `fetch(query)` один раз
+        для всех одновременных запросов с тем же ключом.
+
+        Только для вызовов вне цикла событий: ожидание блокирует поток.
+
+        Args:
+            query: Поисковый запрос
+            fetch: Функция, выполняющая запрос к API
+
+        Returns:
+            Результат `fetch` (из кэша или свежий)
+        """
+        key = normalize_query(query)
+        value = self.get(key)
+        if value is not None:
+            with self._lock:
+                self._stats["hits"] += 1
+            return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"event": threading.Event(), "value": None, "error": None}
+                self._inflight[key] = flight
+                self._stats["misses"] += 1
+            else:
+                self._stats["merged"] += 1
+
+        if not leader:
+            flight["event"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["value"]
+
+        started = time.perf_counter()
+        try:
+            value = fetch(query)
+            flight["value"] = value
+            self.put(key, value)
+            return value
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._inflight.pop(key, None)
+                self._stats["fetch_count"] += 1
+                self._stats["fetch_seconds_total"] += elapsed
+                self._stats["fetch_seconds_max"] = max(
+                    self._stats["fetch_seconds_max"], elapsed
+                )
+            flight["event"].set()
+
+    async def aget_or_fetch(self, query: str, fetch):
+        """
+        Асинхронный вариант `get_or_fetch` для корутины `fetch(query)`.
+
+        Одновременные запросы с тем же ключом ждут одну общую задачу.
+        """
+        key = normalize_query(query)
+        value = self.get(key)
+        if value is not None:
+            with self._lock:
+                self._stats["hits"] += 1
+            return value
+
+        task = self._async_inflight.get(key)
+        if task is not None:
+            with self._lock:
+                self._stats["merged"] += 1
+            return await asyncio.shield(task)
+
+        with self._lock:
+            self._stats["misses"] += 1
+        task = asyncio.ensure_future(self._afetch(key, query, fetch))
+        self._async_inflight[key] = task
+        # shield: отмена одного из ожидающих не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    async def _afetch(self, key: str, query: str, fetch):
+        started = time.perf_counter()
+        try:
+            value = await fetch(query)
+            self.put(key, value)
+            return value
+        finally:
+            elapsed = time.perf_counter() - started
+            self._async_inflight.pop(key, None)
+            with self._lock:
+                self._stats["fetch_count"] += 1
+                self._stats["fetch_seconds_total"] += elapsed
+                self._stats["fetch_seconds_max"] = max(
+                    self._stats["fetch_seconds_max"], elapsed
+                )
+
+    def stats(self) -> dict:
+        """Статистика попаданий, промахов и задержек запросов к API."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"] + stats["merged"]
+        stats["hit_rate"] = (stats["hits"] + stats["merged"]) / lookups if lookups else 0.0
+        stats["fetch_seconds_avg"] = (
+            stats["fetch_seconds_total"] / stats["fetch_count"]
+            if stats["fetch_count"] else 0.0
+        )
+        return stats
+
+
+_search_cache = None
+
+
+def get_search_cache() -> SearchCache:
+    """Возвращает общий для всех инструментов поиска кэш результатов."""
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = SearchCache(
+            ttl=float(os.getenv("SEARCH_CACHE_TTL", "3600")),
+            max_size=int(os.getenv("SEARCH_CACHE_SIZE", "1000")),
+            db_path=os.getenv("SEARCH_CACHE_DB") or None
+        )
+    return _search_cache
+
+
+class AsyncTavilyClient:
+    """
+    Асинхронный клиент Tavily Search API с общим пулом соединений.
+
+    Один экземпляр живет все время работы бота: соединения с API
+    переиспользуются (keep-alive), каждый запрос ограничен таймаутом,
+    а число одновременных запросов — семафором. Адрес API задается
+    параметром `base_url`, поэтому клиент можно направить на локальную
+    заглушку Tavily.
+    """
+
+    def __init__(self, api_key: str, base_url: str = "https://api.tavily.com",
+                 timeout: float = 15.0, max_concurrency: int = 8,
+                 pool_size: int = 20):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self._session
+
+    async def search(self, query: str, search_depth: str = "advanced",
+                     max_results: int = 5) -> dict:
+        """
+        Выполняет запрос к /search.
+
+        Args:
+            query: Поисковый запрос
+            search_depth: Глубина поиска ("basic" или "advanced")
+            max_results: Максимальное число результатов
+
+        Returns:
+            dict: Ответ API
+        """
+        payload = {
+            "api_key": self.api_key,
+            "query": query,
+            "search_depth": search_depth,
+            "max_results": max_results,
+        }
+        async with self._semaphore:
+            session = self._get_session()
+            async with session.post(f"{self.base_url}/search", json=payload) as response:
+                response.raise_for_status()
+                return await response.json()
+
+    async def warm_up(self):
+        """Открывает соединение с API заранее (DNS, TCP и TLS до первого поиска)."""
+        session = self._get_session()
+        async with session.head(self.base_url) as response:
+            return response.status
+
+    async def close(self):
+        """Закрывает пул соединений."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+_async_client = None
+
+
+def get_async_search_client() -> AsyncTavilyClient:
+    """Возвращает общий асинхронный клиент Tavily."""
+    global _async_client
+    if _async_client is None:
+        api_key = os.getenv("TAVILY_API_KEY")
+        if not api_key:
+            raise ValueError("TAVILY_API_KEY не найден в переменных окружения")
+        _async_client = AsyncTavilyClient(
+            api_key=api_key,
+            base_url=os.getenv("TAVILY_BASE_URL", "https://api.tavily.com"),
+            timeout=float(os.getenv("SEARCH_TIMEOUT", "15")),
+            max_concurrency=int(os.getenv("SEARCH_MAX_CONCURRENCY", "8"))
+        )
+    return _async_client
+
+
+async def close_search_clients():
+    """Закрывает общие клиенты поиска при остановке бота."""
+    if _async_client is not None:
+        await _async_client.close()
+
+
+NOTHING_FOUND = "Не удалось найти информацию по этому запросу."
+
+# Бюджет токенов на выдержку одного результата: в промпте и в ответе /search
+PROMPT_RESULT_TOKENS = int(os.getenv("SEARCH_RESULT_TOKENS", "120"))
+USER_RESULT_TOKENS = 400
+
+# Порог сходства (Жаккар по шинглам), выше которого выдержки считаются дублями
+DUPLICATE_SIMILARITY = 0.7
+
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+
+def _terms(text: str) -> set:
+    # Грубая основа слова: первые 5 букв снимают большую часть окончаний
+    return {word[:5] for word in _WORD_RE.findall(text.lower().replace("ё", "е"))
+            if len(word) > 2}
+
+
+def _shingles(words: list, size: int = 3) -> set:
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _similarity(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _excerpt(content: str, query_terms: set, max_tokens: int) -> str:
+    """
+    Выдержка из текста в пределах бюджета токенов.
+
+    Предложения с терминами запроса берутся в первую очередь, но выводятся
+    в исходном порядке.
+    """
+    if count_tokens(content) <= max_tokens:
+        return content
+    # Повторяющиеся предложения (частые в выдержках Tavily) берутся один раз
+    sentences = list(dict.fromkeys(_SENTENCE_RE.split(content)))
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(query_terms & _terms(sentences[i])), i)
+    )
+    chosen = []
+    budget = max_tokens
+    for i in ranked:
+        tokens = count_tokens(sentences[i])
+        if tokens <= budget:
+            chosen.append(i)
+            budget -= tokens
+    if not chosen:
+        # Даже одно предложение не помещается — режем лучшее по словам
+        words = sentences[ranked[0]].split()
+        text = ""
+        for word in words:
+            candidate = f"{text} {word}" if text else word
+            if count_tokens(candidate) > max_tokens:
+                break
+            text = candidate
+        return text + "…"
+    text = " ".join(sentences[i] for i in sorted(chosen))
+    return text if len(chosen) == len(sentences) else text + " …"
+
+
+def prepare_results(query: str, results: list, max_results: int = 3,
+                    max_tokens: int = PROMPT_RESULT_TOKENS) -> list:
+    """
+    Отбирает результаты поиска для промпта или ответа клиенту.
+
+    Почти одинаковые выдержки (перепечатки одной статьи) и повторы URL
+    отбрасываются, оставшиеся ранжируются по доле терминов запроса
+    и оценке Tavily, каждая выдержка обрезается до `max_tokens`.
+
+    Args:
+        query: Поисковый запрос
+        results: Результаты Tavily
+        max_results: Сколько результатов оставить
+        max_tokens: Бюджет токенов на выдержку одного результата
+
+    Returns:
+        list[dict]: Результаты с ключами title, url, content
+    """
+    query_terms = _terms(query)
+    candidates = []
+    for position, result in enumerate(results):
+        content = " ".join((result.get('content') or '').split())
+        title = result.get('title') or 'Без заголовка'
+        coverage = (
+            len(query_terms & _terms(f"{title} {content}")) / len(query_terms)
+            if query_terms else 0.0
+        )
+        relevance = coverage + float(result.get('score') or 0.0)
+        candidates.append((-relevance, coverage, position, title, content,
+                           result.get('url') or ''))
+    candidates.sort()
+    if any(candidate[1] for candidate in candidates):
+        # Результаты без единого термина запроса не стоят токенов промпта
+        candidates = [candidate for candidate in candidates if candidate[1]]
+
+    kept = []
+    seen_urls = set()
+    seen_shingles = []
+    for _, _, _, title, content, url in candidates:
+        url_key = url.rstrip("/").split("#")[0].lower()
+        if url_key and url_key in seen_urls:
+            continue
+        shingles = _shingles(_WORD_RE.findall(content.lower()))
+        if any(_similarity(shingles, other) >= DUPLICATE_SIMILARITY
+               for other in seen_shingles):
+            continue
+        seen_urls.add(url_key)
+        seen_shingles.append(shingles)
+        kept.append({
+            "title": title,
+            "url": url,
+            "content": _excerpt(content, query_terms, max_tokens),
+        })
+        if len(kept) >= max_results:
+            break
+    metrics.inc("search_results_dropped_total", len(results) - len(kept))
+    return kept
+
+
+def format_result_blocks(query: str, results: list, max_results: int = 5,
+                         max_tokens: int = USER_RESULT_TOKENS) -> list:
+    """
+    Результаты поиска для ответа клиенту — по блоку на результат.
+
+    Returns:
+        list[str]: Заголовок и блоки результатов (для разбивки на сообщения)
+    """
+    if not results:
+        return [NOTHING_FOUND]
+    blocks = ["### Результаты поиска:"]
+    blocks.extend(
+        f"{i}. **{result['title']}**\n   {result['content'] or 'Нет содержания'}\n"
+        f"   Источник: {result['url'] or 'Нет источника'}"
+        for i, result in enumerate(
+            prepare_results(query, results, max_results, max_tokens), 1
+        )
+    )
+    return blocks
+
+
+def pack_blocks(blocks: list, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Собирает блоки в сообщения не длиннее `limit`, не разрывая блок,
+    если он сам помещается в одно сообщение.
+    """
+    messages = []
+    current = ""
+    for block in blocks:
+        for part in split_message(block, limit):
+            candidate = f"{current}\n\n{part}" if current else part
+            if len(candidate) <= limit:
+                current = candidate
+            else:
+                messages.append(current)
+                current = part
+    if current:
+        messages.append(current)
+    return messages
+
+
+def compact_results(query: str, results: list, max_results: int = 3,
+                    max_tokens: int = PROMPT_RESULT_TOKENS) -> str:
+    """
+    Сжимает результаты поиска для подстановки в промпт.
+
+    Args:
+        query: Поисковый запрос
+        results: Результаты Tavily
+        max_results: Сколько результатов оставить
+        max_tokens: Бюджет токенов на выдержку одного результата
+
+    Returns:
+        str: Компактный текст с заголовком, выдержкой и источником
+    """
+    return "\n".join(
+        f"[{i}] {result['title']}: {result['content']} (источник: {result['url'] or 'нет'})"
+        for i, result in enumerate(
+            prepare_results(query, results, max_results, max_tokens), 1
+        )
+    )
+
+
 class TavilySearchTool:
-    def __init__(self):
+    def __init__(self, cache: Optional[SearchCache] = None,
+                 async_client: Optional[AsyncTavilyClient] = None):
         api_key = os.getenv("TAVILY_API_KEY")
         if not api_key:
             raise ValueError("TAVILY_API_KEY не найден в переменных окружения")
-        self.client = TavilyClient(api_key=api_key)
+        self.api_key = api_key
+        self._client = None
+        self.async_client = async_client or get_async_search_client()
+        self.cache = cache if cache is not None else get_search_cache()
+
+    @property
+    def client(self):
+        # Синхронный клиент нужен только вне цикла событий — создаем по требованию
+        if self._client is None:
+            from tavily import TavilyClient
+            self._client = TavilyClient(api_key=self.api_key)
+        return self._client
+
+    async def _afetch(self, query: str) -> list:
+        with metrics.stage("search_fetch"):
+            search_result = await self.async_client.search(
+                query=query,
+                search_depth="advanced",
+                max_results=5
+            )
+        return search_result.get('results') or []
+
+    def _fetch(self, query: str) -> list:
+        with metrics.stage("search_fetch"):
+            search_result = self.client.search(
+                query=query,
+                search_depth="advanced",
+                max_results=5
+            )
+        return search_result.get('results') or []
     
     def search(self, query: str) -> str:
         """
         Поиск информации в интернете с помощью Tavily Search API.
+
+        Синхронный вариант для CLI и вызова инструмента вне цикла событий;
+        бот использует `asearch`.
         
         Args:
             query: Поисковый запрос
             
         Returns:
-            str: Результаты поиска в виде текста
+            str: Сжатые результаты поиска для промпта агента
         """
         try:
-            search_result = self.client.search(
-                query=query,
-                search_depth="advanced",
-                max_results=5
-            )
-            
-            if not search_result.get('results'):
-                return "Не удалось найти информацию по этому запросу."
-            
-            results_text = "### Результаты поиска:\n\n"
-            for i, result in enumerate(search_result.get('results', []), 1):
-                results_text += f"{i}. **{result.get('title', 'Без заголовка')}**\n"
-                results_text += f"   {result.get('content', 'Нет содержания')}\n"
-                results_text += f"   Источник: {result.get('url', 'Нет источника')}\n\n"
-            
-            return results_text
+            results = self.cache.get_or_fetch(query, self._fetch)
+            return compact_results(query, results) or NOTHING_FOUND
+        except Exception as e:
+            return f"Ошибка при выполнении поиска: {str(e)}"
+
+    async def afetch_results(self, query: str) -> list:
+        """Возвращает сырые результаты поиска (через кэш)."""
+        return await self.cache.aget_or_fetch(query, self._afetch)
+
+    async def asearch(self, query: str) -> str:
+        """
+        Асинхронный поиск через общий пул соединений, без отдельного потока.
+
+        Args:
+            query: Поисковый запрос
+
+        Returns:
+            str: Сжатые результаты поиска для промпта агента
+        """
+        try:
+            with metrics.stage("search"):
+                results = await self.afetch_results(query)
+            return compact_results(query, results) or NOTHING_FOUND
+        except asyncio.TimeoutError:
+            return "Ошибка при выполнении поиска: превышено время ожидания ответа"
         except Exception as e:
             return f"Ошибка при выполнении поиска: {str(e)}"
     
+    async def asearch_messages(self, query: str,
+                               limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+        """
+        Поиск для ответа клиенту (команда /search).
+
+        Returns:
+            list[str]: Сообщения не длиннее лимита Telegram
+        """
+        try:
+            with metrics.stage("search"):
+                results = await self.afetch_results(query)
+            return pack_blocks(format_result_blocks(query, results), limit)
+        except asyncio.TimeoutError:
+            return ["Ошибка при выполнении поиска: превышено время ожидания ответа"]
+        except Exception as e:
+            return [f"Ошибка при выполнении поиска: {str(e)}"]
+
     def run(self, query: str) -> str:
         """
         Метод для совместимости с интерфейсом Tool.
@@ -49,14 +662,27 @@ class TavilySearchTool:
         return self.search(query)
 
 
-def get_search_tool() -> Tool:
+_tavily_search_tool = None
+
+
+def get_tavily_search_tool() -> TavilySearchTool:
+    """Возвращает общий экземпляр TavilySearchTool."""
+    global _tavily_search_tool
+    if _tavily_search_tool is None:
+        _tavily_search_tool = TavilySearchTool()
+    return _tavily_search_tool
+
+
+def get_search_tool():
     """
     Создает инструмент LangChain для поиска информации в интернете.
     
     Returns:
         Tool: Инструмент LangChain для поиска
     """
-    search_tool = TavilySearchTool()
+    from langchain.tools import Tool
+
+    search_tool = get_tavily_search_tool()
     
     return Tool(
         name="internet_search",
@@ -67,4 +693,5 @@ def get_search_tool() -> Tool:
             "когда вам нужно проверить информацию."
         ),
         func=search_tool.search,
+        coroutine=search_tool.asearch,
     ) 
\ No newline at end of file
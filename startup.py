@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import importlib
+import contextlib
+
+# Модули, импорт которых занимает секунды (LangChain, OpenAI SDK).
+# main.py загружает их в фоновом потоке, пока запускается прием обновлений.
+HEAVY_MODULES = (
+    # Ресурсы OpenAI SDK грузятся лениво при создании первого ChatOpenAI
+    "openai.resources",
+    "model_router",
+    "agents.therapist_agent",
+    "agents.observer_agent",
+    "agents.corrector_agent",
+)
+
+
+class StartupTimer:
+    """Длительность этапов запуска: импорт, создание компонентов, прогрев."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.marks = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def mark(self, name):
+        """Отмечает момент от начала запуска (только первый раз)."""
+        self.marks.setdefault(name, time.perf_counter() - self.started)
+
+    def report(self):
+        return {
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "marks": {name: round(seconds, 4) for name, seconds in self.marks.items()},
+        }
+
+    def format(self):
+        lines = [f"{name}: {seconds:.3f} с" for name, seconds in self.phases.items()]
+        lines.extend(f"{name}: через {seconds:.3f} с" for name, seconds in self.marks.items())
+        return "; ".join(lines)
+
+
+def import_heavy_modules():
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+
+
+async def warm_up(timer, therapist, router, search_client, logger=None):
+    """
+    Прогревает компоненты параллельно: цепочки и кодировку токенов,
+    пул соединений с OpenAI и пул соединений с Tavily.
+
+    Ошибки прогрева только логируются — бот работает и без него.
+    """
+    async def run(name, coroutine):
+        with timer.phase(f"warm_up_{name}"):
+            try:
+                await coroutine
+            except Exception as e:
+                if logger:
+                    logger.warning(f"Прогрев {name} не удался: {type(e).__name__}: {e}")
+
+    await asyncio.gather(
+        run("chains", asyncio.to_thread(therapist.warm_up)),
+        run("openai", router.warm_up()),
+        run("search", search_client.warm_up()),
+    )
+
+
+async def profile(warm=True):
+    """
+    Замеряет этапы запуска в текущем (чистом) процессе без приема обновлений.
+
+    Returns:
+        dict: Длительность этапов в секундах
+    """
+    timer = StartupTimer()
+    with timer.phase("import_main"):
+        import main
+    with timer.phase("import_agents"):
+        import_heavy_modules()
+    with timer.phase("construct"):
+        await main.init_components()
+    if warm:
+        with timer.phase("warm_up"):
+            await main.warm_up_components(timer)
+    await main.shutdown_components()
+    return timer.report()
+
+
+if __name__ == "__main__":
+    # Отдельный процесс, чтобы импорт замерялся без кэша модулей
+    with contextlib.redirect_stdout(sys.stderr):
+        result = asyncio.run(profile(warm=os.getenv("STARTUP_WARM_UP", "1") == "1"))
+    print(json.dumps(result, ensure_ascii=False))
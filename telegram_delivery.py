@@ -0,0 +1,181 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+PLACEHOLDER = "✍️ ..."
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Разбивает текст на части не длиннее лимита Telegram.
+
+    Разрыв по возможности делается по абзацу, строке или пробелу.
+
+    Args:
+        text (str): Исходный текст
+        limit (int): Максимальная длина одной части
+
+    Returns:
+        list[str]: Части текста
+    """
+    parts = []
+    while len(text) > limit:
+        cut = _find_cut(text, limit)
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+def _find_cut(text, limit):
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + len(separator)
+    return limit
+
+
+class StreamingReply:
+    """
+    Постепенная доставка ответа в Telegram через редактирование сообщения.
+
+    Сначала отправляется заглушка, затем по мере поступления токенов она
+    редактируется укрупненными порциями — не чаще `min_edit_interval`
+    секунд. Если текст перестает помещаться в одно сообщение, оно
+    фиксируется и продолжение уходит новым сообщением.
+    """
+
+    def __init__(self, bot, chat_id, placeholder=PLACEHOLDER,
+                 min_edit_interval=1.0, min_chunk_chars=20,
+                 limit=TELEGRAM_MESSAGE_LIMIT, logger=None):
+        """
+        Args:
+            bot (Bot): Экземпляр бота aiogram
+            chat_id (int): Идентификатор чата
+            placeholder (str): Текст заглушки до появления первых токенов
+            min_edit_interval (float): Минимальный интервал между правками, сек
+            min_chunk_chars (int): Минимальный прирост текста для правки
+            limit (int): Максимальная длина одного сообщения
+            logger: Логгер для диагностических сообщений
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.placeholder = placeholder
+        self.min_edit_interval = min_edit_interval
+        self.min_chunk_chars = min_chunk_chars
+        self.limit = limit
+        self.logger = logger
+
+        self._message_id = None
+        self._message_ids = []
+        self._sent_text = ""
+        self._current = ""
+        self._finished_parts = []
+        self._last_edit = 0.0
+        self.first_text_at = None
+        self.send_seconds = 0.0
+        self.edits = 0
+        self.messages = 0
+
+    async def start(self):
+        """Отправляет заглушку, которую затем будут редактировать."""
+        message = await self._call(
+            self.bot.send_message, chat_id=self.chat_id, text=self.placeholder
+        )
+        self._message_id = message.message_id
+        self._message_ids.append(message.message_id)
+        self._sent_text = self.placeholder
+        self.messages += 1
+
+    async def push(self, delta):
+        """Добавляет фрагмент текста и при необходимости обновляет сообщение."""
+        if not delta:
+            return
+        self._current += delta
+
+        while len(self._current) > self.limit:
+            await self._rollover()
+
+        if time.monotonic() - self._last_edit < self.min_edit_interval:
+            return
+        if len(self._current) - len(self._sent_text) < self.min_chunk_chars:
+            # Первый видимый текст показываем сразу, дальше — укрупненно
+            if self.first_text_at is not None:
+                return
+        await self._edit(self._current)
+
+    async def finish(self):
+        """
+        Отправляет остаток текста.
+
+        Returns:
+            str: Полный текст ответа
+        """
+        await self._edit(self._current)
+        return "\n".join(self._finished_parts + [self._current]).strip()
+
+    async def abort(self):
+        """Удаляет уже отправленные части ответа (генерация отменена)."""
+        for message_id in self._message_ids:
+            try:
+                await self._call(
+                    self.bot.delete_message, chat_id=self.chat_id, message_id=message_id
+                )
+            except TelegramBadRequest as e:
+                if self.logger:
+                    self.logger.warning(f"Не удалось удалить сообщение: {str(e)}")
+        self._message_ids = []
+
+    async def _rollover(self):
+        cut = _find_cut(self._current, self.limit)
+        head = self._current[:cut].rstrip()
+        tail = self._current[cut:].lstrip()
+        await self._edit(head)
+        self._finished_parts.append(head)
+
+        self._current = tail
+        message = await self._call(
+            self.bot.send_message, chat_id=self.chat_id,
+            text=tail[:self.limit] or self.placeholder
+        )
+        self._message_id = message.message_id
+        self._message_ids.append(message.message_id)
+        self._sent_text = tail[:self.limit] or self.placeholder
+        self._last_edit = time.monotonic()
+        self.messages += 1
+
+    async def _edit(self, text):
+        if not text.strip() or text == self._sent_text:
+            return
+        try:
+            await self._call(
+                self.bot.edit_message_text,
+                text=text, chat_id=self.chat_id, message_id=self._message_id
+            )
+        except TelegramBadRequest as e:
+            # "message is not modified" и подобные ошибки не критичны
+            if self.logger:
+                self.logger.warning(f"Не удалось обновить сообщение: {str(e)}")
+        self._sent_text = text
+        self._last_edit = time.monotonic()
+        self.edits += 1
+        if self.first_text_at is None:
+            self.first_text_at = self._last_edit
+
+    async def _call(self, method, **kwargs):
+        """Вызывает метод Bot API, выжидая паузу при ограничении частоты."""
+        started = time.perf_counter()
+        while True:
+            try:
+                result = await method(**kwargs)
+                self.send_seconds += time.perf_counter() - started
+                return result
+            except TelegramRetryAfter as e:
+                if self.logger:
+                    self.logger.warning(
+                        f"Ограничение частоты Telegram, ждем {e.retry_after} с"
+                    )
+                await asyncio.sleep(e.retry_after)
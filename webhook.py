@@ -0,0 +1,363 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+
+from aiohttp import web, ClientSession, ClientTimeout, ClientError, TCPConnector
+from aiogram.types import Update
+
+from latency import LatencyTracker
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Поля обновления Telegram, в которых может лежать чат
+_CHAT_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "business_message", "edited_business_message",
+)
+
+
+def jump_hash(key, buckets):
+    """
+    Согласованное хеширование (jump consistent hash, Lamping & Veach).
+
+    При изменении числа обработчиков с N на N+1 переезжает только
+    1/(N+1) чатов — остальные сохраняют свое состояние в памяти.
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def chat_id_of(update):
+    """Идентификатор чата из JSON-обновления Telegram (0, если чата нет)."""
+    for field in _CHAT_FIELDS:
+        payload = update.get(field)
+        if payload and "chat" in payload:
+            return payload["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback and callback.get("message"):
+        return callback["message"]["chat"]["id"]
+    for field in ("inline_query", "chosen_inline_result", "pre_checkout_query",
+                  "shipping_query", "my_chat_member", "chat_member"):
+        payload = update.get(field)
+        if payload:
+            if "chat" in payload:
+                return payload["chat"]["id"]
+            if "from" in payload:
+                return payload["from"]["id"]
+    return 0
+
+
+def shard_for(update, shards):
+    """Номер обработчика, которому принадлежит чат обновления."""
+    return jump_hash(chat_id_of(update), shards)
+
+
+class WebhookWorker:
+    """
+    HTTP-приемник обновлений Telegram для одного процесса бота.
+
+    Обновление разбирается и передается диспетчеру aiogram в фоновой
+    задаче — Telegram (или фронт-процесс) сразу получает ответ 200.
+    При остановке приемник перестает брать новые обновления (503, Telegram
+    повторит их позже) и дожидается завершения уже принятых.
+    """
+
+    def __init__(self, dispatcher, bot, secret=None, drain_timeout=30.0, logger=None):
+        """
+        Args:
+            dispatcher: Диспетчер aiogram
+            bot: Экземпляр Bot
+            secret (str): Ожидаемый заголовок X-Telegram-Bot-Api-Secret-Token
+            drain_timeout (float): Сколько ждать обработки принятых обновлений
+                при остановке, сек
+            logger: Логгер для диагностических сообщений
+        """
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self.drain_timeout = drain_timeout
+        self.logger = logger
+        self.draining = False
+        self._tasks = set()
+        self._counters = {"accepted": 0, "rejected": 0, "handled": 0, "failed": 0}
+        self.handle_latency = LatencyTracker()
+
+    def make_app(self, path="/webhook"):
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        app.router.add_get("/healthz", self.health)
+        return app
+
+    async def handle(self, request):
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=401)
+        if self.draining:
+            self._counters["rejected"] += 1
+            return web.Response(status=503)
+
+        data = await request.json()
+        update = Update.model_validate(data, context={"bot": self.bot})
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._counters["accepted"] += 1
+        return web.json_response({})
+
+    async def _feed(self, update):
+        started = time.perf_counter()
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+            self._counters["handled"] += 1
+        except Exception as e:
+            self._counters["failed"] += 1
+            if self.logger:
+                self.logger.error(f"Ошибка обработки обновления {update.update_id}: {str(e)}")
+        finally:
+            self.handle_latency.observe(time.perf_counter() - started)
+
+    async def health(self, request):
+        status = 503 if self.draining else 200
+        return web.json_response(self.stats(), status=status)
+
+    async def drain(self):
+        """
+        Прекращает прием обновлений и ждет обработки уже принятых.
+
+        Returns:
+            int: Сколько обновлений не успело обработаться за drain_timeout
+        """
+        self.draining = True
+        if not self._tasks:
+            return 0
+        done, pending = await asyncio.wait(set(self._tasks), timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        if pending and self.logger:
+            self.logger.warning(f"Не дождались обработки {len(pending)} обновлений")
+        return len(pending)
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats["in_flight"] = len(self._tasks)
+        stats["draining"] = self.draining
+        stats["handle_seconds"] = self.handle_latency.stats()
+        return stats
+
+
+class ShardRouter:
+    """
+    Фронт-процесс: принимает вебхук Telegram и пересылает каждое обновление
+    обработчику, которому принадлежит чат (согласованный хеш chat_id).
+
+    Все обновления одного чата попадают в один процесс, поэтому состояние
+    чата (история, окно, оценки наблюдателя) живет в памяти только там.
+    """
+
+    def __init__(self, worker_urls, secret=None, timeout=10.0, logger=None):
+        """
+        Args:
+            worker_urls (list[str]): URL вебхуков обработчиков, по номеру шарда
+            secret (str): Секрет вебхука (проверяется и передается обработчикам)
+            timeout (float): Таймаут пересылки, сек
+            logger: Логгер для диагностических сообщений
+        """
+        self.worker_urls = list(worker_urls)
+        self.secret = secret
+        self.timeout = timeout
+        self.logger = logger
+        self._session = None
+        self.forwarded = [0] * len(self.worker_urls)
+        self.failed = [0] * len(self.worker_urls)
+        self.forward_latency = LatencyTracker()
+
+    async def start(self):
+        self._session = ClientSession(
+            connector=TCPConnector(limit_per_host=100),
+            timeout=ClientTimeout(total=self.timeout)
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def make_app(self, path="/webhook"):
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        app.router.add_get("/healthz", self.health)
+        return app
+
+    async def handle(self, request):
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            shard = shard_for(json.loads(body), len(self.worker_urls))
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers[SECRET_HEADER] = self.secret
+        started = time.perf_counter()
+        try:
+            async with self._session.post(
+                self.worker_urls[shard], data=body, headers=headers
+            ) as response:
+                status = response.status
+        except (ClientError, asyncio.TimeoutError) as e:
+            status = 503
+            if self.logger:
+                self.logger.warning(f"Обработчик {shard} недоступен: {str(e)}")
+        self.forward_latency.observe(time.perf_counter() - started)
+
+        if status == 200:
+            self.forwarded[shard] += 1
+            return web.json_response({})
+        # Не 2xx — Telegram повторит доставку обновления позже
+        self.failed[shard] += 1
+        return web.Response(status=503)
+
+    async def health(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self):
+        return {
+            "forwarded": {str(i): count for i, count in enumerate(self.forwarded)},
+            "failed": {str(i): count for i, count in enumerate(self.failed)},
+            "forward_seconds": self.forward_latency.stats(),
+        }
+
+
+async def serve(app, host, port):
+    """Запускает aiohttp-приложение и возвращает раннер."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def wait_for_signal():
+    """Ждет SIGINT или SIGTERM."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+
+async def _wait_healthy(url, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    async with ClientSession(timeout=ClientTimeout(total=2)) as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return True
+            except (ClientError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(0.2)
+    return False
+
+
+class WorkerSupervisor:
+    """
+    Запускает обработчики отдельными процессами и перезапускает упавшие.
+
+    Каждый процесс — это main.py в режиме BOT_MODE=worker со своим портом.
+    """
+
+    def __init__(self, script, workers, host="127.0.0.1", base_port=8081,
+                 path="/webhook", env=None, stop_timeout=40.0, logger=None):
+        self.script = script
+        self.workers = workers
+        self.host = host
+        self.base_port = base_port
+        self.path = path
+        self.env = env or {}
+        self.stop_timeout = stop_timeout
+        self.logger = logger
+        self._processes = [None] * workers
+        self._monitors = []
+        self._stopping = False
+        self.restarts = 0
+
+    @property
+    def urls(self):
+        return [
+            f"http://{self.host}:{self.base_port + i}{self.path}"
+            for i in range(self.workers)
+        ]
+
+    def _worker_env(self, index):
+        env = dict(os.environ)
+        env.update(self.env)
+        env.update({
+            "BOT_MODE": "worker",
+            "WEBHOOK_HOST": self.host,
+            "WEBHOOK_PORT": str(self.base_port + index),
+            "WEBHOOK_PATH": self.path,
+            "SHARD_INDEX": str(index),
+            "SHARD_COUNT": str(self.workers),
+        })
+        if "METRICS_PORT" in env:
+            # У каждого процесса свой эндпоинт /metrics
+            env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + 1 + index)
+        return env
+
+    async def _spawn(self, index):
+        self._processes[index] = await asyncio.create_subprocess_exec(
+            sys.executable, self.script, env=self._worker_env(index)
+        )
+
+    async def _monitor(self, index):
+        while not self._stopping:
+            code = await self._processes[index].wait()
+            if self._stopping:
+                return
+            self.restarts += 1
+            if self.logger:
+                self.logger.error(f"Обработчик {index} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(1.0)
+            await self._spawn(index)
+
+    async def start(self):
+        for index in range(self.workers):
+            await self._spawn(index)
+        healthy = await asyncio.gather(*(
+            _wait_healthy(f"http://{self.host}:{self.base_port + i}/healthz")
+            for i in range(self.workers)
+        ))
+        self._monitors = [
+            asyncio.create_task(self._monitor(i)) for i in range(self.workers)
+        ]
+        return all(healthy)
+
+    async def stop(self):
+        """SIGTERM всем обработчикам; они дообрабатывают очередь и сбрасывают данные."""
+        self._stopping = True
+        for task in self._monitors:
+            task.cancel()
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self._processes:
+            if process is None:
+                continue
+            try:
+                await asyncio.wait_for(process.wait(), timeout=self.stop_timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()